@@ -0,0 +1,533 @@
+# -----------------------------------------------------
+# batchConverter.py
+#
+# Description: Converts many images in one Python process pool using
+#              fileConverter(). The imaging libraries are imported once
+#              in the parent and inherited by each worker, and every job
+#              gets its own result/error record so a failed conversion
+#              does not stop the rest of the batch.
+#
+# Notes:
+# 1. A manifest is a text file with one job per line:
+#       <inputImage.ext> <outputImage.ext> [compression]
+#    Blank lines and lines starting with '#' are ignored. The optional third
+#    column is a compression preset (fast, default or small) for that job,
+#    e.g. 'fast' for scratch outputs and 'small' for images to archive.
+#    Paths with spaces are quoted as in a shell ('/data/scan 1.isq'), but
+#    backslashes are kept as they are.
+#
+# 2. Instead of a manifest, a glob of inputs can be given together with an
+#    output directory and output extension. Each output is named after the
+#    input's basename (everything before the first '.').
+#
+# 3. fileConverter imports its imaging backends lazily. batch_convert()
+#    imports the ones the jobs need before the pool is started, so that the
+#    forked workers inherit them instead of importing them once each.
+#
+# 4. With --cache <dir>, all workers share one conversion cache, so inputs
+#    that were already converted with the same options are not converted
+#    again (see util/conversionCache.py).
+#
+# 5. Compressed outputs are compressed on several threads (see
+#    util/parallelCompress.py). Unless --compress-threads is given, the CPUs
+#    are split between the concurrent conversions; so are the threads that
+#    read DICOM inputs and write DICOM outputs.
+#
+# 6. --metrics-summary / --metrics <file.jsonl> report the read, write etc.
+#    stages of every conversion (see util/instrumentation.py).
+#
+# 7. If a worker process dies (killed for memory or by a signal), the pool
+#    breaks and fails every job still in it. The pool is then rebuilt and
+#    the jobs that had not started yet are submitted again. If only one job
+#    was running, it is marked failed; if several were, each of them is run
+#    again on its own, so only the job that kills its worker is marked
+#    failed. If the pool breaks before any job started, it is tried once
+#    more before the jobs are marked failed.
+# -----------------------------------------------------
+# USAGE:
+# 1. conda activate manskelab
+# 2. python batchConverter.py --manifest <jobs.txt> [-j 8] [--report results.json]
+#    python batchConverter.py --glob "<dir/*.isq>" --out-dir <dir> --out-ext .nii.gz
+#    python batchConverter.py --glob "<dir/*.isq>" --out-dir <dir> --out-ext .nii.gz --compression fast
+#
+# -----------------------------------------------------
+
+import os
+import sys
+import glob
+import json
+import shlex
+import time
+import argparse
+import traceback
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from fileConverter import fileConverter
+from util.streamWriters import split_extension
+from util.conversionCache import ConversionCache
+from util.parallelCompress import compressionPresets
+from util.instrumentation import Instrumentation, add_arguments
+
+
+def parse_manifest(manifest):
+    """
+    Read a conversion manifest.
+
+    Parameters
+    ----------
+    manifest : str
+        Path to a text file with one '<input> <output> [compression]' job
+        per line.
+
+    Returns
+    -------
+    jobs : list of tuple
+        (input, output) pairs, or (input, output, compression) for lines
+        with a compression preset.
+    """
+    jobs = []
+
+    with open(manifest, "r") as fp:
+        for line_num, line in enumerate(fp, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            try:
+                entry = _split_manifest_line(line)
+            except ValueError as e:
+                print(f"Skipped manifest line {line_num}: {e}")
+                continue
+            if len(entry) not in (2, 3):
+                print(f"Skipped manifest line {line_num}: expected '<input> <output> [compression]'")
+                continue
+            if len(entry) == 3 and entry[2] not in compressionPresets:
+                print(f"Skipped manifest line {line_num}: unknown compression preset {entry[2]}")
+                continue
+
+            jobs.append(tuple(entry))
+
+    return jobs
+
+
+def _split_manifest_line(line):
+    # Shell-style quotes, but no backslash escapes (Windows paths)
+    lexer = shlex.shlex(line, posix=True)
+    lexer.whitespace_split = True
+    lexer.escape = ""
+    lexer.commenters = ""
+    return list(lexer)
+
+
+def manifest_line(job):
+    """
+    A job as a manifest line that parse_manifest() reads back, quoting
+    paths with spaces or quotes.
+    """
+    return " ".join(shlex.quote(field) for field in job) + "\n"
+
+
+def glob_jobs(pattern, outDirectory, outExtension):
+    """
+    Build conversion jobs from a glob of input images.
+
+    Parameters
+    ----------
+    pattern : str
+        Glob pattern matching the input images (or DICOM directories).
+    outDirectory : str
+        Directory the outputs are written to.
+    outExtension : str
+        Output extension, e.g. '.nii.gz'.
+
+    Returns
+    -------
+    jobs : list of (str, str)
+    """
+    if not outExtension.startswith("."):
+        outExtension = "." + outExtension
+
+    jobs = []
+    for inputImage in sorted(glob.glob(pattern)):
+        inFilename = os.path.basename(os.path.normpath(inputImage))
+        inBasename = inFilename.split(".")[0]
+        jobs.append((inputImage, os.path.join(outDirectory, inBasename + outExtension)))
+
+    return jobs
+
+
+def _available_cpus():
+    # CPUs this process may run on (a Slurm allocation or cgroup can allow
+    # fewer than the machine has)
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _preload_backends(jobs):
+    """
+    Import the imaging backends the jobs will need in the parent process.
+    """
+    import SimpleITK  # noqa: F401  (needed by every non-streamed conversion)
+
+    for inputImage, outputImage, *_ in jobs:
+        inExtension = split_extension(inputImage)[1]
+        outExtension = split_extension(outputImage)[1]
+
+        # ISQ outputs and compressed AIMs go through ITK
+        if outExtension == ".isq" or ".aim" in inExtension:
+            import itk
+
+            itk.ImageFileReader  # itk loads its submodules on first access
+            break
+
+
+def _convert_job(inputImage, outputImage, options, instrument=False):
+    """
+    Run a single conversion and return its result record.
+
+    fileConverter() calls sys.exit() on bad input, so SystemExit is caught
+    here as well to keep the worker (and the rest of the batch) alive.
+    With instrument=True, the record also holds the conversion's stage
+    records ('stages', see util/instrumentation.py).
+    """
+    record = {
+        "input": inputImage,
+        "output": outputImage,
+        "status": "ok",
+        "error": None,
+        "seconds": 0.0,
+    }
+
+    instrumentation = Instrumentation(tool="batchConverter") if instrument else None
+
+    start = time.perf_counter()
+    try:
+        if instrumentation is not None:
+            with instrumentation:
+                fileConverter(inputImage, outputImage, **options)
+        else:
+            fileConverter(inputImage, outputImage, **options)
+    except SystemExit as e:
+        record["status"] = "error"
+        record["error"] = f"fileConverter exited with status {e.code}"
+    except Exception:
+        record["status"] = "error"
+        record["error"] = traceback.format_exc()
+    record["seconds"] = round(time.perf_counter() - start, 3)
+
+    if instrumentation is not None:
+        record["stages"] = instrumentation.records
+
+    return record
+
+
+# Indices of the jobs a worker started, see _run_job()
+_started = None
+
+
+def _init_worker(started):
+    global _started
+    _started = started
+
+
+def _run_job(idx, inputImage, outputImage, options, instrument):
+    # Tell the parent which job this worker is running, in case it dies
+    _started.put(idx)
+    return _convert_job(inputImage, outputImage, options, instrument)
+
+
+def _died_record(inputImage, outputImage, error):
+    return {
+        "input": inputImage,
+        "output": outputImage,
+        "status": "error",
+        "error": error,
+        "seconds": None,
+    }
+
+
+def _run_pool(jobs, indices, max_workers, options, instrument, finish):
+    """
+    Run jobs[idx] for every idx in indices through one process pool,
+    calling finish(idx, record) as they complete.
+
+    Returns
+    -------
+    running : list of int
+        If a worker died and broke the pool: the jobs that had started but
+        not finished. Jobs that never started get no record.
+    error : str or None
+        The error that broke the pool.
+    """
+    started = multiprocessing.SimpleQueue()
+    finished = set()
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(started,)) as executor:
+        futures = {}
+        for idx in indices:
+            inputImage, outputImage, *compression = jobs[idx]
+            jobOptions = dict(options, compression=compression[0]) if compression else options
+            future = executor.submit(_run_job, idx, inputImage, outputImage, jobOptions, instrument)
+            futures[future] = idx
+
+        error = None
+        for future in as_completed(futures):
+            idx = futures[future]
+            try:
+                record = future.result()
+            except BrokenProcessPool:
+                # A worker process died (e.g. killed for memory)
+                error = traceback.format_exc()
+                continue
+            except Exception:
+                record = _died_record(*jobs[idx][:2], traceback.format_exc())
+            finished.add(idx)
+            finish(idx, record)
+
+    if error is None:
+        return [], None
+
+    running = set()
+    while not started.empty():
+        running.add(started.get())
+    return sorted(running - finished), error
+
+
+def batch_convert(jobs, max_workers=None, report=None, instrumentation=None, **options):
+    """
+    Convert a list of images through a process pool.
+
+    Parameters
+    ----------
+    jobs : list of tuple
+        (inputImage, outputImage) pairs, or (inputImage, outputImage,
+        compression) to use another compression preset for that job.
+    max_workers : int, optional
+        Maximum number of concurrent conversions. Defaults to the number of
+        CPUs available to this process.
+    report : str, optional
+        Path of a JSON file the result records are written to.
+    instrumentation : Instrumentation, optional
+        Receives the stage records of every conversion.
+    **options
+        Extra keyword arguments passed to every fileConverter() call.
+
+    Returns
+    -------
+    records : list of dict
+        One record per job, in the same order as jobs. Each record holds
+        'input', 'output', 'status' ('ok' or 'error'), 'error' and 'seconds'.
+    """
+    cpus = _available_cpus()
+    if max_workers is None:
+        max_workers = cpus
+    max_workers = max(1, min(max_workers, len(jobs) or 1))
+
+    # Share the CPUs between the concurrent conversions
+    if options.get("compressThreads") is None:
+        options["compressThreads"] = max(1, cpus // max_workers)
+    if options.get("readThreads") is None:
+        options["readThreads"] = max(1, cpus // max_workers)
+    if options.get("dicomThreads") is None:
+        options["dicomThreads"] = max(1, cpus // max_workers)
+
+    records = [None] * len(jobs)
+
+    _preload_backends(jobs)
+
+    def finish(idx, record):
+        records[idx] = record
+        if instrumentation is not None:
+            instrumentation.add(record.pop("stages", []))
+        done = sum(r is not None for r in records)
+        print(f"[{done}/{len(jobs)}] {record['status'].upper()}: {jobs[idx][0]}")
+
+    pending = list(range(len(jobs)))
+    # Jobs that were running together when a worker died, each run alone
+    isolated = []
+    # Whether the last pool broke before any of its jobs started
+    brokeIdle = False
+    while pending or isolated:
+        if isolated:
+            indices, workers = [isolated.pop(0)], 1
+        else:
+            indices, workers = pending, max_workers
+
+        done = sum(r is not None for r in records)
+        running, error = _run_pool(jobs, indices, workers, options, instrumentation is not None, finish)
+        progress = sum(r is not None for r in records) > done
+
+        if error is not None and not running and not progress and not brokeIdle:
+            # No job started: the pool itself failed, try it once more
+            brokeIdle = True
+            if len(indices) == 1 and indices[0] not in pending:
+                isolated.insert(0, indices[0])
+            continue
+        brokeIdle = False
+
+        if error is not None and len(running) <= 1:
+            # The job that killed its worker, or (if none had started twice
+            # in a row) every job left, so that a pool that cannot start
+            # does not loop
+            for idx in running or [idx for idx in indices if records[idx] is None]:
+                finish(idx, _died_record(*jobs[idx][:2], error))
+        else:
+            isolated.extend(running)
+
+        pending = [idx for idx in pending if records[idx] is None and idx not in isolated]
+
+    if report is not None:
+        with open(report, "w") as fp:
+            json.dump(records, fp, indent=2)
+
+    return records
+
+
+def main():
+    # Parse input arguments
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
+        "--manifest", type=str, help="Text file with one '<input> <output>' pair per line"
+    )
+    source.add_argument(
+        "--glob", type=str, help="Glob pattern of input images (quote it!)"
+    )
+    parser.add_argument(
+        "--out-dir", type=str, default=".", help="Output directory (with --glob)"
+    )
+    parser.add_argument(
+        "--out-ext", type=str, default=".nii.gz", help="Output extension (with --glob)"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None, help="Maximum number of concurrent conversions"
+    )
+    parser.add_argument(
+        "--report", type=str, default=None, help="JSON file to write per-job results to"
+    )
+    parser.add_argument(
+        "--stream", action="store_true", help="Convert AIM/ISQ images slab by slab"
+    )
+    parser.add_argument(
+        "--slab-size", type=int, default=64, help="Number of slices per slab when streaming"
+    )
+    parser.add_argument(
+        "--dicom-multiframe", action="store_true", help="Write a single multi-frame DICOM file"
+    )
+    parser.add_argument(
+        "--cache", type=str, default=None, help="Conversion cache directory"
+    )
+    parser.add_argument(
+        "--cache-max-gb", type=float, default=None, help="Size limit of the conversion cache (GB)"
+    )
+    parser.add_argument(
+        "--cache-link", action="store_true",
+        help="Hard-link cached outputs instead of copying them (do not modify them in place!)"
+    )
+    parser.add_argument(
+        "--compress", action="store_true", help="Compress MHA, MHD, NRRD and TIFF outputs"
+    )
+    parser.add_argument(
+        "--tif-series", action="store_true", help="Write TIFF outputs as one file per slice"
+    )
+    parser.add_argument(
+        "--tif-tile", type=int, default=None, help="Write TIFF outputs in tiles of this size (multiple of 16)"
+    )
+    parser.add_argument(
+        "--zarr-chunks", type=int, nargs=3, default=None, metavar=("Z", "Y", "X"),
+        help="Chunk shape of Zarr outputs (default: 64 256 256)"
+    )
+    parser.add_argument(
+        "--zarr-levels", type=int, default=None, help="Pyramid levels of Zarr outputs (default: until one chunk)"
+    )
+    parser.add_argument(
+        "--qc", action="store_true",
+        help="Write mid-slice and MIP previews, a histogram and statistics to <output>_qc/"
+    )
+    parser.add_argument(
+        "--roi", type=float, nargs="+", default=None, metavar="BOUND",
+        help="Only convert this region: X0 Y0 X1 Y1 or X0 Y0 Z0 X1 Y1 Z1 (voxel indices, upper bounds excluded)"
+    )
+    parser.add_argument(
+        "--roi-mm", action="store_true", help="--roi bounds are physical coordinates (mm) instead of indices"
+    )
+    parser.add_argument(
+        "--slices", type=int, nargs=2, default=None, metavar=("Z0", "Z1"),
+        help="Only convert slices Z0 up to (excluding) Z1"
+    )
+    parser.add_argument(
+        "--compression", type=str, default=None, choices=list(compressionPresets),
+        help="Compression preset for jobs without one in the manifest"
+    )
+    parser.add_argument(
+        "--compress-level", type=int, default=None, help="zlib compression level (0-9), overrides --compression"
+    )
+    parser.add_argument(
+        "--compress-threads", type=int, default=None, help="Compression threads per conversion"
+    )
+    parser.add_argument(
+        "--pixel-type", type=str, default=None,
+        help="Output pixel type (uint8, int16, float32, ...) or auto (default: keep the input's type)"
+    )
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.manifest is not None:
+        jobs = parse_manifest(args.manifest)
+    else:
+        if not os.path.exists(args.out_dir):
+            os.makedirs(args.out_dir)
+        jobs = glob_jobs(args.glob, args.out_dir, args.out_ext)
+
+    if not jobs:
+        print()
+        print("Error: no conversion jobs found!")
+        sys.exit(1)
+
+    cache = None
+    if args.cache is not None:
+        maxBytes = int(args.cache_max_gb * 1e9) if args.cache_max_gb is not None else None
+        cache = ConversionCache(args.cache, maxBytes=maxBytes, link=args.cache_link)
+
+    with Instrumentation.from_args(args, tool="batchConverter") as instrumentation:
+        records = batch_convert(
+            jobs,
+            max_workers=args.jobs,
+            report=args.report,
+            instrumentation=instrumentation,
+            stream=args.stream,
+            slabSize=args.slab_size,
+            dicomMultiframe=args.dicom_multiframe,
+            cache=cache,
+            compress=args.compress,
+            compression=args.compression,
+            compressionLevel=args.compress_level,
+            compressThreads=args.compress_threads,
+            pixelType=args.pixel_type,
+            tifSeries=args.tif_series,
+            tifTile=args.tif_tile,
+            zarrChunks=args.zarr_chunks,
+            zarrLevels=args.zarr_levels,
+            qc=args.qc,
+            roi=args.roi,
+            roiPhysical=args.roi_mm,
+            slices=args.slices,
+        )
+
+    failed = [r for r in records if r["status"] != "ok"]
+    print()
+    print(f"CONVERTED: {len(records) - len(failed)}/{len(records)}")
+    for record in failed:
+        print(f"FAILED: {record['input']}")
+        print(record["error"])
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
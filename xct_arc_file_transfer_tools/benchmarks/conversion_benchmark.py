@@ -0,0 +1,415 @@
+# -----------------------------------------------------
+# conversion_benchmark.py
+#
+# Description: Times every fileConverter() input -> output path on a
+#              synthetic volume of a realistic HR-pQCT size. The volume is
+#              written once in every input format (ISQ and AIM through
+#              ScancoImageIO, a DICOM series, a TIFF series, MHA, NRRD and
+#              NIfTI), then each conversion is run in a fresh interpreter
+#              and its wall time, CPU time, throughput (MB/s of voxel
+#              data), peak RSS and output size are recorded.
+#
+# Notes:
+# 1. Volume sizes (--size):
+#       tiny   128 x 128 x 32    (to check that every path works)
+#       small  576 x 576 x 168   (an XtremeCT II stack at a quarter of the
+#                                 in-plane resolution, ~110 MB)
+#       xct1  1536 x 1536 x 110  (one XtremeCT stack, ~520 MB)
+#       xct2  2304 x 2304 x 168  (one XtremeCT II stack, ~1.8 GB)
+#    The voxels are int16: air, a soft tissue cylinder and a bone with a
+#    cortex and a speckled trabecular region, plus noise, so that the data
+#    compresses about as well as a real scan. The volume is seeded and the
+#    same for every run.
+#
+# 2. Each conversion runs in its own interpreter, so peak RSS is that of
+#    the conversion alone (plus the imported libraries). The best time of
+#    --repeat runs is kept. Streamed paths (--stream, for ISQ/AIM inputs)
+#    are benchmarked as separate paths.
+#
+# 3. With --baseline, the results are compared with a stored baseline of
+#    the same volume size. A path is reported as a regression if it became
+#    more than --tolerance slower, used more than --rss-tolerance more
+#    memory, grew its output by more than --size-tolerance, or failed
+#    where it used to work. The library versions of both runs are printed
+#    so that a slow-down can be traced to an upgrade. Exits with status 1
+#    on any regression. --save writes the results to the baseline file.
+#
+# 4. Runs offline, on the CPU only. The inputs are kept in --work-dir (if
+#    given) and reused by later runs of the same size.
+# -----------------------------------------------------
+# USAGE:
+# 1. conda activate manskelab
+# 2. python benchmarks/conversion_benchmark.py --size small --baseline conversion_baseline.json --save
+# 3. python benchmarks/conversion_benchmark.py --size small --baseline conversion_baseline.json
+# 4. python benchmarks/conversion_benchmark.py --inputs isq aim --outputs nii.gz --repeat 3
+#
+# -----------------------------------------------------
+
+import os
+import sys
+import json
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+TOOLS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOOLS_DIR)
+
+from util.lazyImport import lazy_import  # noqa: E402
+
+itk = lazy_import("itk")
+sitk = lazy_import("SimpleITK")
+
+# (x, y, z)
+SIZES = {
+    "tiny": (128, 128, 32),
+    "small": (576, 576, 168),
+    "xct1": (1536, 1536, 110),
+    "xct2": (2304, 2304, 168),
+}
+
+SPACING = (0.0607, 0.0607, 0.0607)
+
+INPUTS = ["isq", "aim", "dcm", "tif", "mha", "nrrd", "nii.gz"]
+OUTPUTS = ["mha", "nrrd", "nii.gz", "dcm", "tif", "isq", "zarr"]
+STREAM_INPUTS = ["isq", "aim"]
+STREAM_OUTPUTS = ["mha", "nrrd", "nii.gz", "tif", "zarr"]
+
+MIN_SECONDS = 0.05
+
+# Runs one conversion in a fresh interpreter and prints its measurements.
+# Imports are done before the clock starts.
+_PROBE = """
+import os, sys, json, time, resource
+sys.path.insert(0, {tools!r})
+import SimpleITK, itk
+itk.ImageFileReader
+from fileConverter import fileConverter
+wall, cpu = time.perf_counter(), time.process_time()
+fileConverter({input!r}, {output!r}, stream={stream!r})
+wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+print("RESULT:" + json.dumps({{
+    "seconds": wall,
+    "cpu_seconds": cpu,
+    "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+}}))
+"""
+
+
+def synthetic_volume(size, seed=0):
+    """
+    int16 volume of shape (z, y, x) that looks roughly like an HR-pQCT
+    scan of a distal radius or tibia.
+
+    Parameters
+    ----------
+    size : (int, int, int)
+        (x, y, z)
+    seed : int
+    """
+    nx, ny, nz = size
+    rng = np.random.default_rng(seed)
+
+    y, x = np.ogrid[:ny, :nx]
+    radius = np.hypot((y - ny / 2) / (ny / 2), (x - nx / 2) / (nx / 2)).astype(np.float32)
+
+    volume = np.empty((nz, ny, nx), dtype=np.int16)
+    for z in range(nz):
+        # The bone gets a little wider and narrower along the stack
+        outer = 0.5 + 0.05 * np.sin(2 * np.pi * z / nz)
+        inner = outer - 0.08
+
+        voxels = rng.normal(0.0, 120.0, (ny, nx)).astype(np.float32)
+        voxels += np.where(radius < 0.9, 250.0, -250.0)
+        voxels[(radius < outer) & (radius >= inner)] += 5000.0
+        trabecular = radius < inner
+        voxels[trabecular] += 2500.0 * (rng.random(int(trabecular.sum())) < 0.3)
+
+        volume[z] = np.clip(voxels, -32768, 32767)
+
+    return volume
+
+
+def _write_scanco(image, fileName):
+    # ScancoImageIO needs the dates in the meta-data to write a header
+    for key in ("CreationDate", "ModificationDate"):
+        image[key] = "2020-JAN-01 10:00:00.000"
+
+    writer = itk.ImageFileWriter[type(image)].New()
+    writer.SetImageIO(itk.ScancoImageIO.New())
+    writer.SetInput(image)
+    writer.SetFileName(fileName)
+    writer.Update()
+
+
+def write_inputs(volume, workDir, inputs):
+    """
+    Write the volume in every input format.
+
+    Returns
+    -------
+    inputFiles : dict
+        Input format -> file (or series directory) to convert.
+    """
+    from util.img2dicom import img2dicom
+
+    image = sitk.GetImageFromArray(volume)
+    image.SetSpacing(SPACING)
+
+    inputFiles = {}
+    for fmt in inputs:
+        # Series are read from a directory
+        name = fmt if fmt in ("dcm", "tif") else "input." + fmt
+        fileName = os.path.join(workDir, name)
+        inputFiles[fmt] = fileName
+
+        # Inputs left by an earlier run are reused
+        if os.path.exists(fileName):
+            continue
+
+        # Written to a temporary directory and moved once complete, so an
+        # interrupted run never leaves a partial input behind
+        tmpDir = tempfile.mkdtemp(dir=workDir)
+        if fmt in ("isq", "aim"):
+            itkImage = itk.GetImageFromArray(volume)
+            itkImage.SetSpacing(SPACING)
+            _write_scanco(itkImage, os.path.join(tmpDir, name))
+        elif fmt == "dcm":
+            img2dicom(image, tmpDir)
+        elif fmt == "tif":
+            os.mkdir(os.path.join(tmpDir, name))
+            for z in range(volume.shape[0]):
+                sitk.WriteImage(image[:, :, z], os.path.join(tmpDir, name, f"slice{z:04d}.tif"))
+        else:
+            sitk.WriteImage(image, os.path.join(tmpDir, name))
+
+        os.rename(os.path.join(tmpDir, name), fileName)
+        shutil.rmtree(tmpDir)
+
+    return inputFiles
+
+
+def _output_size(directory):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(directory)
+        for name in names
+    )
+
+
+def run_path(inputFile, outputFormat, workDir, stream=False, repeat=1):
+    """
+    Benchmark one conversion.
+
+    Returns
+    -------
+    result : dict
+        'status' ('ok' or 'error'), 'error', 'seconds' and 'cpu_seconds'
+        (best run), 'peak_rss_mb' (largest run) and 'output_bytes'.
+    """
+    result = {
+        "status": "ok",
+        "error": None,
+        "seconds": None,
+        "cpu_seconds": None,
+        "peak_rss_mb": None,
+        "output_bytes": None,
+    }
+
+    for _ in range(repeat):
+        outDir = tempfile.mkdtemp(prefix="out_", dir=workDir)
+        probe = _PROBE.format(
+            tools=TOOLS_DIR,
+            input=inputFile,
+            output=os.path.join(outDir, "output." + outputFormat),
+            stream=stream,
+        )
+
+        try:
+            proc = subprocess.run([sys.executable, "-c", probe], cwd=TOOLS_DIR, capture_output=True, text=True)
+            lines = [line for line in proc.stdout.splitlines() if line.startswith("RESULT:")]
+            if proc.returncode != 0 or not lines:
+                result["status"] = "error"
+                result["error"] = (proc.stderr.strip().splitlines() or [f"exit status {proc.returncode}"])[-1]
+                break
+
+            measured = json.loads(lines[-1][len("RESULT:"):])
+            for key in ("seconds", "cpu_seconds"):
+                if result[key] is None or measured[key] < result[key]:
+                    result[key] = round(measured[key], 4)
+            result["peak_rss_mb"] = round(max(result["peak_rss_mb"] or 0.0, measured["peak_rss_mb"]), 1)
+            result["output_bytes"] = _output_size(outDir)
+        finally:
+            shutil.rmtree(outDir, ignore_errors=True)
+
+    return result
+
+
+def environment():
+    """
+    Versions of the libraries a conversion depends on.
+    """
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "SimpleITK": sitk.Version_VersionString(),
+        "itk": itk.Version.GetITKVersion(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(results, baseline, tolerance, rssTolerance, sizeTolerance):
+    """
+    Compare results with a baseline.
+
+    Returns
+    -------
+    regressions : list of str
+    """
+    regressions = []
+
+    for path, result in results.items():
+        reference = baseline.get(path)
+        if reference is None:
+            continue
+
+        if result["status"] != "ok":
+            if reference["status"] == "ok":
+                regressions.append(f"{path} fails: {result['error']}")
+            continue
+        if reference["status"] != "ok":
+            continue
+
+        # Differences below MIN_SECONDS are timer noise on small volumes
+        if result["seconds"] > max(reference["seconds"] * (1.0 + tolerance), reference["seconds"] + MIN_SECONDS):
+            regressions.append(
+                f"{path} took {result['seconds']:.3f} s (baseline {reference['seconds']:.3f} s)"
+            )
+        if result["peak_rss_mb"] > reference["peak_rss_mb"] * (1.0 + rssTolerance):
+            regressions.append(
+                f"{path} peaked at {result['peak_rss_mb']:.0f} MB (baseline {reference['peak_rss_mb']:.0f} MB)"
+            )
+        if result["output_bytes"] > reference["output_bytes"] * (1.0 + sizeTolerance):
+            regressions.append(
+                f"{path} wrote {result['output_bytes']} bytes (baseline {reference['output_bytes']})"
+            )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=str, default="small", choices=list(SIZES), help="Volume size")
+    parser.add_argument("--inputs", nargs="+", default=INPUTS, choices=INPUTS, help="Input formats")
+    parser.add_argument("--outputs", nargs="+", default=OUTPUTS, choices=OUTPUTS, help="Output formats")
+    parser.add_argument("--no-stream", action="store_true", help="Skip the streamed ISQ/AIM paths")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per path (best time is kept)")
+    parser.add_argument("--work-dir", type=str, default=None, help="Directory for the inputs (kept)")
+    parser.add_argument("--baseline", type=str, default=None, help="Baseline JSON file")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.25, help="Allowed slow-down relative to the baseline"
+    )
+    parser.add_argument(
+        "--rss-tolerance", type=float, default=0.25, help="Allowed peak RSS increase relative to the baseline"
+    )
+    parser.add_argument(
+        "--size-tolerance", type=float, default=0.05, help="Allowed output size increase relative to the baseline"
+    )
+    parser.add_argument("--save", action="store_true", help="Write the results to --baseline")
+    parser.add_argument("--report", type=str, default=None, help="JSON file to write the results to")
+    args = parser.parse_args()
+
+    size = SIZES[args.size]
+
+    baseline = None
+    if args.baseline is not None and os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline, "r") as fp:
+            baseline = json.load(fp)
+        if baseline.get("size") != list(size):
+            print(f"Baseline is for a {baseline.get('size')} volume, not {list(size)}; not comparing.")
+            baseline = None
+
+    workDir = args.work_dir or tempfile.mkdtemp(prefix="conversion_benchmark_")
+    workDir = os.path.join(workDir, "x".join(str(n) for n in size))
+    os.makedirs(workDir, exist_ok=True)
+
+    try:
+        print(f"Writing the {' x '.join(str(n) for n in size)} inputs to {workDir}")
+        volume = synthetic_volume(size)
+        volumeBytes = volume.nbytes
+        inputFiles = write_inputs(volume, workDir, args.inputs)
+        del volume
+
+        paths = [(i, o, False) for i in args.inputs for o in args.outputs]
+        if not args.no_stream:
+            paths += [
+                (i, o, True) for i in args.inputs if i in STREAM_INPUTS
+                for o in args.outputs if o in STREAM_OUTPUTS
+            ]
+
+        results = {}
+        reference = baseline["results"] if baseline is not None else {}
+
+        print()
+        print(f"{'path':<22} {'seconds':>8} {'cpu s':>8} {'MB/s':>8} {'peak MB':>8} {'out MB':>8} {'baseline s':>10}")
+        for inputFormat, outputFormat, stream in paths:
+            path = f"{inputFormat}->{outputFormat}" + (" (stream)" if stream else "")
+            result = run_path(inputFiles[inputFormat], outputFormat, workDir, stream, args.repeat)
+            if result["status"] == "ok":
+                result["mb_per_s"] = round(volumeBytes / 1e6 / result["seconds"], 2)
+            results[path] = result
+
+            previous = reference.get(path, {}).get("seconds")
+            previous = f"{previous:.3f}" if previous is not None else "-"
+            if result["status"] == "ok":
+                print(
+                    f"{path:<22} {result['seconds']:8.3f} {result['cpu_seconds']:8.3f} "
+                    f"{result['mb_per_s']:8.1f} {result['peak_rss_mb']:8.0f} "
+                    f"{result['output_bytes'] / 1e6:8.1f} {previous:>10}"
+                )
+            else:
+                print(f"{path:<22} {'FAILED':>8}  {result['error']}")
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(os.path.dirname(workDir), ignore_errors=True)
+
+    report = {
+        "size": list(size),
+        "volume_bytes": volumeBytes,
+        "environment": environment(),
+        "results": results,
+    }
+
+    regressions = []
+    if baseline is not None:
+        print()
+        for key, value in report["environment"].items():
+            old = baseline.get("environment", {}).get(key)
+            if old is not None and old != value:
+                print(f"{key}: {old} (baseline) -> {value}")
+        regressions = compare(results, reference, args.tolerance, args.rss_tolerance, args.size_tolerance)
+        report["regressions"] = regressions
+
+    if args.report is not None:
+        with open(args.report, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+    if args.save and args.baseline is not None:
+        with open(args.baseline, "w") as fp:
+            json.dump(report, fp, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+
+    if regressions:
+        print()
+        for regression in regressions:
+            print("REGRESSION: " + regression)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# -----------------------------------------------------
+# startup_benchmark.py
+#
+# Description: Guards the start-up time of the command line tools.
+#              Each CLI is started with --help in a fresh interpreter
+#              (best of --repeat runs), and it is checked that none of
+#              them imports an imaging backend (itk, vtk, SimpleITK)
+#              before a conversion actually needs it.
+#
+# Notes:
+# 1. Exits with status 1 if a CLI imports a backend at start-up, takes
+#    longer than --max-seconds, or (with --baseline) is more than
+#    --tolerance slower than the stored baseline.
+# 2. --save writes the measured times to the baseline file.
+# -----------------------------------------------------
+# USAGE:
+# 1. conda activate manskelab
+# 2. python benchmarks/startup_benchmark.py [--baseline startup_baseline.json] [--save]
+#
+# -----------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+TOOLS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CLIS = [
+    "fileConverter.py",
+    "batchConverter.py",
+    "get_xct.py",
+    "check_xct.py",
+    "check_arc.py",
+    "xct_pipeline.py",
+    "slurmConverter.py",
+    "cacheStats.py",
+    "classifyAIMs.py",
+]
+
+BACKENDS = ("itk", "vtk", "SimpleITK")
+
+# Runs the CLI's --help inside this interpreter and reports which backends
+# were imported along the way.
+_PROBE = """
+import sys, runpy
+sys.argv = [{script!r}, "--help"]
+try:
+    runpy.run_path({script!r}, run_name="__main__")
+except SystemExit:
+    pass
+print("BACKENDS:" + ",".join(m for m in {backends!r} if m in sys.modules))
+"""
+
+
+def time_cli(script, repeat=5):
+    """
+    Time '<python> <script> --help' in a fresh interpreter.
+
+    Returns
+    -------
+    seconds : float
+        Best wall time over the repeats.
+    backends : list of str
+        Imaging backends imported while starting up.
+    """
+    scriptPath = os.path.join(TOOLS_DIR, script)
+    probe = _PROBE.format(script=scriptPath, backends=BACKENDS)
+
+    best = None
+    backends = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-c", probe],
+            cwd=TOOLS_DIR,
+            capture_output=True,
+            text=True,
+        )
+        elapsed = time.perf_counter() - start
+
+        if result.returncode != 0:
+            raise RuntimeError(f"{script} failed to start:\n{result.stderr}")
+
+        best = elapsed if best is None else min(best, elapsed)
+        for line in result.stdout.splitlines():
+            if line.startswith("BACKENDS:"):
+                backends = [m for m in line[len("BACKENDS:"):].split(",") if m]
+
+    return best, backends
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per CLI (best is kept)")
+    parser.add_argument(
+        "--max-seconds", type=float, default=1.0, help="Start-up time budget per CLI"
+    )
+    parser.add_argument("--baseline", type=str, default=None, help="Baseline JSON file")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.25, help="Allowed slow-down relative to the baseline"
+    )
+    parser.add_argument("--save", action="store_true", help="Write the results to --baseline")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline is not None and os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline, "r") as fp:
+            baseline = json.load(fp)
+
+    results = {}
+    failures = []
+
+    print(f"{'CLI':<20} {'seconds':>8} {'baseline':>9}  backends")
+    for script in CLIS:
+        seconds, backends = time_cli(script, args.repeat)
+        results[script] = round(seconds, 4)
+
+        reference = baseline.get(script)
+        print(
+            f"{script:<20} {seconds:8.3f} "
+            f"{(f'{reference:.3f}' if reference is not None else '-'):>9}  "
+            f"{','.join(backends) or '-'}"
+        )
+
+        if backends:
+            failures.append(f"{script} imports {', '.join(backends)} at start-up")
+        if seconds > args.max_seconds:
+            failures.append(f"{script} took {seconds:.3f} s (budget {args.max_seconds:.3f} s)")
+        if reference is not None and seconds > reference * (1.0 + args.tolerance):
+            failures.append(f"{script} took {seconds:.3f} s (baseline {reference:.3f} s)")
+
+    if args.save and args.baseline is not None:
+        with open(args.baseline, "w") as fp:
+            json.dump(results, fp, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+
+    if failures:
+        print()
+        for failure in failures:
+            print("REGRESSION: " + failure)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# -----------------------------------------------------
+# cacheStats.py
+#
+# Description: Reports the size and hit rate of a conversion cache
+#              (see util/conversionCache.py), and optionally shrinks or
+#              clears it.
+#
+# -----------------------------------------------------
+# USAGE:
+# 1. conda activate manskelab
+# 2. python cacheStats.py <cacheDir> [--max-gb 500] [--clear]
+#
+# -----------------------------------------------------
+
+import os
+import sys
+import argparse
+
+from util.conversionCache import ConversionCache
+
+
+def main():
+    # Parse input arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cacheDir", type=str, help="Conversion cache directory")
+    parser.add_argument(
+        "--max-gb", type=float, default=None, help="Evict least recently used entries down to this size (GB)"
+    )
+    parser.add_argument("--clear", action="store_true", help="Remove every entry")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.cacheDir):
+        print()
+        print(f"Error: {args.cacheDir} is not a directory!")
+        sys.exit(1)
+
+    cache = ConversionCache(args.cacheDir)
+
+    if args.clear:
+        print(f"Removed {cache.clear()} entries")
+    elif args.max_gb is not None:
+        print(f"Removed {cache.evict(int(args.max_gb * 1e9))} entries")
+
+    stats = cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    hitRate = 100.0 * stats["hits"] / lookups if lookups else 0.0
+
+    print(f"Entries: {stats['entries']}")
+    print(f"Size:    {stats['bytes'] / 1e9:.3f} GB")
+    print(f"Hits:    {stats['hits']}")
+    print(f"Misses:  {stats['misses']}")
+    print(f"Hit rate: {hitRate:.1f}%")
+
+
+if __name__ == "__main__":
+    main()
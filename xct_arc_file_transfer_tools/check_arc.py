@@ -1,96 +1,157 @@
+# -----------------------------------------------------
+# check_arc.py
+#
+# Description: Checks which converted stacks of a pull request exist on arc.
+#
+# Notes:
+# 1. All expected paths are sent to arc at once and checked with a single
+#    remote stat, which returns the size and modification time of every
+#    file that exists. The result is compared with the expected set locally.
+#
+# 2. Writes <out_dir>/check_arc_report.json (one record per stack with
+#    status 'present', 'missing' or 'size_mismatch') and <out_dir>/log_arc.txt.
+#
+# 3. --arc-host may be 'local:<dir>' to check a local directory instead
+#    (for testing).
+#
+# 4. With --db <jobs.db>, only stacks that have not been verified yet are
+#    checked, and stacks found on arc are marked verified (see
+#    util/manifest.py). Rerunning after adding subjects to the pull request
+#    only checks the new stacks.
+# -----------------------------------------------------
+# USAGE:
+# 1. conda activate manskelab
+# 2. python check_arc.py <pull_request.txt> ./ [--arc-root /work/...] [--compare-dir ./temp] [--db jobs.db]
+#
+# -----------------------------------------------------
+
 import os
+import json
 import argparse
-import shutil
 
-def parse_txt(data):
-    '''
-    parse_txt 
-        Parses through list of liens from txt file to arrage data into dictionary.
+from util.manifest import JobDB, parse_txt, expand_jobs
+from util.instrumentation import Instrumentation, add_arguments
+from util.transferEngine import TransferEngine
 
-    Input: 
-    data -> rows of data in following format:
-        ("Study_ID Sample_# DST1 MID1 PRX1 ... DSTN MIDN PRXN")
+ARC_HOST = 'arc'
+ARC_ROOT = '/work/manske_lab/images/hrpqct/mcp/actus_raw_stacks'
 
-    Output:
-    Dictionary of data with [Study_ID, Sample_#] as key.
-    '''
-    data_dict = {}
-
-    for study_data in data:
-        entry = study_data.split()
-        key = tuple([entry[0], entry[1]])
-        isqs = entry[2:]
-
-        measure_nums = []
-        if len(measure_nums)%3:
-            # print('Must have three measurement numbers for each image. (DST MID PRX).')
-            print('Skipped {}'.format(entry[0]))
-            continue
-
-        for idx in range(0, len(isqs), 3):
-            measure_nums.append(isqs[idx:idx+3])
-        
-        data_dict[key] = measure_nums
-    
-    return data_dict
-
-def batch_check(data_dict, out_dir, out_txt):
+def batch_check(data_dict, engine, arc_host=ARC_HOST, arc_root=ARC_ROOT, compare_dir=None, only=None):
     '''
-    sftp_fetch
-        uses sftp to download isqs in data_dict to out_dir
+    batch_check
+        Checks which nii.gz stacks of data_dict exist on arc, with one remote
+        stat of every expected path.
 
     data_dict
         dictionary
-    out_dir
-        path to output directory
-    out_txt
-        path to txt file to log sftp commands
+    engine
+        TransferEngine used to reach arc
+    arc_host
+        host address of arc (or local:<dir>)
+    arc_root
+        directory holding <Study_ID>/<timepoint>/<Study_ID>_<STACK>.nii.gz on arc
+    compare_dir
+        optional local directory with the same layout; stacks whose size on arc
+        differs from the local file are reported as 'size_mismatch'
+    only
+        optional set of (Study_ID, timepoint, STACK) to check; other stacks
+        are skipped
+
+    Output:
+    List of records, one per stack, with the study id, timepoint, stack, path,
+    status ('present', 'missing' or 'size_mismatch'), size and mtime.
     '''
 
     stacks = ['DST', 'MID', 'PRX']
 
+    expected = []
     for id, measurements in data_dict.items():
 
         time = 0
         for image in measurements:
-            
+
             for idx in range(3):
-                measurement = image[idx]
                 stack = stacks[idx]
+                if only is not None and (id[0], time, stack) not in only:
+                    continue
+                relative = '{}/{}/{}_{}.nii.gz'.format(id[0], time, id[0], stack)
+                expected.append((id[0], time, stack, relative))
+            time += 1
 
-                location = r'/work/manske_lab/images/hrpqct/mcp/actus_raw_stacks/{}/{}/{}_{}.nii.gz'.format(id[0], time, id[0], stack)
+    stats = engine.stat(arc_host, ['{}/{}'.format(arc_root, e[3]) for e in expected])
+
+    records = []
+    for study_id, time, stack, relative in expected:
+        location = '{}/{}'.format(arc_root, relative)
+        size, mtime = stats.get(location, (None, None))
+
+        status = 'missing' if size is None else 'present'
+        if status == 'present' and compare_dir is not None:
+            local_file = os.path.join(compare_dir, relative)
+            if os.path.exists(local_file) and os.path.getsize(local_file) != size:
+                status = 'size_mismatch'
+
+        records.append({
+            'study_id': study_id,
+            'timepoint': time,
+            'stack': stack,
+            'path': location,
+            'status': status,
+            'size': size,
+            'mtime': mtime,
+        })
+
+    return records
 
-                with open(out_txt, 'a') as fp:
-                    fp.write('{}_{}: xxxssh -qnx arc "test -f {} && echo 1 || echo 0"\n'.format(id[0], stack, location))
-            time += 1
-    
 
 def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument("sftp_path", type=str, help="Text file (path + filename)")
     parser.add_argument("out_dir", type=str, help="Output")
+    parser.add_argument("--arc-host", type=str, default=ARC_HOST, help="Host address of arc (or local:<dir>)")
+    parser.add_argument("--arc-root", type=str, default=ARC_ROOT, help="Image directory on arc")
+    parser.add_argument("--compare-dir", type=str, default=None, help="Local directory to compare file sizes with")
+    parser.add_argument("--db", type=str, default=None, help="Job state database; only check unverified stacks")
+    add_arguments(parser)
     args = parser.parse_args()
 
     sftp_path = args.sftp_path
     out_dir = args.out_dir
 
-    temp_dir = os.path.join(out_dir, 'temp')
-    if os.path.exists(temp_dir):
-        shutil.rmtree(temp_dir)
-    os.mkdir(temp_dir)
+    with open(sftp_path, 'r') as file:
+        data_dict = parse_txt(file)
+
+    db = None
+    only = None
+    if args.db is not None:
+        db = JobDB(args.db)
+        jobs = expand_jobs(data_dict)
+        db.sync(jobs)
+        only = db.pending('verified', jobs)
+        print('Checking {} of {} stacks not verified yet'.format(len(only), len(jobs)))
+
+    with Instrumentation.from_args(args, tool='check_arc'), TransferEngine() as engine:
+        records = batch_check(data_dict, engine, args.arc_host, args.arc_root, args.compare_dir, only)
 
-    file = open(sftp_path, 'r')
-    lines = file.readlines()
+    if db is not None:
+        db.mark([(r['study_id'], r['timepoint'], r['stack']) for r in records if r['status'] == 'present'], 'verified')
 
-    out_txt = out_dir+'/arc_check_log.txt'
-    with open(out_txt, 'w') as fp:
-        pass
+    # Machine readable report
+    with open(os.path.join(out_dir, 'check_arc_report.json'), 'w') as fp:
+        json.dump(records, fp, indent=2)
 
-    data_dict = parse_txt(lines)
+    # Human readable log
+    with open(os.path.join(out_dir, 'log_arc.txt'), 'w') as fp:
+        for record in records:
+            status = {'present': 'Exists!', 'missing': 'Not Found', 'size_mismatch': 'Size Mismatch'}[record['status']]
+            fp.write('{}_{}: {}\n'.format(record['study_id'], record['stack'], status))
 
-    batch_check(data_dict, temp_dir, out_txt)
+    problems = [r for r in records if r['status'] != 'present']
+    print('Present: {}/{}'.format(len(records) - len(problems), len(records)))
+    for record in problems:
+        print('{}: {}'.format(record['status'].replace('_', ' ').capitalize(), record['path']))
 
 if __name__=='__main__':
 
-    main() 
\ No newline at end of file
+    main()
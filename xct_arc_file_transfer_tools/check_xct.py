@@ -1,71 +1,102 @@
+# -----------------------------------------------------
+# check_xct.py
+#
+# Description: Checks which ISQs listed in a pull request exist on xt2.
+#
+# Notes:
+# 1. Every sample directory is listed once (the listings are split over
+#    --sessions sftp sessions sharing one SSH connection) and every
+#    measurement is looked up in those listings.
+#
+# 2. Writes <out_dir>/check_xct_report.json (one record per stack with
+#    status 'present' or 'missing') and <out_dir>/log.txt.
+#
+# 3. xt2_host may be 'local:<dir>' to check a local copy of the xt2 file
+#    system instead (for testing).
+#
+# 4. With --db <jobs.db>, stacks that were already fetched (by get_xct.py or
+#    xct_pipeline.py with the same database) are not checked again (see
+#    util/manifest.py).
+# -----------------------------------------------------
+# USAGE:
+# 1. conda activate manskelab
+# 2. python check_xct.py <pull_request.txt> xt2 ./ [--db jobs.db]
+#
+# -----------------------------------------------------
+
 import os
+import json
 import argparse
-import shutil
 
-def parse_txt(data):
-    '''
-    parse_txt 
-        Parses through list of liens from txt file to arrage data into dictionary.
+from util.manifest import JobDB, parse_txt, expand_jobs
+from util.instrumentation import Instrumentation, add_arguments
+from util.transferEngine import TransferEngine
 
-    Input: 
-    data -> rows of data in following format:
-        ("Study_ID Sample_# DST1 MID1 PRX1 ... DSTN MIDN PRXN")
+XT2_DATA_ROOT = '/DISK6/xtremect2/data'
 
-    Output:
-    Dictionary of data with [Study_ID, Sample_#] as key.
+def batch_check(data_dict, engine, data_root=XT2_DATA_ROOT, only=None):
     '''
-    data_dict = {}
-
-    for study_data in data:
-        entry = study_data.split()
-        key = tuple([entry[0], entry[1]])
-        isqs = entry[2:]
-
-        measure_nums = []
-        if len(measure_nums)%3:
-            # print('Must have three measurement numbers for each image. (DST MID PRX).')
-            print('Skipped {}'.format(entry[0]))
-            continue
-
-        for idx in range(0, len(isqs), 3):
-            measure_nums.append(isqs[idx:idx+3])
-        
-        data_dict[key] = measure_nums
-    
-    return data_dict
-
-def batch_check(data_dict, out_dir, out_txt):
-    '''
-    sftp_fetch
-        uses sftp to download isqs in data_dict to out_dir
+    batch_check
+        Checks which isqs in data_dict exist on xt2. Each sample directory is
+        listed once, and every measurement is looked up in that listing.
 
     data_dict
         dictionary
-    out_dir
-        path to output directory
-    out_txt
-        path to txt file to log sftp commands
+    engine
+        TransferEngine used to list xt2
+    data_root
+        directory holding the sample directories on xt2
+    only
+        optional set of (Study_ID, timepoint, STACK) to check; other stacks
+        are skipped
+
+    Output:
+    List of records, one per stack, with the study id, sample, timepoint,
+    stack, measurement, status ('present' or 'missing') and the isq files found.
     '''
 
     stacks = ['DST', 'MID', 'PRX']
 
+    if only is not None:
+        data_dict = {
+            id: measurements for id, measurements in data_dict.items()
+            if any((id[0], time, stack) in only for time in range(len(measurements)) for stack in stacks)
+        }
+
+    patterns = {id: '{}/0000{}/*/*ISQ*'.format(data_root, id[1]) for id in data_dict}
+    listings = engine.list(xt2_host, patterns.values())
+
+    records = []
     for id, measurements in data_dict.items():
 
+        # measurement directory -> isq files in it
+        isq_files = {}
+        for path in listings[patterns[id]]:
+            parts = path.split('/')
+            isq_files.setdefault(parts[-2], []).append(path)
+
+        time = 0
         for image in measurements:
 
             for idx in range(3):
                 measurement = image[idx]
                 stack = stacks[idx]
+                if only is not None and (id[0], time, stack) not in only:
+                    continue
 
-                location = r'dir /DISK6/xtremect2/data/0000{}/000{}/*ISQ*'.format(id[1], measurement)
+                files = isq_files.get('000{}'.format(measurement), [])
+                records.append({
+                    'study_id': id[0],
+                    'sample': id[1],
+                    'timepoint': time,
+                    'stack': stack,
+                    'measurement': measurement,
+                    'status': 'present' if files else 'missing',
+                    'files': files,
+                })
+            time += 1
 
-                with open(out_txt, 'a') as fp:
-                    fp.write('{}_{}: echo \"{}\" | sftp -b - xt2\n'.format(id[0], stack, location))
-    
-
-def sftp_fetch(source, target, out_txt):
-    with open(out_txt, 'a') as fp:
-        fp.write('sftp {}:{} {}\n'.format(xt2_host, source, target))
+    return records
 
 
 def main():
@@ -74,31 +105,49 @@ def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument("sftp_path", type=str, help="Text file (path + filename)")
-    parser.add_argument("xt2_host", type=str, help="Host address of xt2 server")
+    parser.add_argument("xt2_host", type=str, help="Host address of xt2 server (or local:<dir>)")
     parser.add_argument("out_dir", type=str, help="Output")
+    parser.add_argument("--data-root", type=str, default=XT2_DATA_ROOT, help="Sample directories on xt2")
+    parser.add_argument("--sessions", type=int, default=2, help="Concurrent sftp sessions to xt2")
+    parser.add_argument("--db", type=str, default=None, help="Job state database; skip stacks already fetched")
+    add_arguments(parser)
     args = parser.parse_args()
 
     sftp_path = args.sftp_path
     xt2_host = args.xt2_host
     out_dir = args.out_dir
 
-    temp_dir = os.path.join(out_dir, 'temp')
-    if os.path.exists(temp_dir):
-        shutil.rmtree(temp_dir)
-    os.mkdir(temp_dir)
+    with open(sftp_path, 'r') as file:
+        data_dict = parse_txt(file)
+
+    only = None
+    if args.db is not None:
+        db = JobDB(args.db)
+        jobs = expand_jobs(data_dict)
+        db.sync(jobs)
+        only = db.pending('fetched', jobs)
+        print('Checking {} of {} stacks not fetched yet'.format(len(only), len(jobs)))
 
-    file = open(sftp_path, 'r')
-    lines = file.readlines()
+    with Instrumentation.from_args(args, tool='check_xct'), TransferEngine(sessions=args.sessions) as engine:
+        records = batch_check(data_dict, engine, args.data_root, only)
 
-    out_txt = out_dir+'/sftp_check_log.txt'
-    with open(out_txt, 'w') as fp:
-        pass
+    # Machine readable report
+    with open(os.path.join(out_dir, 'check_xct_report.json'), 'w') as fp:
+        json.dump(records, fp, indent=2)
 
-    data_dict = parse_txt(lines)
+    # Human readable log
+    with open(os.path.join(out_dir, 'log.txt'), 'w') as fp:
+        for record in records:
+            status = 'Exists!' if record['status'] == 'present' else 'Not Found'
+            fp.write('{}_{}: {}\n'.format(record['study_id'], record['stack'], status))
 
-    batch_check(data_dict, temp_dir, out_txt)
+    missing = [r for r in records if r['status'] == 'missing']
+    print('Present: {}/{}'.format(len(records) - len(missing), len(records)))
+    for record in missing:
+        print('Missing: {} {} timepoint {} {} (measurement {})'.format(
+            record['study_id'], record['sample'], record['timepoint'], record['stack'], record['measurement']))
 
 if __name__=='__main__':
     xt2_host = False
 
-    main() 
\ No newline at end of file
+    main()
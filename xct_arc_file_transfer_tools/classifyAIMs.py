@@ -0,0 +1,65 @@
+# -----------------------------------------------------
+# classifyAIMs.py
+#
+# Description: Sorts the AIMs below a directory into segmented and
+#              grayscale images from their processing logs, reading only
+#              the AIM headers (see util/searchAIMLog.py).
+#
+# -----------------------------------------------------
+# USAGE:
+# 1. conda activate manskelab
+# 2. python classifyAIMs.py <directory> [--threads 16] [--report aims.json] [--list-dir lists]
+#
+# -----------------------------------------------------
+
+import os
+import sys
+import json
+import argparse
+
+from util.searchAIMLog import SEGMENTED, GRAYSCALE, UNKNOWN, classify_tree
+
+
+def main():
+    # Parse input arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", type=str, help="Directory searched for AIMs (recursively)")
+    parser.add_argument(
+        "--threads", type=int, default=None, help="AIM headers read at once (default: number of CPUs)"
+    )
+    parser.add_argument(
+        "--report", type=str, default=None, help="JSON file to write every AIM's kind and log fields to"
+    )
+    parser.add_argument(
+        "--list-dir", type=str, default=None,
+        help="Directory to write segmented.txt, grayscale.txt and unknown.txt (one AIM per line) to"
+    )
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.directory):
+        print()
+        print(f"Error: {args.directory} is not a directory!")
+        sys.exit(1)
+
+    # The log fields are only needed for the report
+    results = classify_tree(args.directory, threads=args.threads, fields=args.report is not None)
+
+    if args.report is not None:
+        with open(args.report, "w") as fp:
+            json.dump([result._asdict() for result in results], fp, indent=2)
+
+    if args.list_dir is not None:
+        os.makedirs(args.list_dir, exist_ok=True)
+        for kind in (SEGMENTED, GRAYSCALE, UNKNOWN):
+            with open(os.path.join(args.list_dir, kind + ".txt"), "w") as fp:
+                fp.writelines(result.file + "\n" for result in results if result.kind == kind)
+
+    for kind in (SEGMENTED, GRAYSCALE, UNKNOWN):
+        print(f"{kind.capitalize() + ':':11s}{sum(result.kind == kind for result in results)}")
+    for result in results:
+        if result.error is not None:
+            print(f"FAILED: {result.file}: {result.error}")
+
+
+if __name__ == "__main__":
+    main()
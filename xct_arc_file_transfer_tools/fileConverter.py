@@ -42,31 +42,687 @@
 #    -https://fromosia.wordpress.com/2017/03/10/image-orientation-vtk-itk/
 #
 # 3. Be careful when converting to a DICOM series! This script can currently do this conversion, however,
-#    not all of the header information is copied over!
-# 4. Be careful when converting from TIFF! Writing to TIFF currently works, but slice thickness is lost
-#    when writing TIFF images. Thus, when you try to convert back (or use a TIFF image from somewhere else),
-#    the image may look stretched as the slice thickness will be assumed to be 1.0
+#    not all of the header information is copied over! The slices are written on --dicom-threads
+#    threads (default: all CPUs).
+# 4. TIFF outputs are rescaled to 0..32767 signed short and written slice by slice (see util/tiffIO.py),
+#    as one multi-page file or, with --tif-series, as <name>/<name>_<zzzz>.tif. --compress deflates
+#    them and --tif-tile stores them in tiles (ITK cannot read tiled TIFFs back, so they are refused as
+#    inputs; Fiji and most viewers can read them). The slice thickness is stored in the ImageDescription and restored when a TIFF written this
+#    way is converted back; TIFFs from elsewhere are still assumed to have a slice thickness of 1.0.
+#    With --stream, AIM/ISQ images are written to TIFF slab by slab as well.
+# 5. With --stream, uncompressed AIM/ISQ images written to MHA, MHD, NRRD or NIfTI are converted
+#    in z-slabs of --slab-size slices, so only one slab is held in memory. The native pixel type
+#    of the AIM/ISQ is kept. Compressed AIMs fall back to the regular ITK path.
+# 6. With --cache <dir>, outputs are stored in a content-addressed cache keyed on the input's
+#    content and the conversion options. Converting an unchanged input again with the same options
+#    copies (with --cache-link, hard-links) the cached output instead of converting. See
+#    util/conversionCache.py and cacheStats.py. DICOM series outputs are not cached.
+# 7. .nii.gz outputs (and MHA, MHD and NRRD outputs with --compress) are compressed on
+#    --compress-threads threads (default: all CPUs) as one standard gzip/zlib stream, see
+#    util/parallelCompress.py. --compression picks a preset: fast (level 1), default (6) or
+#    small (9). On a single CPU without a preset, SimpleITK's own (faster) compressor is used.
+# 8. --metrics-summary prints how long the read, cast, bridging (sitk_itk/itk_sitk), range and
+#    write stages took, with their throughput and peak memory; --metrics <file.jsonl> appends
+#    the same per-stage records as JSON lines. --profile and --trace-memory add a cProfile
+#    profile and Python allocation peaks. See util/instrumentation.py.
+# 9. Images keep the pixel type they are stored with (e.g. 16-bit CT stays signed short instead
+#    of becoming float). --pixel-type casts to another type (uint8, int16, float32, ...), and
+#    --pixel-type auto picks the smallest type that holds every value of the image without loss,
+#    from one min/max pass over the image. TIFF and ISQ outputs are always signed short, and
+#    DICOM outputs of float or 64-bit images are written as signed short.
+# 10. DICOM directories are indexed by reading every file's header on --read-threads threads; the
+#    index is kept next to the directory (.<directory>.dicom_index.json) and only files whose size
+#    or mtime changed are read again. The largest series is converted unless --series-uid picks
+#    another one; the series found are listed. Its slices are decoded on --read-threads threads
+#    into one volume. See util/dicomIndex.py.
+# 11. .zarr outputs are chunked (--zarr-chunks Z Y X, default 64 256 256), zlib-compressed (fast
+#    preset unless --compression is given) multiscale Zarr stores in the OME-NGFF layout. A pyramid
+#    of half-size levels (--zarr-levels) is averaged in the same pass, so a region or a coarse level
+#    can be read without the rest (util/zarrIO.read_zarr). .zarr inputs are read at full
+#    resolution. With --stream, AIM/ISQ images are written slab by slab.
+# 12. --qc writes previews for QC to <output>_qc/ next to the output: the three mid-slices, MIPs
+#    along each axis, a histogram (PNG) and stats.json (min, max, mean, std, percentiles and the
+#    histogram counts). They are built from the image already in memory, or slab by slab with
+#    --stream, so the output is not read again. See util/qcPreview.py.
+# 13. --roi X0 Y0 X1 Y1 (or X0 Y0 Z0 X1 Y1 Z1) converts only a region of interest, in voxel indices (upper
+#    bounds excluded) or, with --roi-mm, physical coordinates; --slices Z0 Z1 limits the slice range.
+#    Uncompressed AIM/ISQ, MHA/MHD, NRRD and NIfTI inputs are memory-mapped so only the rows inside the
+#    region are read (also with --stream); other inputs are read in full and cropped. The origin of the
+#    output is that of its first voxel, so it overlays the full image. See util/regionIO.py.
 # -----------------------------------------------------
 # USAGE:
 # 1. conda activate manskelab
 # 2. python fileConverter.py <inputImage.ext> <outputImage.ext>
+# 3. python fileConverter.py <inputImage.isq> <outputImage.nii.gz> --stream --slab-size 32
+# 4. python fileConverter.py <inputImage.isq> <outputImage.nii.gz> --cache <cacheDir> --cache-max-gb 500
+# 5. python fileConverter.py <inputImage.isq> <outputImage.nrrd> --compress --compression fast --compress-threads 8
+# 6. python fileConverter.py <inputImage.isq> <outputImage.nii.gz> --metrics-summary --metrics metrics.jsonl
+# 7. python fileConverter.py <dicomDirectory> <outputImage.nii.gz> --pixel-type auto
+# 8. python fileConverter.py <inputImage.isq> <outputImage.tif> --stream --tif-series --compress
+# 9. python fileConverter.py <dicomDirectory> <outputImage.nii.gz> --series-uid <SeriesInstanceUID> --read-threads 8
+# 10. python fileConverter.py <inputImage.isq> <outputImage.zarr> --stream --zarr-chunks 32 256 256
+# 11. python fileConverter.py <inputImage.isq> <outputImage.nii.gz> --stream --qc
+# 12. python fileConverter.py <inputImage.isq> <outputImage.nii.gz> --roi 200 150 1800 1650 --slices 0 168
 #
 # -----------------------------------------------------
 
 import os
 import sys
-import glob
 import argparse
 
+import numpy as np
+
+from util.lazyImport import lazy_import
 from util.sitk_itk import sitk_itk, itk_sitk
 from util.img2dicom import img2dicom
+from util.scancoIO import read_scanco_header, iter_scanco_slabs, read_scanco_sitk
+from util.streamWriters import SlabImageWriter, streamExtensions, split_extension, write_image
+from util.tiffIO import write_tiff, write_tiff_slices, tiff_slice_spacing, tiff_is_tiled
+from util.dicomIndex import index_dicom_directory, select_series, series_summary, read_dicom_series
+from util.zarrIO import ZarrWriter, DEFAULT_CHUNKS, write_zarr, read_zarr, zarr_levels
+from util.qcPreview import QCAccumulator, qc_directory, qc_files
+from util.regionIO import RegionOfInterest, roi_region, region_origin, raw_layout, iter_region_slabs, read_region
+from util.parallelCompress import compressionPresets, compression_level
+from util.conversionCache import ConversionCache
+from util.instrumentation import Instrumentation, stage, image_nbytes, path_nbytes, add_arguments
+
+# Only imported once a conversion actually needs them
+itk = lazy_import("itk")
+sitk = lazy_import("SimpleITK")
+pixelTypes = lazy_import("util.sitkDataTypes")
+
+# Pixel types GDCM can write
+dicomPixelTypes = ("uint8", "int8", "uint16", "int16", "uint32", "int32")
+
+
+def readScanco(inputImage, roi=None):
+    """
+    Read an AIM/ISQ image as a SimpleITK image.
+
+    Uncompressed files are memory-mapped and read without ITK, keeping
+    their pixel type; with a RegionOfInterest only the region is read.
+    Compressed AIMs are read with itk.ScancoImageIO as signed short (and
+    cropped afterwards).
+    """
+    header = read_scanco_header(inputImage)
+
+    if not header["compressed"] and roi is not None:
+        return readRegion(inputImage, raw_layout(inputImage), roi)
+
+    if not header["compressed"]:
+        with stage("read", file=inputImage, bytes_in=path_nbytes(inputImage)) as record:
+            image = read_scanco_sitk(inputImage, header)
+            record["bytes_out"] = image_nbytes(image)
+        return image
+
+    # Read in the AIM using ITK
+    # Only support short images for now
+    with stage("read", file=inputImage, bytes_in=path_nbytes(inputImage)) as record:
+        ImageType = itk.Image[itk.ctype("signed short"), 3]
+        reader = itk.ImageFileReader[ImageType].New()
+        imageio = itk.ScancoImageIO.New()
+        reader.SetImageIO(imageio)
+        reader.SetFileName(inputImage)
+        reader.Update()
+        record["bytes_out"] = image_nbytes(reader.GetOutput())
+
+    image = itk_sitk(reader.GetOutput())
+    return cropImage(image, roi) if roi is not None else image
+
+
+def inputRegion(roi, size, spacing, origin, direction=None):
+    """
+    roi_region() of an input image, exiting with an error if the region of
+    interest is malformed or outside the image.
+    """
+    try:
+        return roi_region(roi, size, spacing, origin, direction)
+    except ValueError as e:
+        print()
+        print(f"Error: {e}!")
+        sys.exit(1)
+
+
+def readRegion(inputImage, layout, roi):
+    """
+    Read the region of interest of an uncompressed image (a
+    util/regionIO.raw_layout()) as the 'read' stage, touching only the rows
+    inside it.
+    """
+    start, size = inputRegion(roi, layout["size"], layout["spacing"], layout["origin"], layout["direction"])
+    print(f"READING REGION: start {start}, size {size}")
+    with stage("read", file=inputImage, bytes_in=int(np.prod(size)) * layout["dtype"].itemsize) as record:
+        image = read_region(layout, start, size)
+        record["bytes_out"] = image_nbytes(image)
+    return image
+
+
+def cropImage(image, roi):
+    """
+    Crop an image read in full to a region of interest, as the 'crop' stage.
+    sitk.RegionOfInterest moves the origin to the first voxel kept.
+    """
+    start, size = inputRegion(roi, image.GetSize(), image.GetSpacing(), image.GetOrigin(), image.GetDirection())
+    print(f"CROPPING: start {start}, size {size}")
+    with stage("crop", bytes_in=image_nbytes(image)) as record:
+        image = sitk.RegionOfInterest(image, size, start)
+        record["bytes_out"] = image_nbytes(image)
+    return image
+
+
+def castImage(image, pixelType, slabSize=64):
+    """
+    Cast an image to a pixel type (see util/sitkDataTypes.cast_pixel_type)
+    as the 'cast' stage. pixelType None keeps the image's own type.
+    """
+    if pixelType is None:
+        return image
+
+    with stage("cast", pixel_type=pixelType, bytes_in=image_nbytes(image)) as record:
+        image = pixelTypes.cast_pixel_type(image, pixelType, slabSize)
+        record["bytes_out"] = image_nbytes(image)
+    return image
+
+
+def timedRead(inputImage, read, *args):
+    """
+    Run read(*args) as the 'read' stage of inputImage and return the image.
+    """
+    with stage("read", file=inputImage, bytes_in=path_nbytes(inputImage)) as record:
+        image = read(*args)
+        record["bytes_out"] = image_nbytes(image)
+    return image
+
+
+def scancoStreamConverter(
+    inputImage, outputImageFileName, slabSize=64, compress=False, level=None, threads=None, pixelType=None,
+    zarrChunks=None, zarrLevels=None, qc=False, roi=None,
+):
+    """
+    Convert an uncompressed AIM/ISQ image slab by slab.
+
+    Parameters
+    ----------
+    inputImage : str
+    outputImageFileName : str
+        Output image (.mha, .mhd, .nrrd, .nii, .nii.gz or .zarr).
+    slabSize : int
+        Number of slices read and written at a time.
+    compress : bool
+        Compress MHA, MHD and NRRD outputs (.nii.gz always is).
+    level : int, optional
+        Compression level (default 6).
+    threads : int, optional
+        Compression threads (default: number of CPUs).
+    pixelType : str, optional
+        Output pixel type (a dataTypeDict name, or 'auto' for the narrowest
+        lossless type, found with an extra min/max pass over the slabs).
+        The AIM/ISQ's own type if None.
+    zarrChunks : sequence of int, optional
+        Chunk shape (z, y, x) of .zarr outputs.
+    zarrLevels : int, optional
+        Pyramid levels of .zarr outputs (default: see util/zarrIO.py).
+    qc : bool
+        Write QC previews of the output from the same slabs (see qcWriter()).
+    roi : RegionOfInterest, optional
+        Only read and write this region (see util/regionIO.py).
+
+    Returns
+    -------
+    converted : bool
+        False if the input cannot be streamed (compressed AIM).
+    """
+    header = read_scanco_header(inputImage)
+    if header["compressed"]:
+        return False
+
+    size, origin, slabs, bytesIn = scancoRegion(inputImage, header, roi, slabSize)
+
+    dtype = header["dtype"]
+    if pixelType == "auto":
+        with stage("range", file=inputImage, bytes_in=bytesIn):
+            valueRange = pixelTypes.slabs_value_range(slab for z, slab in slabs())
+        dtype = np.dtype(pixelTypes.narrowest_pixel_type(*valueRange))
+    elif pixelType is not None:
+        dtype = np.dtype(pixelType)
+
+    if split_extension(outputImageFileName)[1] == ".zarr":
+        writer = ZarrWriter(
+            outputImageFileName,
+            size,
+            header["spacing"],
+            origin,
+            dtype=dtype,
+            chunks=zarrChunks or DEFAULT_CHUNKS,
+            levels=zarrLevels,
+            level=compression_level("fast", level),
+            threads=threads,
+        )
+    else:
+        writer = SlabImageWriter(
+            outputImageFileName,
+            size,
+            header["spacing"],
+            origin,
+            dtype=dtype,
+            compress=compress,
+            level=compression_level(level=level),
+            threads=threads,
+        )
+
+    accumulator = QCAccumulator(size, header["spacing"], dtype) if qc else None
+
+    with stage("stream", file=inputImage, bytes_in=bytesIn) as record:
+        with writer:
+            for z, slab in slabs():
+                slab = slab.astype(dtype, copy=False)
+                with stage("write", file=outputImageFileName, slab=z, bytes_in=slab.nbytes):
+                    writer.write_slab(slab)
+                if accumulator is not None:
+                    accumulator.add_slab(slab)
+
+        outputFiles = outputFileNames(outputImageFileName, compress) or [outputImageFileName]
+        record["bytes_out"] = sum(path_nbytes(f) for f in outputFiles)
+
+    if accumulator is not None:
+        writeQC(accumulator, outputImageFileName)
+
+    return True
+
+
+def scancoTiffConverter(
+    inputImage, outputImageFileName, slabSize=64, series=False, compress=False, level=None, tile=None, threads=None,
+    qc=False, roi=None,
+):
+    """
+    Convert an uncompressed AIM/ISQ image (or a region of it) to TIFF slab
+    by slab: one pass for the value range (and the QC previews with qc), one
+    to rescale and write (see util/tiffIO.py).
+
+    Returns
+    -------
+    converted : bool
+        False if the input cannot be streamed (compressed AIM).
+    """
+    header = read_scanco_header(inputImage)
+    if header["compressed"]:
+        return False
+
+    size, origin, slabs, bytesIn = scancoRegion(inputImage, header, roi, slabSize)
+
+    accumulator = QCAccumulator(size, header["spacing"], header["dtype"]) if qc else None
+
+    with stage("range", file=inputImage, bytes_in=bytesIn):
+        minimum, maximum = np.inf, -np.inf
+        for z, slab in slabs():
+            minimum = min(minimum, float(slab.min()))
+            maximum = max(maximum, float(slab.max()))
+            if accumulator is not None:
+                accumulator.add_slab(slab)
+
+    def slices():
+        for z, slab in slabs():
+            for array in slab:
+                yield array
+
+    with stage("stream", file=inputImage, bytes_in=bytesIn) as record:
+        files = write_tiff_slices(
+            slices(),
+            outputImageFileName,
+            size,
+            header["spacing"],
+            minimum,
+            maximum,
+            series=series,
+            compress=compress,
+            level=compression_level(level=level),
+            tile=tile,
+            threads=threads,
+        )
+        record["bytes_out"] = sum(path_nbytes(f) for f in files)
+
+    if accumulator is not None:
+        writeQC(accumulator, outputImageFileName)
+
+    return True
+
+
+def scancoRegion(inputImage, header, roi, slabSize):
+    """
+    Size, origin, slab iterator and number of bytes read of an uncompressed
+    AIM/ISQ image, or of its region of interest.
+    """
+    if roi is None:
+        return (
+            header["dimensions"],
+            header["origin"],
+            lambda: iter_scanco_slabs(inputImage, header, slabSize),
+            path_nbytes(inputImage),
+        )
+
+    layout = raw_layout(inputImage)
+    start, size = inputRegion(roi, layout["size"], layout["spacing"], layout["origin"])
+    print(f"READING REGION: start {start}, size {size}")
+    return (
+        size,
+        region_origin(layout["origin"], layout["spacing"], start),
+        lambda: iter_region_slabs(layout, start, size, slabSize),
+        int(np.prod(size)) * layout["dtype"].itemsize,
+    )
+
+
+def tiffWriter(image, outputImageFileName, series=False, compress=False, level=None, tile=None, threads=None):
+    """
+    Rescale an image to signed short and write it as TIFF, slice by slice
+    (see util/tiffIO.py).
+    """
+    with stage("write", file=outputImageFileName, bytes_in=image_nbytes(image)) as record:
+        files = write_tiff(
+            image,
+            outputImageFileName,
+            series=series,
+            compress=compress,
+            level=compression_level(level=level),
+            tile=tile,
+            threads=threads,
+        )
+        record["bytes_out"] = sum(path_nbytes(f) for f in files)
+
+
+def writeQC(accumulator, outputImageFileName):
+    """
+    Write the previews a QCAccumulator collected while streaming next to
+    the output, as the 'qc' stage.
+    """
+    directory = qc_directory(outputImageFileName)
+    print("WRITING QC: " + directory)
+    with stage("qc", file=directory) as record:
+        accumulator.write(directory)
+        record["bytes_out"] = path_nbytes(directory)
+
+
+def qcWriter(image, outputImageFileName, slabSize=64):
+    """
+    QC previews of an image in memory: mid-slices, MIPs, histogram and
+    statistics (see util/qcPreview.py), written to <name>_qc/ next to the
+    output.
+    """
+    directory = qc_directory(outputImageFileName)
+    print("WRITING QC: " + directory)
+    with stage("qc", file=directory, bytes_in=image_nbytes(image)) as record:
+        accumulator = QCAccumulator(image.GetSize(), image.GetSpacing(), sitk.GetArrayViewFromImage(image).dtype)
+        accumulator.add_image(image, slabSize)
+        accumulator.write(directory)
+        record["bytes_out"] = path_nbytes(directory)
+
+
+def zarrWriter(image, outputImageFileName, chunks=None, levels=None, level=None, threads=None, slabSize=64):
+    """
+    Write an image as a chunked multiscale Zarr store (see util/zarrIO.py),
+    with the fast compression preset unless a level is given.
+    """
+    with stage("write", file=outputImageFileName, bytes_in=image_nbytes(image)) as record:
+        write_zarr(
+            image,
+            outputImageFileName,
+            slabSize,
+            chunks=chunks or DEFAULT_CHUNKS,
+            levels=levels,
+            level=compression_level("fast", level),
+            threads=threads,
+        )
+        record["bytes_out"] = path_nbytes(outputImageFileName)
+
+
+def checkTiffTiles(tiffFile):
+    """
+    Exit with an error for tiled TIFFs (e.g. written with --tif-tile), which
+    ITK would read as garbled RGBA instead of failing.
+    """
+    if tiff_is_tiled(tiffFile):
+        print()
+        print(f"Error: {tiffFile} is a tiled TIFF, which ITK cannot read (write it without --tif-tile)!")
+        sys.exit(1)
+
+
+def restoreTiffSpacing(image, tiffFile):
+    """
+    Set the slice thickness of an image read from a TIFF written by
+    tiffWriter() (stored in its ImageDescription).
+    """
+    sliceSpacing = tiff_slice_spacing(tiffFile)
+    if sliceSpacing is not None and image.GetDimension() == 3:
+        spacing = list(image.GetSpacing())
+        spacing[2] = sliceSpacing
+        image.SetSpacing(spacing)
+    return image
+
+
+def compressedWriter(image, outputImageFileName, compress=False, level=None, threads=None):
+    """
+    Write an MHA, MHD, NRRD or NIfTI image, compressing it on several
+    threads where that is faster than SimpleITK.
+
+    Parameters
+    ----------
+    image : SimpleITK.Image
+    outputImageFileName : str
+    compress : bool
+        Compress MHA, MHD and NRRD outputs (.nii.gz always is).
+    level : int, optional
+        Compression level. SimpleITK's default if None.
+    threads : int, optional
+        Compression threads (default: number of CPUs).
+    """
+    with stage("write", file=outputImageFileName, bytes_in=image_nbytes(image)) as record:
+        _compressedWriter(image, outputImageFileName, compress, level, threads)
+        record["bytes_out"] = sum(path_nbytes(f) for f in outputFileNames(outputImageFileName, compress))
+
+
+def _compressedWriter(image, outputImageFileName, compress, level, threads):
+    compressed = compress or outputImageFileName.lower().endswith(".gz")
+    threads = threads or os.cpu_count() or 1
+
+    # ITK compresses on one thread, but faster per thread than zlib does.
+    # Only worth it with several threads, or to honour an explicit level.
+    if compressed and (threads > 1 or level is not None):
+        if write_image(
+            image,
+            outputImageFileName,
+            compress=compress,
+            level=compression_level(level=level),
+            threads=threads,
+        ):
+            return
+
+    if level is None:
+        sitk.WriteImage(image, str(outputImageFileName), compressed)
+    else:
+        sitk.WriteImage(image, str(outputImageFileName), compressed, level)
+
+
+def outputFileNames(outputImage, compress=False, tifSeries=False):
+    """
+    Files fileConverter() writes for an output image, or None for outputs
+    that are not plain files (DICOM and TIFF series, Zarr stores).
+    """
+    outBasename, outExtension = split_extension(outputImage)
+
+    if outExtension == ".tif" and tifSeries:
+        return None
+    elif outExtension in (".mhd", ".raw"):
+        return [outBasename + ".mhd", outBasename + (".zraw" if compress else ".raw")]
+    elif outExtension == ".isq":
+        return [outBasename + ".ISQ"]
+    elif outExtension in (".dcm", ".zarr"):
+        return None
+    return [outBasename + outExtension]
+
+
+def cachedConverter(inputImage, outputImage, cache, **options):
+    """
+    Run fileConverter() through a ConversionCache.
+
+    Parameters
+    ----------
+    inputImage, outputImage : str
+    cache : ConversionCache or str
+        Cache (or cache directory) to use.
+    **options
+        Conversion options passed to fileConverter(). They are part of the
+        cache key.
+    """
+    if not isinstance(cache, ConversionCache):
+        cache = ConversionCache(cache)
+
+    outputFiles = outputFileNames(outputImage, options.get("compress", False), options.get("tifSeries", False))
+    if outputFiles is None:
+        fileConverter(inputImage, outputImage, **options)
+        return
+
+    # The QC previews are cached with the output
+    if options.get("qc"):
+        outputFiles = outputFiles + qc_files(outputImage)
+        os.makedirs(qc_directory(outputImage), exist_ok=True)
+
+    outBasename, outExtension = split_extension(outputImage)
+    # The slab size and number of compression/read/DICOM threads do not change the output
+    threadOptions = ("slabSize", "compressThreads", "readThreads", "dicomThreads")
+    params = {
+        "extension": outExtension,
+        "options": {k: v for k, v in options.items() if k not in threadOptions},
+    }
+    if outExtension in (".mhd", ".raw"):
+        # The .mhd header refers to its .raw file by name
+        params["basename"] = os.path.basename(outBasename)
+
+    key = cache.key(inputImage, params)
+    if cache.fetch(key, outputFiles):
+        print("******************************************************")
+        print(f"CACHED: {inputImage} to {outputImage}")
+        print("******************************************************")
+        print()
+        return
 
-import itk
+    fileConverter(inputImage, outputImage, **options)
+    cache.store(key, outputFiles)
 
-import SimpleITK as sitk
 
+def fileConverter(
+    inputImage,
+    outputImage,
+    stream=False,
+    slabSize=64,
+    dicomMultiframe=False,
+    cache=None,
+    compress=False,
+    compression=None,
+    compressionLevel=None,
+    compressThreads=None,
+    pixelType=None,
+    tifSeries=False,
+    tifTile=None,
+    seriesUID=None,
+    readThreads=None,
+    zarrChunks=None,
+    zarrLevels=None,
+    qc=False,
+    roi=None,
+    roiPhysical=False,
+    slices=None,
+    dicomThreads=None,
+):
+    if cache is not None:
+        cachedConverter(
+            inputImage,
+            outputImage,
+            cache,
+            stream=stream,
+            slabSize=slabSize,
+            dicomMultiframe=dicomMultiframe,
+            compress=compress,
+            compression=compression,
+            compressionLevel=compressionLevel,
+            compressThreads=compressThreads,
+            pixelType=pixelType,
+            tifSeries=tifSeries,
+            tifTile=tifTile,
+            seriesUID=seriesUID,
+            readThreads=readThreads,
+            zarrChunks=zarrChunks,
+            zarrLevels=zarrLevels,
+            qc=qc,
+            roi=roi,
+            roiPhysical=roiPhysical,
+            slices=slices,
+            dicomThreads=dicomThreads,
+        )
+        return
+
+    with stage("convert", input=inputImage, output=outputImage, bytes_in=path_nbytes(inputImage)):
+        _fileConverter(
+            inputImage,
+            outputImage,
+            stream,
+            slabSize,
+            dicomMultiframe,
+            compress,
+            compression,
+            compressionLevel,
+            compressThreads,
+            pixelType,
+            tifSeries,
+            tifTile,
+            seriesUID,
+            readThreads,
+            zarrChunks,
+            zarrLevels,
+            qc,
+            roi,
+            roiPhysical,
+            slices,
+            dicomThreads,
+        )
+
+
+def _fileConverter(
+    inputImage,
+    outputImage,
+    stream,
+    slabSize,
+    dicomMultiframe,
+    compress,
+    compression,
+    compressionLevel,
+    compressThreads,
+    pixelType,
+    tifSeries,
+    tifTile,
+    seriesUID,
+    readThreads,
+    zarrChunks,
+    zarrLevels,
+    qc,
+    roi,
+    roiPhysical,
+    slices,
+    dicomThreads,
+):
+    if pixelType is not None and pixelType != "auto" and pixelType not in pixelTypes.dataTypeDict:
+        print()
+        print(f"Error: unknown pixel type {pixelType}!")
+        sys.exit(1)
+
+    # Only this part of the input is read (see util/regionIO.py)
+    region = None
+    if roi is not None or slices is not None:
+        region = RegionOfInterest(roi, slices, roiPhysical)
+
+    # None keeps the writer's default level
+    level = None
+    if compression is not None or compressionLevel is not None:
+        level = compression_level(compression, compressionLevel)
 
-def fileConverter(inputImage, outputImage):
     print("******************************************************")
     print(f"CONVERTING: {inputImage} to {outputImage}")
 
@@ -99,11 +755,23 @@ def fileConverter(inputImage, outputImage):
         outputImageFileName = os.path.join(outDirectory, outBasename + ".tif")
     elif outExtension.lower() == ".isq":
         outputImageFileName = os.path.join(outDirectory, outBasename + ".ISQ")
+    elif outExtension.lower() == ".zarr":
+        outputImageFileName = os.path.join(outDirectory, outBasename + ".zarr")
     else:
         print()
-        print("Error: output file extension must be MHD, MHA, RAW, NRRD, TIFF or NII.")
+        print("Error: output file extension must be MHD, MHA, RAW, NRRD, TIFF, NII or ZARR.")
         sys.exit(1)
 
+    # The writers open their files in place: remove old outputs first so a
+    # conversion never writes through a hard link (e.g. into the cache)
+    oldOutputs = outputFileNames(outputImageFileName, compress, tifSeries) or []
+    if qc:
+        oldOutputs += qc_files(outputImageFileName)
+    for oldOutput in oldOutputs:
+        if os.path.lexists(oldOutput) and not os.path.isdir(oldOutput) \
+                and os.path.abspath(oldOutput) != os.path.abspath(inputImage):
+            os.remove(oldOutput)
+
     # Check if the input is a DICOM series directory
     if os.path.isdir(inputImage):
         # Check if the directory exists
@@ -111,32 +779,53 @@ def fileConverter(inputImage, outputImage):
             print()
             print("Error: DICOM directory does not exist!")
             sys.exit(1)
-        elif len(glob.glob(os.path.join(inputImage, "*.tif"))) > 0:
-            # TIF series
-            reader = sitk.ImageSeriesReader()
-            reader.SetFileNames(glob.glob(os.path.join(inputImage, "*.tif")))
-            reader.SetOutputPixelType(sitk.sitkInt16)
-            outputImage = reader.Execute()
-        elif len(glob.glob(os.path.join(inputImage, "*.tiff"))) > 0:
-            # TIF series
+
+        # One listing decides between a TIF and a DICOM series
+        isZarr = inputImage.rstrip(os.sep).lower().endswith(".zarr")
+        names = [] if isZarr else sorted(os.listdir(inputImage))
+        tiffNames = [os.path.join(inputImage, n) for n in names if n.lower().endswith(".tif")] or \
+            [os.path.join(inputImage, n) for n in names if n.lower().endswith(".tiff")]
+
+        if isZarr:
+            # Zarr store written by fileConverter, at full resolution; only
+            # the chunks of a region of interest are read
+            if region is not None:
+                info = zarr_levels(inputImage)[0]
+                start, size = inputRegion(region, info["size"], info["spacing"], info["origin"], info["direction"])
+                outputImage = timedRead(inputImage, read_zarr, inputImage, 0, start, size)
+            else:
+                outputImage = timedRead(inputImage, read_zarr, inputImage)
+        elif tiffNames:
+            # TIF series, in slice order (only the slices of a region of
+            # interest are read)
+            checkTiffTiles(tiffNames[0])
             reader = sitk.ImageSeriesReader()
-            reader.SetFileNames(glob.glob(os.path.join(inputImage, "*.tiff")))
-            reader.SetOutputPixelType(sitk.sitkInt16)
-            outputImage = reader.Execute()
+            reader.SetFileNames(tiffNames)
+            outputImage = restoreTiffSpacing(timedRead(inputImage, reader.Execute), tiffNames[0])
+            if region is not None:
+                outputImage = cropImage(outputImage, region)
         else:
-            # DICOM series
-            reader = sitk.ImageSeriesReader()
+            # DICOM series, in the pixel type GDCM reads it as (after applying
+            # the rescale slope and intercept)
+            with stage("index", file=inputImage) as record:
+                series, indexStats = index_dicom_directory(inputImage, readThreads)
+                record.update(indexStats)
 
-            # Convert to 16-bit Int to ensure compatibility with ITK-Python functions
-            # Needed for writing TIFF images
-            if outExtension.lower() == ".tif":
-                reader.SetOutputPixelType(sitk.sitkInt16)
+            try:
+                dicomSeries = select_series(series, seriesUID)
+            except ValueError as e:
+                print()
+                print(f"Error: {e}!")
+                sys.exit(1)
 
-            dicom_names = reader.GetGDCMSeriesFileNames(inputImage)
-            reader.SetFileNames(dicom_names)
-            reader.SetOutputPixelType(sitk.sitkFloat32)
+            if len(series) > 1:
+                print(f"{len(series)} DICOM series found, reading {dicomSeries.uid} (select one with --series-uid):")
+                for line in series_summary(series):
+                    print("    " + line)
 
-            outputImage = reader.Execute()
+            outputImage = timedRead(inputImage, read_dicom_series, dicomSeries, readThreads)
+            if region is not None:
+                outputImage = cropImage(outputImage, region)
     else:
         # Extract directory, filename, basename, and extensions from the input
         # image
@@ -149,6 +838,34 @@ def fileConverter(inputImage, outputImage):
         inBasename = inFilename[:ext_idx]
         inExtension = inFilename[ext_idx:]
 
+        # Scanco images can be streamed straight to the output
+        if stream and (".aim" in inExtension.lower() or ".isq" in inExtension.lower()) \
+                and (outExtension.lower() in streamExtensions + (".tif", ".zarr")):
+            if ";" in inExtension.lower():
+                inputImageNew = inputImage.rsplit(";", 1)[0]
+                os.rename(inputImage, inputImageNew)
+                inputImage = inputImageNew
+
+            print("STREAMING IMAGE: " + str(outputImageFileName))
+            if outExtension.lower() == ".tif":
+                # TIFFs are always rescaled to signed short, pixelType does not apply
+                streamed = scancoTiffConverter(
+                    inputImage, outputImageFileName, slabSize, tifSeries, compress, level, tifTile, compressThreads,
+                    qc, region,
+                )
+            else:
+                streamed = scancoStreamConverter(
+                    inputImage, outputImageFileName, slabSize, compress, level, compressThreads, pixelType,
+                    zarrChunks, zarrLevels, qc, region,
+                )
+            if streamed:
+                print("DONE")
+                print("******************************************************")
+                print()
+                return
+
+            print("Compressed AIM cannot be streamed, reading the whole image instead.")
+
         # AIM image file
         if ".aim" in inExtension.lower():
             # If the input AIM contains a version number, remove it and rename
@@ -158,16 +875,7 @@ def fileConverter(inputImage, outputImage):
                 os.rename(inputImage, inputImageNew)
                 inputImage = inputImageNew
 
-            # Read in the AIM using ITK
-            # Only support short images for now
-            ImageType = itk.Image[itk.ctype("signed short"), 3]
-            reader = itk.ImageFileReader[ImageType].New()
-            imageio = itk.ScancoImageIO.New()
-            reader.SetImageIO(imageio)
-            reader.SetFileName(inputImage)
-            reader.Update()
-
-            outputImage = itk_sitk(reader.GetOutput())
+            outputImage = readScanco(inputImage, region)
 
         # ISQ image file
         elif ".isq" in inExtension.lower():
@@ -178,111 +886,108 @@ def fileConverter(inputImage, outputImage):
                 os.rename(inputImage, inputImageNew)
                 inputImage = inputImageNew
 
-            # Read in the ISQ using ITK
-            ImageType = itk.Image[itk.ctype("signed short"), 3]
-            reader = itk.ImageFileReader[ImageType].New()
-            imageio = itk.ScancoImageIO.New()
-            reader.SetImageIO(imageio)
-            reader.SetFileName(inputImage)
-            reader.Update()
-
-            outputImage = itk_sitk(reader.GetOutput())
+            outputImage = readScanco(inputImage, region)
 
         # Other image file (e.g., MHA, NII, NRRD)
         elif os.path.isfile(inputImage) and (
             ".nii" or ".nii.gz" or ".mha" or ".mhd" or ".raw" or ".nrrd" in inExtension.lower()
         ):
-            # Convert to 16-bit Int to ensure compatibility with ITK-Python
-            # functions for writing TIFFs
-            if outExtension.lower() == ".tif":
-                outputImage = sitk.ReadImage(inputImage, sitk.sitkInt16)
+            # Uncompressed MHA/MHD, NRRD and NIfTI files are memory-mapped
+            # to read only a region of interest
+            layout = raw_layout(inputImage) if region is not None else None
+            if layout is not None:
+                outputImage = readRegion(inputImage, layout, region)
             else:
-                # Use unkown pixel type (may cause errors if the pixel type is
-                # not supported by ITK-Python)
-                outputImage = sitk.ReadImage(inputImage, sitk.sitkInt16)
+                if inExtension.lower() in (".tif", ".tiff"):
+                    checkTiffTiles(inputImage)
+                outputImage = timedRead(inputImage, sitk.ReadImage, inputImage)
+                if inExtension.lower() in (".tif", ".tiff"):
+                    outputImage = restoreTiffSpacing(outputImage, inputImage)
+                if region is not None:
+                    outputImage = cropImage(outputImage, region)
 
         else:
             print()
             print("Error: Input image is an incorrect type!")
             sys.exit(1)
 
+    outputImage = castImage(outputImage, pixelType, slabSize)
+
+    if qc:
+        qcWriter(outputImage, outputImageFileName, slabSize)
+
     # Setup the correct writer based on the output image extension
     if outExtension.lower() == ".mha":
         print("WRITING IMAGE: " + str(outputImageFileName))
-        sitk.WriteImage(outputImage, str(outputImageFileName))
+        compressedWriter(outputImage, outputImageFileName, compress, level, compressThreads)
 
     elif outExtension.lower() == ".mhd" or outExtension.lower() == ".raw":
         print("WRITING IMAGE: " + str(outputImageFileName))
-        sitk.WriteImage(outputImage, str(outputImageFileName))
+        compressedWriter(outputImage, outputImageFileName, compress, level, compressThreads)
 
     elif outExtension.lower() == ".nii" or outExtension.lower() == ".nii.gz":
         print("WRITING IMAGE: " + str(outputImageFileName))
-        sitk.WriteImage(outputImage, str(outputImageFileName))
+        compressedWriter(outputImage, outputImageFileName, compress, level, compressThreads)
 
     elif outExtension.lower() == ".nrrd":
         print("WRITING IMAGE: " + str(outputImageFileName))
-        sitk.WriteImage(outputImage, str(outputImageFileName))
+        compressedWriter(outputImage, outputImageFileName, compress, level, compressThreads)
 
     elif outExtension.lower() == ".tif":
-        # SimpleITK TIFFImageIO is a bit buggy (sometimes writes out binary images...)
-        # Use ITK instead. Need to force the use of a supported ITK-Python
-        # pixel type. Signed short is used as default
-        imageType = itk.Image[itk.SS, 3]
-
-        # Need to convert to ITK image
-        # Should be read in as signed short by default so we shouldn't need to
-        # cast
-        image = sitk_itk(outputImage)
-
-        # Image values need to rescaled
-        rescaler = itk.RescaleIntensityImageFilter[imageType, imageType].New()
-        rescaler.SetInput(image)
-        rescaler.SetOutputMinimum(0)
-        pixelTypeMaximum = itk.NumericTraits[itk.SS].max()
-        rescaler.SetOutputMaximum(pixelTypeMaximum)
+        # Rescaled to 0..32767 signed short slice by slice while writing
+        # (see util/tiffIO.py)
+        print("WRITING IMAGE: " + str(outputImageFileName))
+        tiffWriter(outputImage, outputImageFileName, tifSeries, compress, level, tifTile, compressThreads)
 
+    elif outExtension.lower() == ".zarr":
         print("WRITING IMAGE: " + str(outputImageFileName))
-        writer = itk.ImageFileWriter[imageType].New()
-        writer.SetFileName(str(outputImageFileName))
-        writer.SetInput(rescaler.GetOutput())
-        writer.Update()
+        zarrWriter(outputImage, outputImageFileName, zarrChunks, zarrLevels, level, compressThreads, slabSize)
 
     elif outExtension.lower() == ".dcm":
+        # GDCM cannot write float or 64-bit pixels
+        if pixelTypes.pixel_type_name(outputImage) not in dicomPixelTypes:
+            outputImage = castImage(outputImage, "int16")
+
         print("WRITING IMAGE: " + str(outputImageFileName))
-        img2dicom(outputImage, outDirectory)
+        with stage("write", file=outputImageFileName, bytes_in=image_nbytes(outputImage)) as record:
+            img2dicom(outputImage, outDirectory, max_workers=dicomThreads, multiframe=dicomMultiframe)
+            record["bytes_out"] = path_nbytes(os.path.join(outDirectory, "dcm"))
 
     elif outExtension.lower() == ".isq":
-        outputImageISQ = sitk_itk(outputImage)
+        # ISQs only store signed short
+        outputImageISQ = sitk_itk(castImage(outputImage, "int16"))
         print("WRITING IMAGE: " + str(outputImageFileName))
 
-        ImageType = itk.Image[itk.ctype("signed short"), 3]
-        writer = itk.ImageFileWriter[ImageType].New()
-        imageio = itk.ScancoImageIO.New()
-        writer.SetImageIO(imageio)
-        writer.SetInput(outputImageISQ)
-        writer.SetFileName(outputImageFileName)
-        writer.Update()
-
-        # Set header information
-        imageio.SetEnergy(68)
-        imageio.SetIntensity(1.47)
-        imageio.SetReconstructionAlg(3)
-        imageio.SetSite(4)
-        imageio.SetScannerID(3401)
-        imageio.SetPatientIndex(2567)
-        imageio.SetMeasurementIndex(12778)
-        imageio.SetSampleTime(100)
-        imageio.SetScannerType(9)
-        imageio.SetMuScaling(8192)
-        imageio.SetNumberOfProjections(900)
-        imageio.SetSliceIncrement(0.0609)
-        imageio.SetSliceThickness(0.0609)
-        # imageio.SetScanDistance(139852)
-        # imageio.SetReferenceLine(109737)
-        # imageio.SetNumberOfSamples(2304)
-        # imageio.SetStartPosition()
-
-        writer.Write()
+        with stage("write", file=outputImageFileName, bytes_in=image_nbytes(outputImageISQ)) as record:
+            ImageType = itk.Image[itk.ctype("signed short"), 3]
+            writer = itk.ImageFileWriter[ImageType].New()
+            imageio = itk.ScancoImageIO.New()
+            writer.SetImageIO(imageio)
+            writer.SetInput(outputImageISQ)
+            writer.SetFileName(outputImageFileName)
+            writer.Update()
+
+            # Set header information
+            imageio.SetEnergy(68)
+            imageio.SetIntensity(1.47)
+            imageio.SetReconstructionAlg(3)
+            imageio.SetSite(4)
+            imageio.SetScannerID(3401)
+            imageio.SetPatientIndex(2567)
+            imageio.SetMeasurementIndex(12778)
+            imageio.SetSampleTime(100)
+            imageio.SetScannerType(9)
+            imageio.SetMuScaling(8192)
+            imageio.SetNumberOfProjections(900)
+            imageio.SetSliceIncrement(0.0609)
+            imageio.SetSliceThickness(0.0609)
+            # imageio.SetScanDistance(139852)
+            # imageio.SetReferenceLine(109737)
+            # imageio.SetNumberOfSamples(2304)
+            # imageio.SetStartPosition()
+
+            writer.Write()
+            record["bytes_out"] = path_nbytes(outputImageFileName)
 
     print("DONE")
     print("******************************************************")
@@ -298,9 +1003,114 @@ if __name__ == "__main__":
     parser.add_argument(
         "outputImage", type=str, help="The output image (path + filename)"
     )
+    parser.add_argument(
+        "--stream", action="store_true", help="Convert AIM/ISQ images slab by slab"
+    )
+    parser.add_argument(
+        "--slab-size", type=int, default=64, help="Number of slices per slab when streaming"
+    )
+    parser.add_argument(
+        "--dicom-multiframe", action="store_true", help="Write a single multi-frame DICOM file"
+    )
+    parser.add_argument(
+        "--cache", type=str, default=None, help="Conversion cache directory"
+    )
+    parser.add_argument(
+        "--cache-max-gb", type=float, default=None, help="Size limit of the conversion cache (GB)"
+    )
+    parser.add_argument(
+        "--cache-link", action="store_true",
+        help="Hard-link cached outputs instead of copying them (do not modify them in place!)"
+    )
+    parser.add_argument(
+        "--compress", action="store_true", help="Compress MHA, MHD, NRRD and TIFF outputs"
+    )
+    parser.add_argument(
+        "--compression", type=str, default=None, choices=list(compressionPresets),
+        help="Compression preset (fast, default or small)"
+    )
+    parser.add_argument(
+        "--compress-level", type=int, default=None, help="zlib compression level (0-9), overrides --compression"
+    )
+    parser.add_argument(
+        "--compress-threads", type=int, default=None, help="Compression threads (default: number of CPUs)"
+    )
+    parser.add_argument(
+        "--pixel-type", type=str, default=None,
+        help="Output pixel type (uint8, int16, float32, ...) or auto for the smallest lossless type "
+        "(default: keep the input's type)"
+    )
+    parser.add_argument(
+        "--tif-series", action="store_true", help="Write TIFF outputs as one file per slice"
+    )
+    parser.add_argument(
+        "--tif-tile", type=int, default=None, help="Write TIFF outputs in tiles of this size (multiple of 16)"
+    )
+    parser.add_argument(
+        "--series-uid", type=str, default=None,
+        help="Series instance UID to read from a DICOM directory (default: the largest series)"
+    )
+    parser.add_argument(
+        "--read-threads", type=int, default=None, help="Threads reading DICOM headers and slices (default: all CPUs)"
+    )
+    parser.add_argument(
+        "--dicom-threads", type=int, default=None, help="Threads writing DICOM slices (default: number of CPUs)"
+    )
+    parser.add_argument(
+        "--zarr-chunks", type=int, nargs=3, default=None, metavar=("Z", "Y", "X"),
+        help="Chunk shape of Zarr outputs (default: 64 256 256)"
+    )
+    parser.add_argument(
+        "--zarr-levels", type=int, default=None, help="Pyramid levels of Zarr outputs (default: until one chunk)"
+    )
+    parser.add_argument(
+        "--qc", action="store_true",
+        help="Write mid-slice and MIP previews, a histogram and statistics to <output>_qc/"
+    )
+    parser.add_argument(
+        "--roi", type=float, nargs="+", default=None, metavar="BOUND",
+        help="Only convert this region: X0 Y0 X1 Y1 or X0 Y0 Z0 X1 Y1 Z1 (voxel indices, upper bounds excluded)"
+    )
+    parser.add_argument(
+        "--roi-mm", action="store_true", help="--roi bounds are physical coordinates (mm) instead of indices"
+    )
+    parser.add_argument(
+        "--slices", type=int, nargs=2, default=None, metavar=("Z0", "Z1"),
+        help="Only convert slices Z0 up to (excluding) Z1"
+    )
+    add_arguments(parser)
     args = parser.parse_args()
 
     inputImage = args.inputImage
     outputImage = args.outputImage
 
-    fileConverter(inputImage, outputImage)
+    cache = None
+    if args.cache is not None:
+        maxBytes = int(args.cache_max_gb * 1e9) if args.cache_max_gb is not None else None
+        cache = ConversionCache(args.cache, maxBytes=maxBytes, link=args.cache_link)
+
+    with Instrumentation.from_args(args, tool="fileConverter"):
+        fileConverter(
+            inputImage,
+            outputImage,
+            stream=args.stream,
+            slabSize=args.slab_size,
+            dicomMultiframe=args.dicom_multiframe,
+            cache=cache,
+            compress=args.compress,
+            compression=args.compression,
+            compressionLevel=args.compress_level,
+            compressThreads=args.compress_threads,
+            pixelType=args.pixel_type,
+            tifSeries=args.tif_series,
+            tifTile=args.tif_tile,
+            seriesUID=args.series_uid,
+            readThreads=args.read_threads,
+            zarrChunks=args.zarr_chunks,
+            zarrLevels=args.zarr_levels,
+            qc=args.qc,
+            roi=args.roi,
+            roiPhysical=args.roi_mm,
+            slices=args.slices,
+            dicomThreads=args.dicom_threads,
+        )
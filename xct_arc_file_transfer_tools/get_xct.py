@@ -1,43 +1,59 @@
+# -----------------------------------------------------
+# get_xct.py
+#
+# Description: Fetches the ISQs listed in a pull request from xt2.
+#
+# Notes:
+# 1. The pull request has one line per subject:
+#       <Study_ID> <Sample_#> <DST1> <MID1> <PRX1> ... <DSTN> <MIDN> <PRXN>
+#    Images are fetched to <out_dir>/temp/<Study_ID>/<timepoint>/<Study_ID>_<STACK>.isq
+#
+# 2. The transfers run concurrently over persistent SSH connections (see
+#    util/transferEngine.py), at most --sessions at a time. The sftp/scp
+#    commands are also written to <out_dir>/sftp_fetch_log.txt for the
+#    shell scripts.
+#
+# 3. Transfers are resumable: an interrupted ISQ is continued from its
+#    last verified chunk by the next run (see util/chunkLedger.py), and
+#    images that were already fetched are skipped. --clean removes the
+#    temp directory of earlier runs first; --no-resume always starts over.
+#
+# 4. With --log-only, nothing is transferred and only the command log is
+#    written (the old behaviour).
+#
+# 5. xt2_host may be 'local:<dir>' to fetch from a local copy of the xt2
+#    file system instead (for testing).
+#
+# 6. --metrics-summary shows how the time splits between the SSH handshake
+#    (connect) and the transfers (get); --metrics <file.jsonl> records every
+#    transfer (see util/instrumentation.py).
+#
+# 7. With --db <jobs.db>, only stacks that were not fetched yet are fetched,
+#    and fetched stacks are recorded in the database (see util/manifest.py).
+#    Rerunning a long pull request after adding subjects only fetches the
+#    new stacks, even when earlier images were moved out of <out_dir>/temp.
+# -----------------------------------------------------
+# USAGE:
+# 1. conda activate manskelab
+# 2. python get_xct.py <pull_request.txt> xt2 ./ arc <arc_out_dir> [--sessions 4] [--report fetch.json] [--db jobs.db]
+#
+# -----------------------------------------------------
+
 import os
+import sys
+import json
 import argparse
 import shutil
 
-def parse_txt(data):
-    '''
-    parse_txt 
-        Parses through list of liens from txt file to arrage data into dictionary.
-
-    Input: 
-    data -> rows of data in following format:
-        ("Study_ID Sample_# DST1 MID1 PRX1 ... DSTN MIDN PRXN")
+from util.transferEngine import Transfer, TransferEngine
+from util.manifest import JobDB, parse_txt, expand_jobs
+from util.instrumentation import Instrumentation, add_arguments
 
-    Output:
-    Dictionary of data with [Study_ID, Sample_#] as key.
-    '''
-    data_dict = {}
-
-    for study_data in data:
-        entry = study_data.split()
-        key = tuple([entry[0], entry[1]])
-        isqs = entry[2:]
-
-        measure_nums = []
-        if len(measure_nums)%3:
-            # print('Must have three measurement numbers for each image. (DST MID PRX).')
-            print('Skipped {}'.format(entry[0]))
-            continue
-
-        for idx in range(0, len(isqs), 3):
-            measure_nums.append(isqs[idx:idx+3])
-        
-        data_dict[key] = measure_nums
-    
-    return data_dict
-
-def batch_fetch(data_dict, out_dir, arc_out_dir, out_txt):
+def batch_fetch(data_dict, out_dir, arc_out_dir, out_txt, only=None, keys=None):
     '''
-    sftp_fetch
-        uses sftp to download isqs in data_dict to out_dir
+    batch_fetch
+        Lists the transfers needed to download the isqs in data_dict to out_dir
+        and logs the sftp/scp commands.
 
     data_dict
         dictionary
@@ -45,9 +61,19 @@ def batch_fetch(data_dict, out_dir, arc_out_dir, out_txt):
         path to output directory
     out_txt
         path to txt file to log sftp commands
+    only
+        optional set of (Study_ID, timepoint, STACK) to fetch; other stacks
+        are skipped
+    keys
+        optional dictionary; filled with target -> (Study_ID, timepoint, STACK)
+        of every transfer
+
+    Output:
+    List of Transfers from xt2, in manifest order.
     '''
 
     stacks = ['DST', 'MID', 'PRX']
+    transfers = []
 
     for id, measurements in data_dict.items():
         id_dir = os.path.join(out_dir, id[0])
@@ -64,11 +90,16 @@ def batch_fetch(data_dict, out_dir, arc_out_dir, out_txt):
             for idx in range(3):
                 measurement = image[idx]
                 stack = stacks[idx]
+                if only is not None and (id[0], time, stack) not in only:
+                    continue
 
                 source = r'/DISK6/xtremect2/data/0000{}/000{}/*ISQ*'.format(id[1], measurement)
                 target = '{}/{}_{}.isq'.format(image_dir, id[0], stack)
                 nii_target = '{}/{}_{}.nii.gz'.format(image_dir, id[0], stack)
                 sftp_fetch(source, target, out_txt)
+                transfers.append(Transfer('get', xt2_host, source, target))
+                if keys is not None:
+                    keys[target] = (id[0], time, stack)
 
                 arc_target = os.path.join(arc_out_dir, id[0])
                 arc_target = os.path.join(arc_target, str(time))
@@ -77,7 +108,9 @@ def batch_fetch(data_dict, out_dir, arc_out_dir, out_txt):
                     fp.write('scp {} {}:{}\n'.format(nii_target, arc_host, arc_target))
 
             time += 1
-    
+
+    return transfers
+
 
 def sftp_fetch(source, target, out_txt):
     with open(out_txt, 'a') as fp:
@@ -95,6 +128,16 @@ def main():
     parser.add_argument("out_dir", type=str, help="Output")
     parser.add_argument("arc_host", type=str, help="Host address of arc cluster")
     parser.add_argument("arc_out_dir", type=str, help="Output dir on arc")
+    parser.add_argument("--sessions", type=int, default=4, help="Concurrent transfers from xt2")
+    parser.add_argument("--retries", type=int, default=3, help="Retries per failed transfer")
+    parser.add_argument("--progress-interval", type=float, default=5.0, help="Seconds between progress reports")
+    parser.add_argument("--report", type=str, default=None, help="JSON file to write per-transfer results to")
+    parser.add_argument("--clean", action="store_true", help="Remove images of earlier runs first")
+    parser.add_argument("--no-resume", action="store_true", help="Restart interrupted transfers from scratch")
+    parser.add_argument("--chunk-mb", type=int, default=16, help="Chunk size for resuming transfers (MB)")
+    parser.add_argument("--log-only", action="store_true", help="Only write the command log, do not transfer")
+    parser.add_argument("--db", type=str, default=None, help="Job state database; only fetch stacks not fetched yet")
+    add_arguments(parser)
     args = parser.parse_args()
 
     sftp_path = args.sftp_path
@@ -104,20 +147,62 @@ def main():
     arc_out_dir = args.arc_out_dir
 
     temp_dir = os.path.join(out_dir, 'temp')
-    if os.path.exists(temp_dir):
+    if os.path.exists(temp_dir) and args.clean:
         shutil.rmtree(temp_dir)
-    os.mkdir(temp_dir)
-
-    file = open(sftp_path, 'r')
-    lines = file.readlines()
+    if not os.path.exists(temp_dir):
+        os.mkdir(temp_dir)
 
     out_txt = out_dir+'/sftp_fetch_log.txt'
     with open(out_txt, 'w') as fp:
         pass
 
-    data_dict = parse_txt(lines)
-
-    batch_fetch(data_dict, temp_dir, arc_out_dir, out_txt)
+    with open(sftp_path, 'r') as file:
+        data_dict = parse_txt(file)
+
+    db = None
+    only = None
+    if args.db is not None:
+        db = JobDB(args.db)
+        jobs = expand_jobs(data_dict)
+        counts = db.sync(jobs)
+        only = db.pending('fetched', jobs)
+        print('{} new and {} changed stacks in {}'.format(counts['new'], counts['changed'], args.db))
+
+    keys = {}
+    transfers = batch_fetch(data_dict, temp_dir, arc_out_dir, out_txt, only, keys)
+    if args.log_only:
+        return
+
+    pending = [t for t in transfers if not os.path.exists(t.target)]
+    if db is not None:
+        db.mark([keys[t.target] for t in transfers if os.path.exists(t.target)], 'fetched')
+    print('Fetching {} of {} images from {}'.format(len(pending), len(transfers), xt2_host))
+
+    engine = TransferEngine(
+        sessions=args.sessions,
+        retries=args.retries,
+        progressInterval=args.progress_interval,
+        resume=not args.no_resume,
+        chunkSize=args.chunk_mb << 20,
+    )
+    with Instrumentation.from_args(args, tool='get_xct'), engine:
+        records = engine.run(pending)
+
+    if db is not None:
+        db.mark([keys[r['target']] for r in records if r['status'] == 'ok'], 'fetched')
+        for record in records:
+            if record['status'] != 'ok':
+                db.mark([keys[record['target']]], 'fetched', error=record['error'])
+
+    if args.report is not None:
+        with open(args.report, 'w') as fp:
+            json.dump(records, fp, indent=2)
+
+    failed = [r for r in records if r['status'] != 'ok']
+    if failed:
+        print()
+        print('Error: {} of {} transfers failed!'.format(len(failed), len(records)))
+        sys.exit(1)
 
 if __name__=='__main__':
     xt2_host = False
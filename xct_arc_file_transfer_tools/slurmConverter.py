@@ -0,0 +1,570 @@
+# -----------------------------------------------------
+# slurmConverter.py
+#
+# Description: Spreads a batch of conversions over a Slurm job array on ARC.
+#              'plan' splits the jobs into shards of about the same amount of
+#              voxel data and writes a job-array script, 'run' converts one
+#              shard (one array task) with batchConverter, and 'collect'
+#              merges the results of all shards.
+#
+# Notes:
+# 1. The jobs are given as for batchConverter.py: a manifest of
+#    '<input> <output> [compression]' lines, or a glob of inputs with an
+#    output directory and extension.
+#
+# 2. The size of every input is read from its header (AIM/ISQ, or any format
+#    SimpleITK reads without loading the voxels), so compressed inputs are
+#    weighed by their uncompressed size. DICOM and TIFF directories are
+#    weighed by the size of their files. The largest jobs are placed first,
+#    each in the shard with the least data so far.
+#
+# 3. The work directory holds plan.json, one batchConverter manifest per shard
+#    (shards/shard_<N>.txt), the job-array script (convert_array.slurm), the
+#    Slurm logs (logs/) and the result of every shard (results/).
+#
+# 4. Each array task runs --workers conversions at a time and splits its
+#    --cpus-per-task between them: ITK/OpenMP threads, compression threads and
+#    DICOM read/write threads are set to cpus-per-task // workers.
+#
+# 5. 'collect' writes every record to one report, lists the failed jobs and
+#    the shards that left no result, and writes the failed and missing jobs
+#    to <work_dir>/retry.txt, a manifest that can be planned again. It exits
+#    with status 1 if anything failed or is missing.
+#
+# 6. 'local' runs every shard one after another on this machine with the
+#    same 'run' command the array tasks use, so a plan can be tested
+#    without Slurm.
+# -----------------------------------------------------
+# USAGE:
+# 1. conda activate manskelab
+# 2. python slurmConverter.py plan --manifest <jobs.txt> --work-dir <dir> [--shards 20] [--cpus-per-task 8] [--workers 2]
+#    python slurmConverter.py plan --glob "<dir/*.isq>" --out-dir <dir> --out-ext .nii.gz --work-dir <dir> --shard-gb 50
+# 3. sbatch <dir>/convert_array.slurm      (or: python slurmConverter.py local --work-dir <dir>)
+# 4. python slurmConverter.py collect --work-dir <dir> [--report results.json]
+#
+# -----------------------------------------------------
+
+import os
+import sys
+import json
+import shlex
+import heapq
+import argparse
+import subprocess
+
+from batchConverter import parse_manifest, manifest_line, glob_jobs, batch_convert
+from util.streamWriters import split_extension
+from util.scancoIO import read_scanco_header
+from util.parallelCompress import compressionPresets
+from util.instrumentation import Instrumentation, path_nbytes, add_arguments
+
+PLAN_FILE = "plan.json"
+SCRIPT_FILE = "convert_array.slurm"
+RETRY_FILE = "retry.txt"
+
+SLURM_TEMPLATE = """#!/bin/bash
+#SBATCH --job-name={jobName}
+#SBATCH --array=0-{lastShard}{throttle}
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task={cpusPerTask}
+#SBATCH --mem={mem}
+#SBATCH --time={time}
+#SBATCH --output="{logDir}/shard_%a.out"
+{extraDirectives}
+{setup}
+
+export ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=$(( SLURM_CPUS_PER_TASK / {workers} > 0 ? SLURM_CPUS_PER_TASK / {workers} : 1 ))
+export OMP_NUM_THREADS=$ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS
+
+python {script} run --work-dir {workDir} --shard $SLURM_ARRAY_TASK_ID
+"""
+
+
+def shard_path(workDir, shard):
+    return os.path.join(workDir, "shards", f"shard_{shard:04d}.txt")
+
+
+def result_path(workDir, shard):
+    return os.path.join(workDir, "results", f"shard_{shard:04d}.json")
+
+
+def estimate_bytes(inputImage):
+    """
+    Uncompressed size of an input image, from its header where possible.
+
+    Parameters
+    ----------
+    inputImage : str
+        Image file, or DICOM/TIFF directory.
+
+    Returns
+    -------
+    nbytes : int
+        Voxel data size in bytes; the size on disk if the header cannot be
+        read (and 0 if the input does not exist).
+    """
+    if os.path.isdir(inputImage) or not os.path.exists(inputImage):
+        return path_nbytes(inputImage)
+
+    extension = split_extension(inputImage)[1]
+    try:
+        if ".isq" in extension or ".aim" in extension:
+            header = read_scanco_header(inputImage)
+            if header["dtype"] is not None:
+                x, y, z = header["dimensions"]
+                return int(x) * int(y) * int(z) * header["dtype"].itemsize
+        else:
+            import SimpleITK as sitk
+
+            reader = sitk.ImageFileReader()
+            reader.SetFileName(inputImage)
+            reader.ReadImageInformation()
+
+            # A one-voxel image of the same pixel type gives the component size
+            voxel = sitk.Image([1] * reader.GetDimension(), reader.GetPixelID())
+            nvoxels = 1
+            for size in reader.GetSize():
+                nvoxels *= size
+            return nvoxels * reader.GetNumberOfComponents() * voxel.GetSizeOfPixelComponent()
+    except Exception:
+        pass
+
+    return path_nbytes(inputImage)
+
+
+def plan_shards(jobs, sizes, shards):
+    """
+    Split jobs into shards of about the same total size.
+
+    Parameters
+    ----------
+    jobs : list of tuple
+        batchConverter jobs.
+    sizes : list of int
+        Estimated size of every job.
+    shards : int
+        Number of shards (fewer if there are fewer jobs).
+
+    Returns
+    -------
+    plan : list of dict
+        Per shard: 'jobs' (in their original order) and 'bytes'.
+    """
+    shards = max(1, min(shards, len(jobs)))
+
+    # Largest job first, into the least loaded shard
+    loads = [(0, shard) for shard in range(shards)]
+    members = [[] for _ in range(shards)]
+    for idx in sorted(range(len(jobs)), key=lambda i: sizes[i], reverse=True):
+        load, shard = heapq.heappop(loads)
+        members[shard].append(idx)
+        heapq.heappush(loads, (load + sizes[idx], shard))
+
+    return [
+        {"jobs": [list(jobs[idx]) for idx in sorted(member)], "bytes": sum(sizes[idx] for idx in member)}
+        for member in members
+    ]
+
+
+def write_plan(workDir, jobs, shards=None, shardBytes=None, cpusPerTask=8, workers=1, options=None,
+               slurm=None):
+    """
+    Plan the shards of a batch and write them, with the job-array script,
+    to a work directory.
+
+    Parameters
+    ----------
+    workDir : str
+    jobs : list of tuple
+        batchConverter jobs.
+    shards : int, optional
+        Number of shards.
+    shardBytes : int, optional
+        Target size of a shard, used when shards is not given.
+    cpusPerTask : int
+        CPUs of every array task.
+    workers : int
+        Concurrent conversions per array task.
+    options : dict, optional
+        fileConverter() options of every conversion.
+    slurm : dict, optional
+        Job-array settings: 'job_name', 'mem', 'time', 'max_running',
+        'partition', 'account' and 'setup' (shell lines run before Python).
+
+    Returns
+    -------
+    plan : dict
+        The contents of plan.json.
+    """
+    workDir = os.path.abspath(workDir)
+    slurm = slurm or {}
+
+    # The array tasks run in another working directory
+    jobs = [(os.path.abspath(job[0]), os.path.abspath(job[1])) + tuple(job[2:]) for job in jobs]
+    sizes = [estimate_bytes(job[0]) for job in jobs]
+
+    if shards is None:
+        shards = -(-sum(sizes) // shardBytes) if shardBytes else 1
+    shardPlan = plan_shards(jobs, sizes, shards)
+
+    for directory in ("shards", "results", "logs"):
+        os.makedirs(os.path.join(workDir, directory), exist_ok=True)
+
+    for shard, entry in enumerate(shardPlan):
+        with open(shard_path(workDir, shard), "w") as fp:
+            for job in entry["jobs"]:
+                fp.write(manifest_line(job))
+
+        # A result of an earlier plan would be collected as this one's
+        if os.path.exists(result_path(workDir, shard)):
+            os.remove(result_path(workDir, shard))
+
+    plan = {
+        "shards": len(shardPlan),
+        "jobs": len(jobs),
+        "bytes": sum(sizes),
+        "shard_bytes": [entry["bytes"] for entry in shardPlan],
+        "shard_jobs": [len(entry["jobs"]) for entry in shardPlan],
+        "cpus_per_task": cpusPerTask,
+        "workers": workers,
+        "options": options or {},
+    }
+    with open(os.path.join(workDir, PLAN_FILE), "w") as fp:
+        json.dump(plan, fp, indent=2)
+
+    extraDirectives = [f"#SBATCH --{name}={slurm[name]}" for name in ("partition", "account") if slurm.get(name)]
+    script = SLURM_TEMPLATE.format(
+        jobName=slurm.get("job_name") or "convert",
+        lastShard=len(shardPlan) - 1,
+        throttle=f"%{slurm['max_running']}" if slurm.get("max_running") else "",
+        cpusPerTask=cpusPerTask,
+        mem=slurm.get("mem") or "16G",
+        time=slurm.get("time") or "04:00:00",
+        logDir=os.path.join(workDir, "logs"),
+        extraDirectives="\n".join(extraDirectives),
+        setup=slurm.get("setup") or "",
+        workers=workers,
+        script=shlex.quote(os.path.abspath(__file__)),
+        workDir=shlex.quote(workDir),
+    )
+    with open(os.path.join(workDir, SCRIPT_FILE), "w") as fp:
+        fp.write(script)
+
+    return plan
+
+
+def run_shard(workDir, shard, instrumentation=None):
+    """
+    Convert the jobs of one shard and write its result records.
+
+    Returns
+    -------
+    records : list of dict
+        batchConverter records of the shard's jobs.
+
+    Raises
+    ------
+    ValueError
+        If the shard's manifest does not hold the planned number of jobs.
+    """
+    with open(os.path.join(workDir, PLAN_FILE), "r") as fp:
+        plan = json.load(fp)
+
+    # Slurm sets the task's CPUs; otherwise use the planned number
+    cpus = int(os.environ.get("SLURM_CPUS_PER_TASK", plan["cpus_per_task"]))
+    workers = max(1, plan["workers"])
+    threads = max(1, cpus // workers)
+
+    # Read by ITK when it is first imported (in batch_convert)
+    os.environ.setdefault("ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", str(threads))
+    os.environ.setdefault("OMP_NUM_THREADS", str(threads))
+
+    jobs = parse_manifest(shard_path(workDir, shard))
+    if "shard_jobs" in plan and len(jobs) != plan["shard_jobs"][shard]:
+        raise ValueError(
+            f"{shard_path(workDir, shard)} has {len(jobs)} readable jobs, but shard {shard} was planned with "
+            f"{plan['shard_jobs'][shard]}"
+        )
+
+    records = batch_convert(
+        jobs,
+        max_workers=workers,
+        instrumentation=instrumentation,
+        compressThreads=threads,
+        readThreads=threads,
+        dicomThreads=threads,
+        **plan["options"],
+    )
+
+    # Written last and atomically: a shard without a result did not finish
+    resultFile = result_path(workDir, shard)
+    with open(resultFile + ".tmp", "w") as fp:
+        json.dump(records, fp, indent=2)
+    os.replace(resultFile + ".tmp", resultFile)
+
+    return records
+
+
+def run_local(workDir, extraArgs=()):
+    """
+    Run every shard of a plan one after another, without Slurm.
+
+    Returns
+    -------
+    failedShards : list of int
+        Shards whose 'run' command exited with an error.
+    """
+    with open(os.path.join(workDir, PLAN_FILE), "r") as fp:
+        plan = json.load(fp)
+
+    failedShards = []
+    for shard in range(plan["shards"]):
+        print(f"Shard {shard + 1}/{plan['shards']}")
+        env = dict(os.environ, SLURM_ARRAY_TASK_ID=str(shard))
+        command = [sys.executable, os.path.abspath(__file__), "run", "--work-dir", workDir, "--shard", str(shard)]
+        if subprocess.run(command + list(extraArgs), env=env).returncode != 0:
+            failedShards.append(shard)
+
+    return failedShards
+
+
+def collect(workDir, report=None):
+    """
+    Merge the result records of all shards.
+
+    Parameters
+    ----------
+    workDir : str
+    report : str, optional
+        JSON file the merged records are written to.
+
+    Returns
+    -------
+    records : list of dict
+        Records of every finished shard, in shard order.
+    missing : list of int
+        Shards without a result.
+    """
+    with open(os.path.join(workDir, PLAN_FILE), "r") as fp:
+        plan = json.load(fp)
+
+    records = []
+    missing = []
+    retry = []
+    for shard in range(plan["shards"]):
+        resultFile = result_path(workDir, shard)
+        if not os.path.exists(resultFile):
+            missing.append(shard)
+            retry.extend(parse_manifest(shard_path(workDir, shard)))
+            continue
+
+        with open(resultFile, "r") as fp:
+            shardRecords = json.load(fp)
+        for record in shardRecords:
+            record["shard"] = shard
+        records.extend(shardRecords)
+
+        failed = {r["input"] for r in shardRecords if r["status"] != "ok"}
+        retry.extend(job for job in parse_manifest(shard_path(workDir, shard)) if job[0] in failed)
+
+    with open(os.path.join(workDir, RETRY_FILE), "w") as fp:
+        for job in retry:
+            fp.write(manifest_line(job))
+
+    if report is not None:
+        with open(report, "w") as fp:
+            json.dump({"records": records, "missing_shards": missing}, fp, indent=2)
+
+    return records, missing
+
+
+def main():
+    # Parse input arguments
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    plan = commands.add_parser("plan", help="Split the jobs into shards and write the job-array script")
+    source = plan.add_mutually_exclusive_group(required=True)
+    source.add_argument("--manifest", type=str, help="Text file with one '<input> <output>' pair per line")
+    source.add_argument("--glob", type=str, help="Glob pattern of input images (quote it!)")
+    plan.add_argument("--out-dir", type=str, default=".", help="Output directory (with --glob)")
+    plan.add_argument("--out-ext", type=str, default=".nii.gz", help="Output extension (with --glob)")
+    plan.add_argument("--work-dir", type=str, required=True, help="Directory for the plan, shards and results")
+    size = plan.add_mutually_exclusive_group()
+    size.add_argument("--shards", type=int, default=None, help="Number of shards (array tasks)")
+    size.add_argument("--shard-gb", type=float, default=None, help="Uncompressed image data per shard (GB)")
+    plan.add_argument("--cpus-per-task", type=int, default=8, help="CPUs of every array task")
+    plan.add_argument("--workers", type=int, default=1, help="Concurrent conversions per array task")
+    plan.add_argument("--mem", type=str, default="16G", help="Memory of every array task")
+    plan.add_argument("--time", type=str, default="04:00:00", help="Time limit of every array task")
+    plan.add_argument("--max-running", type=int, default=None, help="Array tasks running at once")
+    plan.add_argument("--partition", type=str, default=None, help="Slurm partition")
+    plan.add_argument("--account", type=str, default=None, help="Slurm account")
+    plan.add_argument("--job-name", type=str, default="convert", help="Slurm job name")
+    plan.add_argument(
+        "--setup", type=str, default="source ~/.bashrc\nconda activate manskelab",
+        help="Shell lines run before the conversions (e.g. to activate the environment)"
+    )
+    plan.add_argument("--stream", action="store_true", help="Convert AIM/ISQ images slab by slab")
+    plan.add_argument("--slab-size", type=int, default=64, help="Number of slices per slab when streaming")
+    plan.add_argument("--dicom-multiframe", action="store_true", help="Write a single multi-frame DICOM file")
+    plan.add_argument("--compress", action="store_true", help="Compress MHA, MHD, NRRD and TIFF outputs")
+    plan.add_argument("--tif-series", action="store_true", help="Write TIFF outputs as one file per slice")
+    plan.add_argument(
+        "--tif-tile", type=int, default=None, help="Write TIFF outputs in tiles of this size (multiple of 16)"
+    )
+    plan.add_argument(
+        "--zarr-chunks", type=int, nargs=3, default=None, metavar=("Z", "Y", "X"),
+        help="Chunk shape of Zarr outputs (default: 64 256 256)"
+    )
+    plan.add_argument(
+        "--zarr-levels", type=int, default=None, help="Pyramid levels of Zarr outputs (default: until one chunk)"
+    )
+    plan.add_argument(
+        "--qc", action="store_true",
+        help="Write mid-slice and MIP previews, a histogram and statistics to <output>_qc/"
+    )
+    plan.add_argument(
+        "--roi", type=float, nargs="+", default=None, metavar="BOUND",
+        help="Only convert this region: X0 Y0 X1 Y1 or X0 Y0 Z0 X1 Y1 Z1 (voxel indices, upper bounds excluded)"
+    )
+    plan.add_argument(
+        "--roi-mm", action="store_true", help="--roi bounds are physical coordinates (mm) instead of indices"
+    )
+    plan.add_argument(
+        "--slices", type=int, nargs=2, default=None, metavar=("Z0", "Z1"),
+        help="Only convert slices Z0 up to (excluding) Z1"
+    )
+    plan.add_argument(
+        "--compression", type=str, default=None, choices=list(compressionPresets),
+        help="Compression preset for jobs without one in the manifest"
+    )
+    plan.add_argument(
+        "--compress-level", type=int, default=None, help="zlib compression level (0-9), overrides --compression"
+    )
+    plan.add_argument(
+        "--pixel-type", type=str, default=None,
+        help="Output pixel type (uint8, int16, float32, ...) or auto (default: keep the input's type)"
+    )
+
+    run = commands.add_parser("run", help="Convert one shard (run by every array task)")
+    run.add_argument("--work-dir", type=str, required=True, help="Work directory of the plan")
+    run.add_argument(
+        "--shard", type=int, default=None, help="Shard to convert (default: $SLURM_ARRAY_TASK_ID)"
+    )
+    add_arguments(run)
+
+    local = commands.add_parser("local", help="Run every shard here, one after another, without Slurm")
+    local.add_argument("--work-dir", type=str, required=True, help="Work directory of the plan")
+
+    collector = commands.add_parser("collect", help="Merge the results of all shards")
+    collector.add_argument("--work-dir", type=str, required=True, help="Work directory of the plan")
+    collector.add_argument("--report", type=str, default=None, help="JSON file to write all results to")
+
+    args = parser.parse_args()
+
+    if args.command != "plan" and not os.path.exists(os.path.join(args.work_dir, PLAN_FILE)):
+        print()
+        print(f"Error: no {PLAN_FILE} in {args.work_dir}, run 'plan' first!")
+        sys.exit(1)
+
+    if args.command == "plan":
+        if args.manifest is not None:
+            jobs = parse_manifest(args.manifest)
+        else:
+            if not os.path.exists(args.out_dir):
+                os.makedirs(args.out_dir)
+            jobs = glob_jobs(args.glob, args.out_dir, args.out_ext)
+
+        if not jobs:
+            print()
+            print("Error: no conversion jobs found!")
+            sys.exit(1)
+
+        plan = write_plan(
+            args.work_dir,
+            jobs,
+            shards=args.shards,
+            shardBytes=int(args.shard_gb * 1e9) if args.shard_gb is not None else None,
+            cpusPerTask=args.cpus_per_task,
+            workers=args.workers,
+            options={
+                "stream": args.stream,
+                "slabSize": args.slab_size,
+                "dicomMultiframe": args.dicom_multiframe,
+                "compress": args.compress,
+                "compression": args.compression,
+                "compressionLevel": args.compress_level,
+                "pixelType": args.pixel_type,
+                "tifSeries": args.tif_series,
+                "tifTile": args.tif_tile,
+                "zarrChunks": args.zarr_chunks,
+                "zarrLevels": args.zarr_levels,
+                "qc": args.qc,
+                "roi": args.roi,
+                "roiPhysical": args.roi_mm,
+                "slices": args.slices,
+            },
+            slurm={
+                "job_name": args.job_name,
+                "mem": args.mem,
+                "time": args.time,
+                "max_running": args.max_running,
+                "partition": args.partition,
+                "account": args.account,
+                "setup": args.setup,
+            },
+        )
+
+        shardGB = [nbytes / 1e9 for nbytes in plan["shard_bytes"]]
+        print(f"{plan['jobs']} jobs, {plan['bytes'] / 1e9:.1f} GB in {plan['shards']} shards")
+        print(f"Shard size: {min(shardGB):.1f} - {max(shardGB):.1f} GB")
+        print(f"Submit with: sbatch {shlex.quote(os.path.join(os.path.abspath(args.work_dir), SCRIPT_FILE))}")
+
+    elif args.command == "run":
+        shard = args.shard
+        if shard is None:
+            if "SLURM_ARRAY_TASK_ID" not in os.environ:
+                print()
+                print("Error: give --shard or run as a Slurm array task!")
+                sys.exit(1)
+            shard = int(os.environ["SLURM_ARRAY_TASK_ID"])
+
+        try:
+            with Instrumentation.from_args(args, tool="slurmConverter") as instrumentation:
+                records = run_shard(args.work_dir, shard, instrumentation)
+        except ValueError as e:
+            print()
+            print(f"Error: {e}!")
+            sys.exit(1)
+
+        failed = [r for r in records if r["status"] != "ok"]
+        print()
+        print(f"Shard {shard} CONVERTED: {len(records) - len(failed)}/{len(records)}")
+        for record in failed:
+            print(f"FAILED: {record['input']}")
+            print(record["error"])
+
+    elif args.command == "local":
+        failedShards = run_local(args.work_dir)
+        if failedShards:
+            print(f"Shards that did not finish: {', '.join(str(s) for s in failedShards)}")
+        print(f"Merge the results with: python {sys.argv[0]} collect --work-dir {args.work_dir}")
+
+    elif args.command == "collect":
+        records, missing = collect(args.work_dir, args.report)
+
+        failed = [r for r in records if r["status"] != "ok"]
+        print(f"CONVERTED: {len(records) - len(failed)}/{len(records)}")
+        for record in failed:
+            print(f"FAILED (shard {record['shard']}): {record['input']}")
+            print(record["error"])
+        if missing:
+            print(f"NO RESULT from shards: {', '.join(str(s) for s in missing)} (see {args.work_dir}/logs)")
+        if failed or missing:
+            print(f"Failed and missing jobs written to {os.path.join(args.work_dir, RETRY_FILE)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
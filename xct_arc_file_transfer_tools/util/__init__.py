@@ -1,7 +1,42 @@
 # __init__.py
-from .searchAIMLog import searchAIMLog
+#
+# The imaging backends (itk, vtk, SimpleITK) are only imported when first
+# used: the bridge and writer modules import them through lazy_import(),
+# and the SimpleITK constant tables below are resolved on first access.
+import importlib
+
+from .lazyImport import lazy_import
+from .searchAIMLog import searchAIMLog, AIMClassification, classify_aim, classify_files, classify_tree
 from .img2dicom import img2dicom
 from .sitk_vtk import sitk_to_vtk, vtk_to_sitk
 from .sitk_itk import sitk_itk, itk_sitk
-from .sitkInterpolators import interpolatorDict, sitkInterpolatorDictEnum
-from .sitkDataTypes import dataTypeDict, sitkPixelIDEnum
+from .scancoIO import read_scanco_header, iter_scanco_slabs, read_scanco_memmap, read_scanco_sitk, parse_aim_log
+from .streamWriters import SlabImageWriter, write_image
+from .tiffIO import TiffWriter, write_tiff, write_tiff_slices
+from .dicomIndex import DicomSeries, index_dicom_directory, select_series, read_dicom_series
+from .zarrIO import ZarrWriter, write_zarr, read_zarr, zarr_levels
+from .qcPreview import QCAccumulator, write_qc
+from .regionIO import RegionOfInterest, roi_region, raw_layout, read_region, iter_region_slabs
+from .parallelCompress import ParallelCompressWriter, compression_level
+from .conversionCache import ConversionCache, fingerprint
+from .transferEngine import Transfer, TransferEngine, TransferError, open_host
+from .pipeline import Stage, Pipeline, ScratchBudget
+from .chunkLedger import ChunkLedger, StreamHasher
+from .instrumentation import Instrumentation, stage
+from .manifest import JobDB, parse_txt, iter_manifest, expand_jobs
+
+# Attributes whose modules need SimpleITK at import time
+_lazyAttributes = {
+    "interpolatorDict": ".sitkInterpolators",
+    "sitkInterpolatorDictEnum": ".sitkInterpolators",
+    "dataTypeDict": ".sitkDataTypes",
+    "sitkPixelIDEnum": ".sitkDataTypes",
+}
+
+
+def __getattr__(name):
+    if name in _lazyAttributes:
+        value = getattr(importlib.import_module(_lazyAttributes[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,262 @@
+"""
+chunkLedger.py
+
+Description: Bookkeeping for resumable, chunk-verified transfers. A ledger
+             is a JSON sidecar next to a file that records the SHA-256 of
+             every fixed-size chunk written (or read) so far and, once the
+             file is complete, its size and whole-file SHA-256.
+
+Notes:
+1. When a download is restarted, the chunks already on disk are hashed
+   again and compared with the ledger. The file is cut back to the first
+   chunk that is missing or does not match, and the transfer continues
+   from there.
+
+2. StreamHasher hashes a file while another process (sftp) is writing it,
+   following the end of the file. The whole-file SHA-256 is therefore
+   ready when the transfer ends, without reading the file a second time.
+   Since sftp may write a few outstanding blocks out of order, only data
+   more than `margin` bytes behind the end of the file is hashed before
+   the transfer has finished. The same holds when the transfer fails: sftp
+   may have been cut off with holes in the last blocks it wrote, so the
+   chunks within `margin` of the end are not recorded and are fetched
+   again by the next attempt.
+
+3. Chunk hashes are plain SHA-256 of each chunk (as 'dd ... | sha256sum'
+   would print), so they can be compared with hashes computed on a remote
+   Linux host.
+"""
+
+import os
+import json
+import hashlib
+import threading
+
+
+CHUNK_SIZE = 16 << 20
+
+
+class ChunkLedger:
+    """
+    Chunk hashes of one file, stored in a JSON sidecar.
+
+    Parameters
+    ----------
+    sidecar : str
+        Path of the JSON file.
+    key : str or list
+        Identifies the content the ledger belongs to (e.g. the remote source
+        path, or a local file's size and mtime). A sidecar with another key
+        or chunk size is ignored.
+    chunkSize : int
+    """
+
+    def __init__(self, sidecar, key, chunkSize=CHUNK_SIZE):
+        self.sidecar = sidecar
+        self.key = key
+        self.chunkSize = chunkSize
+        self.chunks = []
+        self.size = None
+        self.sha256 = None
+
+        self._lock = threading.Lock()
+
+        if os.path.exists(sidecar):
+            try:
+                with open(sidecar, "r") as fp:
+                    data = json.load(fp)
+            except (OSError, ValueError):
+                data = {}
+
+            if data.get("key") == key and data.get("chunk_size") == chunkSize:
+                self.chunks = data.get("chunks", [])
+                self.size = data.get("size")
+                self.sha256 = data.get("sha256")
+
+    @property
+    def complete(self):
+        return self.sha256 is not None
+
+    def save(self):
+        with self._lock:
+            data = {
+                "key": self.key,
+                "chunk_size": self.chunkSize,
+                "chunks": list(self.chunks),
+                "size": self.size,
+                "sha256": self.sha256,
+            }
+            tmpFile = self.sidecar + ".tmp"
+            with open(tmpFile, "w") as fp:
+                json.dump(data, fp)
+            os.replace(tmpFile, self.sidecar)
+
+    def add(self, digest, save=True):
+        with self._lock:
+            self.chunks.append(digest)
+        if save:
+            self.save()
+
+    def finish(self, size, sha256):
+        self.size = size
+        self.sha256 = sha256
+        self.save()
+
+    def remove(self):
+        if os.path.exists(self.sidecar):
+            os.remove(self.sidecar)
+
+    def verify(self, fileName, fileHash=None):
+        """
+        Check the chunks of fileName against the ledger and cut the file
+        (and the ledger) back to the verified part.
+
+        Parameters
+        ----------
+        fileName : str
+        fileHash : hashlib hash, optional
+            Fed with the verified bytes.
+
+        Returns
+        -------
+        offset : int
+            Number of verified bytes kept.
+        """
+        verified = 0
+
+        if os.path.exists(fileName):
+            with open(fileName, "rb") as fp:
+                for digest in self.chunks:
+                    chunk = fp.read(self.chunkSize)
+                    if len(chunk) < self.chunkSize or hashlib.sha256(chunk).hexdigest() != digest:
+                        break
+                    if fileHash is not None:
+                        fileHash.update(chunk)
+                    verified += 1
+
+            with open(fileName, "r+b") as fp:
+                fp.truncate(verified * self.chunkSize)
+
+        self.chunks = self.chunks[:verified]
+        self.size = None
+        self.sha256 = None
+        self.save()
+
+        return verified * self.chunkSize
+
+
+class StreamHasher:
+    """
+    Hashes a file chunk by chunk while it is being written, recording every
+    chunk in a ledger.
+
+    Parameters
+    ----------
+    fileName : str
+    ledger : ChunkLedger
+    offset : int
+        Bytes already verified (a multiple of the chunk size).
+    fileHash : hashlib hash
+        Whole-file hash, already fed with the first offset bytes.
+    margin : int
+        Bytes behind the end of the file that are not hashed until
+        finish() (data that may still be written out of order).
+    interval : float
+        Seconds between checks of the file size.
+    """
+
+    def __init__(self, fileName, ledger, offset=0, fileHash=None, margin=8 << 20, interval=0.2):
+        self.fileName = fileName
+        self.ledger = ledger
+        self.offset = offset
+        self.fileHash = fileHash if fileHash is not None else hashlib.sha256()
+        self.margin = margin
+        self.interval = interval
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._condition = threading.Condition()
+
+    def _hash_chunks(self, limit, final=False):
+        chunkSize = self.ledger.chunkSize
+
+        with open(self.fileName, "rb") as fp:
+            fp.seek(self.offset)
+            while self.offset + chunkSize <= limit:
+                chunk = fp.read(chunkSize)
+                if len(chunk) < chunkSize:
+                    # Cut back since the size was read
+                    break
+                self.fileHash.update(chunk)
+                self.ledger.add(hashlib.sha256(chunk).hexdigest())
+                with self._condition:
+                    self.offset += len(chunk)
+                    self._condition.notify_all()
+
+            if final:
+                # Last, partial chunk
+                chunk = fp.read()
+                if chunk:
+                    self.fileHash.update(chunk)
+                    self.ledger.add(hashlib.sha256(chunk).hexdigest())
+                    with self._condition:
+                        self.offset += len(chunk)
+                        self._condition.notify_all()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                size = os.path.getsize(self.fileName)
+            except OSError:
+                continue
+            self._hash_chunks(size - self.margin)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, checkpoint=False):
+        """
+        Stop following the file. Chunks hashed so far stay in the ledger.
+
+        Parameters
+        ----------
+        checkpoint : bool
+            Also hash every complete chunk now more than margin bytes behind
+            the end of the file (the thread checks only every interval
+            seconds). Use this once the writer has exited, e.g. after a
+            failed transfer; the last margin bytes may hold holes of blocks
+            that were never written and are left for the next attempt.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if checkpoint and os.path.exists(self.fileName):
+            self._hash_chunks(os.path.getsize(self.fileName) - self.margin)
+
+    def wait_for(self, nbytes):
+        """
+        Wait until the first nbytes of the file have been hashed.
+        """
+        with self._condition:
+            while self.offset < nbytes and self._thread is not None and self._thread.is_alive():
+                self._condition.wait(timeout=1.0)
+
+    def finish(self):
+        """
+        Hash the rest of the (now complete) file and record it in the ledger.
+
+        Returns
+        -------
+        sha256 : str
+            Hex digest of the whole file.
+        """
+        self.stop()
+        self._hash_chunks(os.path.getsize(self.fileName), final=True)
+
+        sha256 = self.fileHash.hexdigest()
+        self.ledger.finish(self.offset, sha256)
+        return sha256
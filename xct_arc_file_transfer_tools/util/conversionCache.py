@@ -0,0 +1,354 @@
+"""
+conversionCache.py
+
+Description: Content-addressed cache of fileConverter() outputs. A
+             conversion is keyed on a fingerprint of the input (its header
+             plus sampled, or optionally all, content) and on the
+             conversion parameters (output format and options). On a hit
+             the cached output is copied (or, optionally, hard-linked) to
+             the requested output path instead of converting again.
+
+Notes:
+1. The cache lives in a directory with an SQLite index (index.sqlite) and
+   one folder per entry under objects/. SQLite is used so that several
+   batch workers can share one cache safely.
+
+2. The default fingerprint reads the first 1 MB of each input file (the
+   whole Scanco/NIfTI/MHA header), 16 evenly spaced 64 kB samples and the
+   last 64 kB, plus the file size. This is fast on multi-GB ISQs but can
+   miss an edit that changes neither the size nor a sampled block; use
+   fullHash=True to hash every byte.
+
+3. Outputs are copied by default. With link=True (--cache-link) they are
+   hard-linked instead, which saves the copy but makes a cached output and
+   every file linked from it share their data: writing to any of them in
+   place changes them all. fileConverter() removes its outputs before writing
+   them, with or without a cache, but other tools that modify outputs in
+   place must not be used on linked outputs.
+
+4. The total size of the cache is bounded by maxBytes; least recently used
+   entries are evicted first.
+
+5. A new entry is staged in its own temporary directory and renamed into
+   objects/ in one step, so an entry is never seen half-written. If the
+   entry is already there (another worker stored the same conversion
+   first), the staged copy is dropped. A complete entry directory is never
+   removed by store(); an incomplete one (left by an interrupted eviction)
+   is first renamed out of the way.
+"""
+
+import os
+import json
+import time
+import errno
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import contextlib
+
+
+CACHE_VERSION = 1
+
+HEAD_BYTES = 1 << 20
+SAMPLE_BYTES = 64 << 10
+SAMPLE_COUNT = 16
+
+
+def _fingerprint_file(fileName, digest, fullHash=False):
+    size = os.path.getsize(fileName)
+    digest.update(str(size).encode())
+
+    with open(fileName, "rb") as fp:
+        if fullHash or size <= HEAD_BYTES + (SAMPLE_COUNT + 1) * SAMPLE_BYTES:
+            for block in iter(lambda: fp.read(1 << 20), b""):
+                digest.update(block)
+            return
+
+        digest.update(fp.read(HEAD_BYTES))
+
+        step = (size - HEAD_BYTES) // (SAMPLE_COUNT + 1)
+        for i in range(1, SAMPLE_COUNT + 1):
+            fp.seek(HEAD_BYTES + i * step)
+            digest.update(fp.read(SAMPLE_BYTES))
+
+        fp.seek(size - SAMPLE_BYTES)
+        digest.update(fp.read(SAMPLE_BYTES))
+
+
+def fingerprint(inputImage, fullHash=False):
+    """
+    Fingerprint an input image file or directory (e.g. a DICOM series).
+
+    Parameters
+    ----------
+    inputImage : str
+    fullHash : bool
+        Hash every byte instead of the header plus samples.
+
+    Returns
+    -------
+    digest : str
+        Hex digest of the content. Paths, names and times do not take part,
+        so a renamed or copied input has the same fingerprint.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+
+    if os.path.isdir(inputImage):
+        for root, dirs, files in os.walk(inputImage):
+            dirs.sort()
+            for name in sorted(files):
+                fileName = os.path.join(root, name)
+                digest.update(os.path.relpath(fileName, inputImage).encode())
+                _fingerprint_file(fileName, digest, fullHash)
+    else:
+        _fingerprint_file(inputImage, digest, fullHash)
+
+    return digest.hexdigest()
+
+
+class ConversionCache:
+    """
+    Cache of converted images.
+
+    Parameters
+    ----------
+    cacheDir : str
+        Directory holding the cache. Created if it does not exist.
+    maxBytes : int, optional
+        Size limit of the cache. No limit if None.
+    fullHash : bool
+        Fingerprint inputs by hashing every byte.
+    link : bool
+        Hard-link cached outputs instead of copying them (falls back to
+        copying across file systems). See Note 3.
+    """
+
+    def __init__(self, cacheDir, maxBytes=None, fullHash=False, link=False):
+        self.cacheDir = os.path.abspath(cacheDir)
+        self.maxBytes = maxBytes
+        self.fullHash = fullHash
+        self.link = link
+
+        os.makedirs(os.path.join(self.cacheDir, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(self.cacheDir, "tmp"), exist_ok=True)
+
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, files TEXT, size INTEGER, created REAL, last_used REAL)"
+            )
+            db.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+            db.execute("INSERT OR IGNORE INTO stats VALUES ('hits', 0), ('misses', 0)")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(os.path.join(self.cacheDir, "index.sqlite"), timeout=60)
+        try:
+            # Commits on success, rolls back on error
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _object_dir(self, key):
+        return os.path.join(self.cacheDir, "objects", key)
+
+    def key(self, inputImage, params):
+        """
+        Cache key of converting inputImage with the given parameters.
+
+        Parameters
+        ----------
+        inputImage : str
+        params : dict
+            Everything that changes the output bytes (output extension,
+            pixel type, compression, ...). Must be JSON serializable.
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(str(CACHE_VERSION).encode())
+        digest.update(fingerprint(inputImage, self.fullHash).encode())
+        digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def _place(self, source, target):
+        if os.path.lexists(target):
+            os.remove(target)
+
+        if self.link:
+            try:
+                os.link(source, target)
+                return
+            except OSError:
+                pass
+        shutil.copy2(source, target)
+
+    def fetch(self, key, outputFiles):
+        """
+        Place a cached conversion at outputFiles.
+
+        Returns
+        -------
+        hit : bool
+        """
+        with self._connect() as db:
+            row = db.execute("SELECT files FROM entries WHERE key = ?", (key,)).fetchone()
+
+        objectDir = self._object_dir(key)
+        files = json.loads(row[0]) if row is not None else None
+
+        if files is None or len(files) != len(outputFiles) or not all(
+            os.path.isfile(os.path.join(objectDir, name)) for name in files
+        ):
+            with self._connect() as db:
+                if row is not None:
+                    # Entry lost its files; forget it
+                    db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                db.execute("UPDATE stats SET value = value + 1 WHERE name = 'misses'")
+            return False
+
+        try:
+            for name, outputFile in zip(files, outputFiles):
+                self._place(os.path.join(objectDir, name), outputFile)
+        except FileNotFoundError:
+            # Evicted by another process while being fetched
+            with self._connect() as db:
+                db.execute("UPDATE stats SET value = value + 1 WHERE name = 'misses'")
+            return False
+
+        with self._connect() as db:
+            db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+            db.execute("UPDATE stats SET value = value + 1 WHERE name = 'hits'")
+
+        return True
+
+    def store(self, key, outputFiles):
+        """
+        Add the outputs of a finished conversion to the cache (see Note 5).
+        """
+        tmpDir = tempfile.mkdtemp(prefix=f"{key}.", dir=os.path.join(self.cacheDir, "tmp"))
+
+        files = []
+        size = 0
+        try:
+            for outputFile in outputFiles:
+                name = os.path.basename(outputFile)
+                self._place(outputFile, os.path.join(tmpDir, name))
+                files.append(name)
+                size += os.path.getsize(outputFile)
+        except BaseException:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+            raise
+
+        objectDir = self._object_dir(key)
+        stored = self._rename_entry(tmpDir, objectDir, len(files))
+        if not stored:
+            # Another process stored the same conversion first
+            shutil.rmtree(tmpDir, ignore_errors=True)
+            if not all(os.path.isfile(os.path.join(objectDir, name)) for name in files):
+                # Its outputs were named differently; it indexes its own entry
+                return
+
+        now = time.time()
+        with self._connect() as db:
+            # A row of the entry stored by another process is kept
+            db.execute(
+                f"INSERT OR {'REPLACE' if stored else 'IGNORE'} INTO entries VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(files), size, now, now),
+            )
+
+        if self.maxBytes is not None:
+            self.evict(self.maxBytes)
+
+    def _rename_entry(self, tmpDir, objectDir, nfiles):
+        # Returns False if a complete entry (of nfiles files; entries only
+        # lose files while being evicted) is already at objectDir
+        for attempt in range(2):
+            try:
+                os.rename(tmpDir, objectDir)
+                return True
+            except OSError as e:
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    shutil.rmtree(tmpDir, ignore_errors=True)
+                    raise
+
+            if self._complete(objectDir, nfiles) or attempt:
+                return False
+
+            # Left over from an interrupted eviction: move it aside
+            staleDir = tempfile.mkdtemp(prefix="stale.", dir=os.path.dirname(tmpDir))
+            staleEntry = os.path.join(staleDir, "entry")
+            try:
+                os.rename(objectDir, staleEntry)
+                if self._complete(staleEntry, nfiles):
+                    # Stored by another process in the meantime: put it back
+                    os.rename(staleEntry, objectDir)
+            except OSError:
+                pass
+            shutil.rmtree(staleDir, ignore_errors=True)
+        return False
+
+    @staticmethod
+    def _complete(objectDir, nfiles):
+        try:
+            return len(os.listdir(objectDir)) >= nfiles
+        except OSError:
+            return False
+
+    def evict(self, maxBytes):
+        """
+        Remove least recently used entries until the cache fits in maxBytes.
+
+        Returns
+        -------
+        removed : int
+            Number of entries removed.
+        """
+        with self._connect() as db:
+            rows = db.execute("SELECT key, size FROM entries ORDER BY last_used DESC").fetchall()
+
+        total = 0
+        evicted = []
+        for key, size in rows:
+            total += size
+            if total > maxBytes:
+                evicted.append(key)
+
+        for key in evicted:
+            with self._connect() as db:
+                db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            shutil.rmtree(self._object_dir(key), ignore_errors=True)
+
+        return len(evicted)
+
+    def clear(self):
+        """
+        Remove every entry and reset the statistics.
+        """
+        removed = self.evict(0)
+        with self._connect() as db:
+            db.execute("UPDATE stats SET value = 0")
+        return removed
+
+    def stats(self):
+        """
+        Cache statistics.
+
+        Returns
+        -------
+        stats : dict
+            'entries', 'bytes', 'hits', 'misses' and 'max_bytes'.
+        """
+        with self._connect() as db:
+            entries, total = db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+            counters = dict(db.execute("SELECT name, value FROM stats").fetchall())
+
+        return {
+            "entries": entries,
+            "bytes": total,
+            "hits": counters.get("hits", 0),
+            "misses": counters.get("misses", 0),
+            "max_bytes": self.maxBytes,
+        }
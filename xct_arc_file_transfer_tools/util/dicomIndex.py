@@ -0,0 +1,306 @@
+"""
+dicomIndex.py
+
+Description: Indexes the DICOM series in a directory and reads one of them
+             into a single volume. Used for fileConverter's DICOM
+             directory inputs instead of GDCM's series scan.
+
+Notes:
+1. The header of every file is read (without its pixel data) on a pool of
+   threads. A file that is not DICOM is remembered as such and skipped.
+
+2. The index is stored next to the directory, as
+   .<directory name>.dicom_index.json, with the size and mtime of every
+   file. Indexing the directory again only reads the headers of files
+   that are new or whose size or mtime changed; files that were removed
+   are dropped. If the index cannot be written (read-only parent), the
+   directory is simply indexed again next time.
+
+3. The slices of a series are sorted along the slice normal (like GDCM's
+   IPPSorter), then by instance number and file name. The origin is that
+   of the first slice, the slice spacing the distance between the first
+   and last slice over the number of gaps.
+
+4. read_dicom_series() allocates the volume once and decodes runs of
+   slices into it on a pool of threads. The slices are decoded by GDCM
+   (so the rescale slope/intercept are applied as before), and the volume
+   has the smallest type that holds every slice's type. Uneven slice gaps
+   (missing slices) are reported. Series that are not a stack of
+   single-frame scalar slices of one size (multi-frame files, RGB) are
+   read with SimpleITK's ImageSeriesReader instead.
+"""
+
+import os
+import json
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .lazyImport import lazy_import
+
+sitk = lazy_import("SimpleITK")
+pixelTypes = lazy_import(__package__ + ".sitkDataTypes")
+
+
+# Bump when the fields stored per file change
+INDEX_VERSION = 1
+
+# One series of a directory; files and slices are in slice order
+DicomSeries = namedtuple("DicomSeries", ["uid", "description", "modality", "files", "slices"])
+
+# DICOM tags read into the index
+_tags = {
+    "series_uid": "0020|000e",
+    "description": "0008|103e",
+    "modality": "0008|0060",
+    "instance": "0020|0013",
+}
+
+
+def dicom_index_file(directory):
+    """
+    File the index of a DICOM directory is stored in.
+    """
+    directory = os.path.abspath(directory)
+    parent, name = os.path.split(directory.rstrip(os.sep))
+    return os.path.join(parent, f".{name}.dicom_index.json")
+
+
+def _read_header(fileName):
+    # Index entry of one file, from its header only
+    reader = sitk.ImageFileReader()
+    reader.SetImageIO("GDCMImageIO")
+    reader.SetFileName(fileName)
+    try:
+        reader.ReadImageInformation()
+    except RuntimeError:
+        return {"series_uid": None}
+
+    entry = {}
+    for field, tag in _tags.items():
+        entry[field] = reader.GetMetaData(tag).strip() if reader.HasMetaDataKey(tag) else ""
+    try:
+        entry["instance"] = int(entry["instance"])
+    except ValueError:
+        entry["instance"] = None
+
+    entry.update(
+        size=list(reader.GetSize()),
+        components=reader.GetNumberOfComponents(),
+        pixel_type=pixelTypes.sitkPixelIDEnum.get(reader.GetPixelID(), "unknown"),
+        origin=list(reader.GetOrigin()),
+        spacing=list(reader.GetSpacing()),
+        direction=list(reader.GetDirection()),
+    )
+    return entry
+
+
+def _load_index(indexFile, directory):
+    try:
+        with open(indexFile, "r") as fp:
+            index = json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+    if index.get("version") != INDEX_VERSION or index.get("directory") != directory:
+        return {}
+    return index.get("files", {})
+
+
+def _save_index(indexFile, directory, files):
+    try:
+        with open(indexFile + ".tmp", "w") as fp:
+            json.dump({"version": INDEX_VERSION, "directory": directory, "files": files}, fp)
+        os.replace(indexFile + ".tmp", indexFile)
+    except OSError:
+        pass
+
+
+def _slice_position(entry):
+    # Position of a slice along its normal (the third direction column)
+    direction = entry["direction"]
+    normal = (direction[2], direction[5], direction[8])
+    return float(np.dot(entry["origin"], normal))
+
+
+def index_dicom_directory(directory, threads=None, persist=True):
+    """
+    Index the DICOM series in a directory (not its subdirectories).
+
+    Parameters
+    ----------
+    directory : str
+    threads : int, optional
+        Threads reading headers (default: number of CPUs).
+    persist : bool
+        Reuse and update the index stored next to the directory (see
+        dicom_index_file()).
+
+    Returns
+    -------
+    series : dict
+        DicomSeries by series instance UID, largest series first.
+    stats : dict
+        'files' (DICOM files), 'read' (headers read) and 'reused'
+        (entries taken from the stored index).
+    """
+    directory = os.path.abspath(directory)
+    indexFile = dicom_index_file(directory)
+    stored = _load_index(indexFile, directory) if persist else {}
+
+    files = {}
+    toRead = []
+    with os.scandir(directory) as it:
+        for dirEntry in it:
+            if dirEntry.name.startswith(".") or not dirEntry.is_file():
+                continue
+            stat = dirEntry.stat()
+            entry = stored.get(dirEntry.name)
+            if entry is not None and entry["mtime_ns"] == stat.st_mtime_ns and entry["bytes"] == stat.st_size:
+                files[dirEntry.name] = entry
+            else:
+                toRead.append((dirEntry.name, stat))
+
+    if toRead:
+        with ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as executor:
+            headers = executor.map(_read_header, [os.path.join(directory, name) for name, stat in toRead])
+            for (name, stat), entry in zip(toRead, headers):
+                entry.update(mtime_ns=stat.st_mtime_ns, bytes=stat.st_size)
+                files[name] = entry
+
+        if persist:
+            _save_index(indexFile, directory, files)
+    elif persist and len(files) != len(stored):
+        # Files were removed
+        _save_index(indexFile, directory, files)
+
+    grouped = {}
+    for name, entry in files.items():
+        if entry["series_uid"] is not None:
+            grouped.setdefault(entry["series_uid"], []).append((name, entry))
+
+    series = {}
+    for uid, members in sorted(grouped.items(), key=lambda item: (-len(item[1]), item[0])):
+        members.sort(key=lambda member: (
+            _slice_position(member[1]),
+            member[1]["instance"] if member[1]["instance"] is not None else 0,
+            member[0],
+        ))
+        first = members[0][1]
+        series[uid] = DicomSeries(
+            uid=uid,
+            description=first["description"],
+            modality=first["modality"],
+            files=[os.path.join(directory, name) for name, entry in members],
+            slices=[entry for name, entry in members],
+        )
+
+    stats = {
+        "files": sum(len(members) for members in grouped.values()),
+        "read": len(toRead),
+        "reused": len(files) - len(toRead),
+    }
+    return series, stats
+
+
+def select_series(series, seriesUID=None):
+    """
+    Pick a series of index_dicom_directory(): the one with seriesUID, or
+    the largest.
+
+    Raises
+    ------
+    ValueError
+        If there is no DICOM series or none with seriesUID.
+    """
+    if not series:
+        raise ValueError("No DICOM series found")
+    if seriesUID is None:
+        return next(iter(series.values()))
+    if seriesUID not in series:
+        raise ValueError(f"No DICOM series {seriesUID} (found: {', '.join(series)})")
+    return series[seriesUID]
+
+
+def series_summary(series):
+    """
+    One line per series of index_dicom_directory(): UID, number of files
+    and description.
+    """
+    return [f"{s.uid}  {len(s.files):5d} files  {s.modality} {s.description}".rstrip() for s in series.values()]
+
+
+def _is_slice_stack(series):
+    first = series.slices[0]
+    return all(
+        entry["components"] == 1
+        and entry["size"][:2] == first["size"][:2]
+        and (len(entry["size"]) < 3 or entry["size"][2] == 1)
+        and entry["pixel_type"] != "unknown"
+        for entry in series.slices
+    )
+
+
+def read_dicom_series(series, threads=None):
+    """
+    Read a series of index_dicom_directory() as one image.
+
+    Parameters
+    ----------
+    series : DicomSeries
+    threads : int, optional
+        Threads decoding slices (default: number of CPUs).
+
+    Returns
+    -------
+    image : SimpleITK.Image
+    """
+    if len(series.files) == 1 or not _is_slice_stack(series):
+        reader = sitk.ImageSeriesReader()
+        reader.SetFileNames(series.files)
+        return reader.Execute()
+
+    first = series.slices[0]
+    dtype = np.result_type(*{entry["pixel_type"] for entry in series.slices})
+    volume = np.empty((len(series.files), first["size"][1], first["size"][0]), dtype=dtype)
+
+    # Slices are decoded in runs, a few per thread: reading a run with
+    # GDCM's series reader costs far less per file than one read per file
+    threads = threads or os.cpu_count() or 1
+    runLength = -(-len(series.files) // (4 * threads))
+
+    def decode(z):
+        reader = sitk.ImageSeriesReader()
+        reader.SetImageIO("GDCMImageIO")
+        reader.SetOutputPixelType(pixelTypes.dataTypeDict[dtype.name])
+        # Spacing is checked once for the whole series below
+        reader.SetSpacingWarningRelThreshold(float("inf"))
+        reader.SetFileNames(series.files[z:z + runLength])
+        # The view does not keep the image alive
+        image = reader.Execute()
+        volume[z:z + runLength] = sitk.GetArrayViewFromImage(image).reshape((-1,) + volume.shape[1:])
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        # list() re-raises the first decoding error
+        list(executor.map(decode, range(0, len(series.files), runLength)))
+
+    image = sitk.GetImageFromArray(volume)
+    del volume
+
+    spacing = list(first["spacing"][:2])
+    if len(series.slices) > 1:
+        positions = np.array([_slice_position(entry) for entry in series.slices])
+        spacing.append(abs(positions[-1] - positions[0]) / (len(positions) - 1) or 1.0)
+        gaps = np.abs(np.diff(positions))
+        if gaps.max() - gaps.min() > 1e-3 * spacing[2]:
+            print(f"Warning: slices of series {series.uid} are not evenly spaced "
+                  f"({gaps.min():.4g} to {gaps.max():.4g} mm apart), missing slices?")
+    else:
+        spacing.append(first["spacing"][2])
+
+    image.SetSpacing(spacing)
+    image.SetOrigin(first["origin"])
+    image.SetDirection(first["direction"])
+    return image
@@ -4,21 +4,31 @@
 # Created by:   Michael Kuczynski
 # Created on:   21-01-2020
 #
-# Description: Converts between SimpleITK and VTK image types
+# Description: Writes a SimpleITK image as a DICOM series (one file per
+#              slice) or as a single multi-frame DICOM file.
+#
+# Notes:
+# 1. The series tags, creation date/time and slice positions are computed
+#    once up front. Slices are then extracted and written by a bounded
+#    thread pool; each worker uses its own ImageFileWriter. File names
+#    and instance numbers only depend on the slice index, so the output
+#    is the same regardless of the number of threads.
+# 2. Multi-frame files are written with the CT modality, since GDCM only
+#    writes signed pixels for CT (not for the default Secondary Capture).
 # -----------------------------------------------------
 
 import os
 import time
 import errno
 
-import SimpleITK as sitk
+from concurrent.futures import ThreadPoolExecutor
+
+from .lazyImport import lazy_import
 
+sitk = lazy_import("SimpleITK")
 
-def img2dicom(img, outDir):
-    new_img = img
-    spacingX, spacingY, spacingZ = img.GetSpacing()
-    new_img.SetSpacing([spacingX, spacingY, spacingZ])
 
+def _series_tags(img):
     modification_time = time.strftime("%H%M%S")
     modification_date = time.strftime("%Y%m%d")
 
@@ -26,8 +36,8 @@ def img2dicom(img, outDir):
     # For the series instance UID (0020|000e), each of the components is a number, cannot start
     # with zero, and separated by a '.' We create a unique series ID using the date and time.
     # tags of interest:
-    direction = new_img.GetDirection()
-    series_tag_values = [
+    direction = img.GetDirection()
+    return [
         ("0008|0031", modification_time),  # Series Time
         ("0008|0021", modification_date),  # Series Date
         ("0008|0008", "DERIVED\\SECONDARY"),  # Image Type
@@ -54,14 +64,28 @@ def img2dicom(img, outDir):
                 )
             ),
         ),
-        ("0008|103e", "Created-SimpleITK"),
-    ]  # Series Description
+        ("0008|103e", "Created-SimpleITK"),  # Series Description
+        ("0008|0012", modification_date),  # Instance Creation Date
+        ("0008|0013", modification_time),  # Instance Creation Time
+        # Setting the type to CT preserves the slice location.
+        ("0008|0060", "CT"),  # set the type to CT so the thickness is carried over
+    ]
 
-    writer = sitk.ImageFileWriter()
-    # Use the study/series/frame of reference information given in the meta-data
-    # dictionary and not the automatically generated information from the file
-    # IO
-    writer.KeepOriginalImageUIDOn()
+
+def img2dicom(img, outDir, max_workers=None, multiframe=False):
+    """
+    Write an image to <outDir>/dcm as DICOM.
+
+    Parameters
+    ----------
+    img : SimpleITK.Image
+    outDir : str
+    max_workers : int, optional
+        Number of threads writing slices. Defaults to the number of CPUs.
+    multiframe : bool
+        Write one multi-frame file (dcm.dcm) instead of one file per slice.
+    """
+    series_tag_values = _series_tags(img)
 
     outPath = os.path.join(outDir, "dcm")
 
@@ -71,31 +95,45 @@ def img2dicom(img, outDir):
         if e.errno != errno.EEXIST:  # Directory already exists error
             raise
 
-    for i in range(new_img.GetDepth()):
-        image_slice = new_img[:, :, i]
+    if multiframe:
+        # Shallow copy so the caller's meta-data is left alone
+        volume = sitk.Image(img)
+        for tag, value in series_tag_values:
+            volume.SetMetaData(tag, value)
+
+        writer = sitk.ImageFileWriter()
+        writer.KeepOriginalImageUIDOn()
+        writer.SetFileName(os.path.join(outPath, "dcm.dcm"))
+        writer.Execute(volume)
+        return
+
+    # (0020, 0032) image position patient determines the 3D spacing between slices.
+    positions = [
+        "\\".join(map(str, img.TransformIndexToPhysicalPoint((0, 0, i))))
+        for i in range(img.GetDepth())
+    ]
+
+    def write_slice(i):
+        image_slice = img[:, :, i]
         # Tags shared by the series.
         for tag, value in series_tag_values:
             image_slice.SetMetaData(tag, value)
         # Slice specific tags.
-        image_slice.SetMetaData(
-            "0008|0012", time.strftime("%Y%m%d")
-        )  # Instance Creation Date
-        image_slice.SetMetaData(
-            "0008|0013", time.strftime("%H%M%S")
-        )  # Instance Creation Time
-        # Setting the type to CT preserves the slice location.
-        image_slice.SetMetaData(
-            "0008|0060", "CT"
-        )  # set the type to CT so the thickness is carried over
+        image_slice.SetMetaData("0020|0032", positions[i])  # Image Position (Patient)
+        image_slice.SetMetaData("0020|0013", str(i + 1))  # Instance Number
 
-        # (0020, 0032) image position patient determines the 3D spacing between slices.
-        image_slice.SetMetaData(
-            "0020|0032",
-            "\\".join(map(str, new_img.TransformIndexToPhysicalPoint((0, 0, i)))),
-        )  # Image Position (Patient)
-        image_slice.SetMetaData("0020,0013", str(i))  # Instance Number
+        # Use the study/series/frame of reference information given in the meta-data
+        # dictionary and not the automatically generated information from the file
+        # IO
+        writer = sitk.ImageFileWriter()
+        writer.KeepOriginalImageUIDOn()
 
         # Write to the output directory and add the extension dcm, to force
         # writing in DICOM format.
         writer.SetFileName(os.path.join(outPath, "dcm" + str(i) + ".dcm"))
         writer.Execute(image_slice)
+
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as executor:
+        # Consume the results so that any writer error is raised here
+        for _ in executor.map(write_slice, range(img.GetDepth())):
+            pass
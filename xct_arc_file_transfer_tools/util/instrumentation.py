@@ -0,0 +1,356 @@
+"""
+instrumentation.py
+
+Description: Per-stage timing and memory measurements shared by the
+             conversion and transfer tools. Code marks its stages (read,
+             cast, sitk_itk, rescale, write, connect, get, put, ...) with
+
+                 with stage("read", file=inputImage) as record:
+                     image = sitk.ReadImage(inputImage)
+                     record["bytes_out"] = image_nbytes(image)
+
+             and, while an Instrumentation is active, every stage is
+             recorded with its wall time, CPU time, bytes in and out and
+             peak RSS. Without an active Instrumentation stage() does
+             nothing, so the marks can stay in the code.
+
+Notes:
+1. Records can be written as JSON lines (one per stage, as it ends) and/or
+   summarised per stage name in a table at the end of the run.
+
+2. Peak RSS is measured per stage on Linux by resetting the process'
+   high-water mark (/proc/self/clear_refs) when a stage starts. Stages may
+   be nested or run in several threads at once: every open stage gets the
+   highest mark seen while it was open. Elsewhere the peak RSS of the
+   whole process so far is reported.
+
+3. CPU time is that of the whole process (ITK and SimpleITK filters run on
+   their own threads), so it is only meaningful for stages that do not
+   overlap.
+
+4. Optional, per run: a cProfile profile of the main thread written to a
+   file, and the peak of Python/numpy allocations per stage (tracemalloc,
+   which slows the run down).
+
+5. Stages recorded in worker processes (e.g. batchConverter) are returned
+   with the job result and added to the parent's Instrumentation.
+"""
+
+import os
+import sys
+import json
+import time
+import cProfile
+import resource
+import threading
+import tracemalloc
+
+from contextlib import contextmanager
+
+
+_active = None
+_lock = threading.Lock()
+# Records of the stages currently open (in any thread)
+_open = []
+_canResetPeak = None
+
+
+def _rss_peak():
+    # High-water mark of the resident set size in bytes
+    try:
+        with open("/proc/self/status", "r") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _reset_rss_peak():
+    global _canResetPeak
+    if _canResetPeak is False:
+        return
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+        _canResetPeak = True
+    except OSError:
+        _canResetPeak = False
+
+
+def _fold_peaks():
+    # Give every open stage the highest marks seen since the last reset
+    rss = _rss_peak()
+    traced = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+    for record in _open:
+        record["_rss"] = max(record["_rss"], rss)
+        if traced is not None:
+            record["_traced"] = max(record["_traced"], traced)
+
+    _reset_rss_peak()
+    if traced is not None:
+        tracemalloc.reset_peak()
+
+
+def image_nbytes(image):
+    """
+    Size of the pixel buffer of a SimpleITK or ITK image in bytes.
+    """
+    if hasattr(image, "GetSizeOfPixelComponent"):
+        return (
+            image.GetNumberOfPixels()
+            * image.GetNumberOfComponentsPerPixel()
+            * image.GetSizeOfPixelComponent()
+        )
+    import itk
+
+    return itk.GetArrayViewFromImage(image).nbytes
+
+
+def path_nbytes(path):
+    """
+    Size of a file, or of all files in a directory, in bytes (0 if missing).
+    """
+    if os.path.isdir(path):
+        return sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(path)
+            for name in names
+        )
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+@contextmanager
+def stage(name, **fields):
+    """
+    Record a stage in the active Instrumentation.
+
+    Parameters
+    ----------
+    name : str
+    **fields
+        Extra fields of the record (file names, host, ...). 'bytes_in'
+        and 'bytes_out' can be given here or set on the yielded record.
+
+    Yields
+    ------
+    record : dict
+        The stage's record; a throwaway dict if nothing is active.
+    """
+    instrumentation = _active
+    # A forked worker process does not record into its parent's
+    # Instrumentation (see note 5)
+    if instrumentation is None or instrumentation._pid != os.getpid():
+        yield dict(fields)
+        return
+
+    record = {"tool": instrumentation.tool, "stage": name, "bytes_in": None, "bytes_out": None}
+    record.update(fields)
+    record.update(_rss=0, _traced=0)
+
+    with _lock:
+        _fold_peaks()
+        _open.append(record)
+
+    record["start"] = time.time()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield record
+    except BaseException as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        record["wall_seconds"] = round(time.perf_counter() - wall, 6)
+        record["cpu_seconds"] = round(time.process_time() - cpu, 6)
+
+        with _lock:
+            _fold_peaks()
+            _open.remove(record)
+
+        record["peak_rss_mb"] = round(record.pop("_rss") / 2**20, 1)
+        traced = record.pop("_traced")
+        if tracemalloc.is_tracing():
+            record["traced_peak_mb"] = round(traced / 2**20, 1)
+
+        instrumentation.add([record])
+
+
+class Instrumentation:
+    """
+    Collects the stage records of a run.
+
+    Parameters
+    ----------
+    tool : str, optional
+        Name of the tool, stored in every record.
+    metricsFile : str, optional
+        File the records are appended to as JSON lines.
+    summary : bool
+        Print a per-stage summary table when the run ends.
+    profile : str, optional
+        File a cProfile profile of the run (main thread) is written to.
+    traceMemory : bool
+        Also record the peak of Python/numpy allocations per stage.
+
+    Use as a context manager around the run: it is active (and stage()
+    records into it) inside the with block.
+    """
+
+    def __init__(self, tool=None, metricsFile=None, summary=False, profile=None, traceMemory=False):
+        self.tool = tool
+        self.metricsFile = metricsFile
+        self.summary = summary
+        self.profile = profile
+        self.traceMemory = traceMemory
+        self.records = []
+
+        self._fp = None
+        self._profiler = None
+        self._previous = None
+        self._pid = None
+        self._recordsLock = threading.Lock()
+
+    @classmethod
+    def from_args(cls, args, tool=None):
+        """
+        Instrumentation set up from the arguments of add_arguments().
+        """
+        return cls(
+            tool=tool,
+            metricsFile=args.metrics,
+            summary=args.metrics_summary,
+            profile=args.profile,
+            traceMemory=args.trace_memory,
+        )
+
+    def add(self, records):
+        """
+        Add finished stage records (e.g. returned by a worker process).
+        """
+        with self._recordsLock:
+            self.records.extend(records)
+            if self._fp is not None:
+                for record in records:
+                    self._fp.write(json.dumps(record) + "\n")
+                self._fp.flush()
+
+    def activate(self):
+        global _active
+        self._previous = _active
+        self._pid = os.getpid()
+        _active = self
+
+        if self.metricsFile is not None and self._fp is None:
+            self._fp = open(self.metricsFile, "a")
+        if self.traceMemory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.profile is not None:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def deactivate(self):
+        global _active
+        _active = self._previous
+
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile)
+            self._profiler = None
+            print(f"Profile written to {self.profile} (view with: python -m pstats {self.profile})")
+        if self.traceMemory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+        if self.summary:
+            print_summary(summarise(self.records))
+
+    def __enter__(self):
+        return self.activate()
+
+    def __exit__(self, *args):
+        self.deactivate()
+        return False
+
+
+def summarise(records):
+    """
+    Totals per stage name, in the order the stages first appear.
+
+    Returns
+    -------
+    summary : list of dict
+        'stage', 'count', 'errors', 'wall_seconds', 'cpu_seconds',
+        'bytes_in', 'bytes_out', 'mb_per_s' (of the bytes out, or in if
+        there are none) and 'peak_rss_mb' (the largest of any record).
+    """
+    stages = {}
+    for record in records:
+        total = stages.setdefault(record["stage"], {
+            "stage": record["stage"],
+            "count": 0,
+            "errors": 0,
+            "wall_seconds": 0.0,
+            "cpu_seconds": 0.0,
+            "bytes_in": 0,
+            "bytes_out": 0,
+            "peak_rss_mb": 0.0,
+        })
+        total["count"] += 1
+        total["errors"] += "error" in record
+        total["wall_seconds"] += record["wall_seconds"]
+        total["cpu_seconds"] += record["cpu_seconds"]
+        total["bytes_in"] += record.get("bytes_in") or 0
+        total["bytes_out"] += record.get("bytes_out") or 0
+        total["peak_rss_mb"] = max(total["peak_rss_mb"], record["peak_rss_mb"])
+
+    for total in stages.values():
+        nbytes = total["bytes_out"] or total["bytes_in"]
+        total["mb_per_s"] = round(nbytes / 1e6 / total["wall_seconds"], 2) if total["wall_seconds"] > 0 else None
+        total["wall_seconds"] = round(total["wall_seconds"], 3)
+        total["cpu_seconds"] = round(total["cpu_seconds"], 3)
+
+    return list(stages.values())
+
+
+def print_summary(summary):
+    """
+    Print the table returned by summarise().
+    """
+    print()
+    print(
+        f"{'stage':<14} {'count':>6} {'errors':>6} {'wall s':>9} {'cpu s':>9} "
+        f"{'MB in':>9} {'MB out':>9} {'MB/s':>8} {'peak MB':>8}"
+    )
+    for total in summary:
+        mbPerS = f"{total['mb_per_s']:.1f}" if total["mb_per_s"] is not None else "-"
+        print(
+            f"{total['stage']:<14} {total['count']:>6} {total['errors']:>6} "
+            f"{total['wall_seconds']:>9.2f} {total['cpu_seconds']:>9.2f} "
+            f"{total['bytes_in'] / 1e6:>9.1f} {total['bytes_out'] / 1e6:>9.1f} "
+            f"{mbPerS:>8} {total['peak_rss_mb']:>8.0f}"
+        )
+
+
+def add_arguments(parser):
+    """
+    Add the instrumentation options to an argparse parser.
+    """
+    group = parser.add_argument_group("instrumentation")
+    group.add_argument(
+        "--metrics", type=str, default=None, help="Append per-stage measurements to this file (JSON lines)"
+    )
+    group.add_argument(
+        "--metrics-summary", action="store_true", help="Print a per-stage timing/memory summary"
+    )
+    group.add_argument(
+        "--profile", type=str, default=None, help="Write a cProfile profile of the run to this file"
+    )
+    group.add_argument(
+        "--trace-memory", action="store_true", help="Record Python/numpy allocation peaks per stage (slow)"
+    )
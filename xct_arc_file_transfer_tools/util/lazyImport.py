@@ -0,0 +1,64 @@
+"""
+lazyImport.py
+
+Description: Defers importing heavy imaging backends (itk, vtk, SimpleITK)
+             until they are first used. Importing itk or vtk alone takes
+             about a second, which every CLI run used to pay even when the
+             chosen conversion never touches them.
+
+Notes:
+1. importlib.util.LazyLoader cannot be used here: itk replaces its own
+   entry in sys.modules while it is being imported. LazyModule instead
+   imports the real module with importlib on the first attribute access
+   and forwards every attribute lookup to it.
+"""
+
+import sys
+import types
+import importlib
+
+
+class LazyModule(types.ModuleType):
+    """
+    Placeholder for a module that is imported on first attribute access.
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self.__name__)
+        return self._module
+
+    def __getattr__(self, attr):
+        # Only called for attributes not found on the placeholder itself
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self.__name__}' ({state})>"
+
+
+def lazy_import(name):
+    """
+    Return a module that is only imported when it is first used.
+
+    Parameters
+    ----------
+    name : str
+        Absolute module name, e.g. 'itk' or 'vtk.util.numpy_support'.
+
+    Returns
+    -------
+    module : module or LazyModule
+        The module itself if it has already been imported.
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return LazyModule(name)
@@ -0,0 +1,334 @@
+"""
+manifest.py
+
+Description: Reads and validates pull request manifests and keeps track of
+             which of their stacks have been fetched, converted, uploaded
+             and verified.
+
+             A manifest has one line per subject:
+                 <Study_ID> <Sample_#> <DST1> <MID1> <PRX1> ... <DSTN> <MIDN> <PRXN>
+             i.e. three measurement numbers (DST, MID, PRX) per timepoint.
+             Every stack (study, timepoint, DST/MID/PRX) is one job.
+
+Notes:
+1. Lines are validated as they are read: a line without a sample number,
+   with no measurements, with a measurement count that is not a multiple
+   of three, or with a sample or measurement number that is not a number
+   is skipped (and reported). Blank lines and lines starting with '#' are
+   ignored. A study listed twice (even with another sample number) keeps
+   its last line; the earlier line is reported as replaced.
+
+2. JobDB is an SQLite database with one row per job and a timestamp for
+   every state it reached (fetched, converted, uploaded, verified). A tool
+   syncs the manifest into it and only processes the jobs that have not
+   reached its state yet, so rerunning a large manifest after adding a
+   few subjects only touches the new stacks. Syncing a job whose
+   measurement number changed resets its states.
+
+3. Resetting a state also resets the states after it (fetched ->
+   converted -> uploaded -> verified): an image fetched again has to be
+   converted and uploaded again too.
+"""
+
+import os
+import time
+import sqlite3
+import contextlib
+
+from collections import namedtuple
+
+
+STACKS = ("DST", "MID", "PRX")
+STATES = ("fetched", "converted", "uploaded", "verified")
+
+# One subject line of a manifest; measurements holds one (DST, MID, PRX)
+# tuple per timepoint
+ManifestRow = namedtuple("ManifestRow", ["study_id", "sample", "measurements", "line_num"])
+
+# One stack
+Job = namedtuple("Job", ["study_id", "sample", "timepoint", "stack", "measurement"])
+
+
+def _validate(entry):
+    # Reason the fields of a line are not a valid row, or None
+    if len(entry) < 2:
+        return "expected '<Study_ID> <Sample_#> <DST> <MID> <PRX> ...'"
+    if not entry[1].isdigit():
+        return f"sample number {entry[1]} is not a number"
+
+    isqs = entry[2:]
+    if not isqs:
+        return "no measurement numbers"
+    if len(isqs) % 3:
+        return f"{len(isqs)} measurement numbers, expected three (DST MID PRX) per timepoint"
+    for measurement in isqs:
+        if not measurement.isdigit():
+            return f"measurement number {measurement} is not a number"
+    return None
+
+
+def iter_manifest(lines, errors=None):
+    """
+    Read and validate manifest lines one at a time.
+
+    Parameters
+    ----------
+    lines : iterable of str
+        E.g. an open manifest file.
+    errors : list, optional
+        (line number, line, reason) of every skipped line is appended to
+        it. If None, skipped lines are printed instead.
+
+    Yields
+    ------
+    row : ManifestRow
+    """
+    for line_num, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+
+        entry = line.split()
+        reason = _validate(entry)
+        if reason is not None:
+            if errors is None:
+                print(f"Skipped line {line_num} ({entry[0]}): {reason}")
+            else:
+                errors.append((line_num, line, reason))
+            continue
+
+        isqs = entry[2:]
+        measurements = [tuple(isqs[idx:idx + 3]) for idx in range(0, len(isqs), 3)]
+        yield ManifestRow(entry[0], entry[1], measurements, line_num)
+
+
+def parse_txt(data, errors=None):
+    """
+    Read a manifest into a dictionary.
+
+    Parameters
+    ----------
+    data : iterable of str
+        Manifest lines.
+    errors : list, optional
+        See iter_manifest().
+
+    Returns
+    -------
+    data_dict : dict
+        (Study_ID, Sample_#) -> list of [DST, MID, PRX] measurement numbers,
+        one per timepoint.
+    """
+    data_dict = {}
+    # Study_ID -> (key in data_dict, line number)
+    studies = {}
+    for row in iter_manifest(data, errors):
+        # Jobs are keyed on the study, so only its last line is kept (in
+        # the position of that line)
+        if row.study_id in studies:
+            key, lineNum = studies[row.study_id]
+            reason = f"study listed again on line {row.line_num}, that line is used"
+            if errors is None:
+                print(f"Skipped line {lineNum} ({row.study_id}): {reason}")
+            else:
+                line = " ".join(list(key) + [m for image in data_dict[key] for m in image])
+                errors.append((lineNum, line, reason))
+            del data_dict[key]
+
+        key = (row.study_id, row.sample)
+        data_dict[key] = [list(m) for m in row.measurements]
+        studies[row.study_id] = (key, row.line_num)
+    return data_dict
+
+
+def expand_jobs(data_dict):
+    """
+    One Job per stack of a parsed manifest, in manifest order.
+    """
+    jobs = []
+    for (study_id, sample), measurements in data_dict.items():
+        for timepoint, image in enumerate(measurements):
+            for stack, measurement in zip(STACKS, image):
+                jobs.append(Job(study_id, sample, timepoint, stack, measurement))
+    return jobs
+
+
+def job_key(job):
+    """
+    (study, timepoint, stack) identifying a job.
+    """
+    return (job.study_id, job.timepoint, job.stack)
+
+
+class JobDB:
+    """
+    Persistent state of the jobs of one or more manifests.
+
+    Parameters
+    ----------
+    path : str
+        SQLite database file (created if missing).
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "study_id TEXT, timepoint INTEGER, stack TEXT, sample TEXT, measurement TEXT, "
+                + ", ".join(f"{state} REAL" for state in STATES)
+                + ", error TEXT, updated REAL, "
+                "PRIMARY KEY (study_id, timepoint, stack))"
+            )
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=60)
+        try:
+            # Commits on success, rolls back on error
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def sync(self, jobs):
+        """
+        Add new jobs; reset jobs whose sample or measurement changed.
+
+        Returns
+        -------
+        counts : dict
+            'new', 'changed' and 'unchanged' jobs.
+        """
+        jobs = list(jobs)
+        now = time.time()
+
+        with self._connect() as db:
+            known = {
+                (row[0], row[1], row[2]): (row[3], row[4])
+                for row in db.execute("SELECT study_id, timepoint, stack, sample, measurement FROM jobs")
+            }
+
+            new = [job for job in jobs if job_key(job) not in known]
+            changed = [
+                job for job in jobs
+                if job_key(job) in known and known[job_key(job)] != (job.sample, job.measurement)
+            ]
+
+            db.executemany(
+                "INSERT INTO jobs (study_id, timepoint, stack, sample, measurement, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [job_key(job) + (job.sample, job.measurement, now) for job in new],
+            )
+            db.executemany(
+                "UPDATE jobs SET sample = ?, measurement = ?, "
+                + ", ".join(f"{state} = NULL" for state in STATES)
+                + ", error = NULL, updated = ? WHERE study_id = ? AND timepoint = ? AND stack = ?",
+                [(job.sample, job.measurement, now) + job_key(job) for job in changed],
+            )
+
+        return {"new": len(new), "changed": len(changed), "unchanged": len(jobs) - len(new) - len(changed)}
+
+    def pending(self, state, jobs=None):
+        """
+        Jobs that have not reached a state.
+
+        Parameters
+        ----------
+        state : str
+            One of STATES.
+        jobs : list of Job, optional
+            Only consider these jobs (e.g. those of the current manifest).
+
+        Returns
+        -------
+        keys : set
+            job_key() of every pending job.
+        """
+        if state not in STATES:
+            raise ValueError(f"Unknown job state {state} (use {', '.join(STATES)})")
+
+        with self._connect() as db:
+            keys = {
+                (row[0], row[1], row[2])
+                for row in db.execute(f"SELECT study_id, timepoint, stack FROM jobs WHERE {state} IS NULL")
+            }
+
+        if jobs is not None:
+            keys &= {job_key(job) for job in jobs}
+        return keys
+
+    def mark(self, keys, state, error=None):
+        """
+        Record that jobs reached a state (or, with error, that they failed to).
+        """
+        if state not in STATES:
+            raise ValueError(f"Unknown job state {state} (use {', '.join(STATES)})")
+
+        now = time.time()
+        with self._connect() as db:
+            if error is None:
+                db.executemany(
+                    f"UPDATE jobs SET {state} = ?, error = NULL, updated = ? "
+                    "WHERE study_id = ? AND timepoint = ? AND stack = ?",
+                    [(now, now) + tuple(key) for key in keys],
+                )
+            else:
+                db.executemany(
+                    "UPDATE jobs SET error = ?, updated = ? WHERE study_id = ? AND timepoint = ? AND stack = ?",
+                    [(f"{state}: {error}", now) + tuple(key) for key in keys],
+                )
+
+    def reset(self, state, keys=None):
+        """
+        Clear a state and the states after it, for some jobs or all of them.
+
+        Returns
+        -------
+        count : int
+            Number of jobs reset.
+        """
+        if state not in STATES:
+            raise ValueError(f"Unknown job state {state} (use {', '.join(STATES)})")
+
+        assignments = ", ".join(f"{s} = NULL" for s in STATES[STATES.index(state):])
+        now = time.time()
+        with self._connect() as db:
+            if keys is None:
+                return db.execute(f"UPDATE jobs SET {assignments}, updated = ?", (now,)).rowcount
+
+            count = 0
+            for key in keys:
+                count += db.execute(
+                    f"UPDATE jobs SET {assignments}, updated = ? "
+                    "WHERE study_id = ? AND timepoint = ? AND stack = ?",
+                    (now,) + tuple(key),
+                ).rowcount
+            return count
+
+    def counts(self):
+        """
+        Number of jobs in total, in every state and with an error.
+        """
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT COUNT(*), "
+                + ", ".join(f"COUNT({state})" for state in STATES)
+                + ", COUNT(error) FROM jobs"
+            ).fetchone()
+
+        return dict(zip(("total",) + STATES + ("errors",), row))
+
+    def errors(self):
+        """
+        (study, timepoint, stack, error) of every job whose last attempt failed.
+        """
+        with self._connect() as db:
+            return db.execute(
+                "SELECT study_id, timepoint, stack, error FROM jobs WHERE error IS NOT NULL "
+                "ORDER BY study_id, timepoint, stack"
+            ).fetchall()
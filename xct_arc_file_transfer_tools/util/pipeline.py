@@ -0,0 +1,249 @@
+"""
+pipeline.py
+
+Description: Runs items through a chain of stages (e.g. fetch -> convert ->
+             upload) concurrently. Every stage has its own worker threads
+             and stages are connected by bounded queues, so a fast stage
+             waits for a slow one instead of piling up work.
+
+Notes:
+1. A stage function takes an item and returns it (possibly updated) for the
+   next stage, or None to drop it. An exception (from the function or the
+   stage's gate) marks the item as failed at that stage; it is not passed
+   on.
+
+2. A ScratchBudget can be shared by the stage functions to bound the local
+   disk used by items in flight: a stage that creates files waits in
+   reserve() until enough earlier files have been released.
+
+3. run() returns per-stage statistics: busy time, time blocked (on the
+   stage's gate or a full downstream queue), and utilisation (busy time /
+   (workers x wall time)).
+"""
+
+import time
+import queue
+import shutil
+import threading
+
+
+_DONE = object()
+
+
+class Stage:
+    """
+    One stage of a pipeline.
+
+    Parameters
+    ----------
+    name : str
+    func : callable
+        func(item) -> item or None
+    workers : int
+        Number of worker threads.
+    gate : callable, optional
+        gate(item) is called before func and may block (e.g.
+        ScratchBudget.reserve); the time spent in it counts as blocked,
+        not busy.
+    """
+
+    def __init__(self, name, func, workers=1, gate=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.gate = gate
+
+
+class ScratchBudget:
+    """
+    Bound on the bytes of scratch disk used by items in flight.
+
+    Parameters
+    ----------
+    maxBytes : int, optional
+        Bytes allowed in use at once. No limit if None.
+    directory : str, optional
+        Scratch directory. If given with minFreeBytes, reserve() also waits
+        while the file system has less than minFreeBytes free.
+    minFreeBytes : int
+    """
+
+    def __init__(self, maxBytes=None, directory=None, minFreeBytes=0):
+        self.maxBytes = maxBytes
+        self.directory = directory
+        self.minFreeBytes = minFreeBytes
+        self.used = 0
+
+        self._condition = threading.Condition()
+
+    def _fits(self, nbytes):
+        if self.used == 0:
+            # Always let one item through, however large
+            return True
+        if self.maxBytes is not None and self.used + nbytes > self.maxBytes:
+            return False
+        if self.directory is not None and self.minFreeBytes:
+            return shutil.disk_usage(self.directory).free - nbytes >= self.minFreeBytes
+        return True
+
+    def reserve(self, nbytes=0):
+        """
+        Wait until nbytes more fit in the budget, then take them.
+        """
+        with self._condition:
+            # Free space is polled, since other programs can release it too
+            while not self._fits(nbytes):
+                self._condition.wait(timeout=5.0)
+            self.used += nbytes
+
+    def adjust(self, nbytes):
+        """
+        Take (nbytes > 0) or release (nbytes < 0) bytes without waiting.
+        """
+        with self._condition:
+            self.used = max(self.used + nbytes, 0)
+            self._condition.notify_all()
+
+    def release(self, nbytes):
+        self.adjust(-nbytes)
+
+
+class Pipeline:
+    """
+    Chain of stages connected by bounded queues.
+
+    Parameters
+    ----------
+    stages : list of Stage
+    queueSize : int
+        Capacity of each queue between stages.
+    """
+
+    def __init__(self, stages, queueSize=2):
+        self.stages = stages
+        self.queueSize = queueSize
+
+    def run(self, items):
+        """
+        Run items through every stage.
+
+        Returns
+        -------
+        results : list of dict
+            One record per item, in order: 'item' (as returned by the last
+            stage it went through), 'status' ('ok', 'dropped' or 'error'),
+            'stage' (where it failed or was dropped) and 'error'.
+        stats : list of dict
+            Per stage: 'stage', 'workers', 'items', 'failed', 'busy_seconds',
+            'blocked_seconds' and 'utilisation'.
+        wall : float
+            Wall time of the whole run (seconds).
+        """
+        items = list(items)
+        queues = [queue.Queue(maxsize=self.queueSize) for _ in self.stages]
+        results = [None] * len(items)
+        stats = [
+            {
+                "stage": stage.name,
+                "workers": stage.workers,
+                "items": 0,
+                "failed": 0,
+                "busy_seconds": 0.0,
+                "blocked_seconds": 0.0,
+            }
+            for stage in self.stages
+        ]
+        remaining = [stage.workers for stage in self.stages]
+        lock = threading.Lock()
+
+        def worker(s):
+            stage = self.stages[s]
+            while True:
+                entry = queues[s].get()
+                if entry is _DONE:
+                    break
+                idx, item = entry
+
+                busy = 0.0
+                try:
+                    if stage.gate is not None:
+                        start = time.perf_counter()
+                        try:
+                            stage.gate(item)
+                        finally:
+                            with lock:
+                                stats[s]["blocked_seconds"] += time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    try:
+                        item = stage.func(item)
+                    finally:
+                        busy = time.perf_counter() - start
+                    error = None
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+
+                with lock:
+                    stats[s]["items"] += 1
+                    stats[s]["busy_seconds"] += busy
+                    if error is not None:
+                        stats[s]["failed"] += 1
+
+                if error is not None:
+                    results[idx] = {"item": entry[1], "status": "error", "stage": stage.name, "error": error}
+                elif item is None:
+                    results[idx] = {"item": entry[1], "status": "dropped", "stage": stage.name, "error": None}
+                elif s + 1 == len(self.stages):
+                    results[idx] = {"item": item, "status": "ok", "stage": None, "error": None}
+                else:
+                    start = time.perf_counter()
+                    queues[s + 1].put((idx, item))
+                    with lock:
+                        stats[s]["blocked_seconds"] += time.perf_counter() - start
+
+            # The last worker of a stage to finish closes the next stage
+            with lock:
+                remaining[s] -= 1
+                last = remaining[s] == 0
+            if last and s + 1 < len(self.stages):
+                for _ in range(self.stages[s + 1].workers):
+                    queues[s + 1].put(_DONE)
+
+        threads = [
+            threading.Thread(target=worker, args=(s,), daemon=True)
+            for s, stage in enumerate(self.stages)
+            for _ in range(stage.workers)
+        ]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+
+        for idx, item in enumerate(items):
+            queues[0].put((idx, item))
+        for _ in range(self.stages[0].workers):
+            queues[0].put(_DONE)
+
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - start
+
+        for stat in stats:
+            stat["busy_seconds"] = round(stat["busy_seconds"], 3)
+            stat["blocked_seconds"] = round(stat["blocked_seconds"], 3)
+            stat["utilisation"] = round(stat["busy_seconds"] / (stat["workers"] * wall), 3) if wall > 0 else 0.0
+
+        return results, stats, wall
+
+
+def print_stage_report(stats, wall):
+    """
+    Print the per-stage statistics returned by Pipeline.run().
+    """
+    print(f"{'stage':<10} {'workers':>7} {'items':>6} {'failed':>6} {'busy s':>9} {'blocked s':>9} {'util':>6}")
+    for stat in stats:
+        print(
+            f"{stat['stage']:<10} {stat['workers']:>7} {stat['items']:>6} {stat['failed']:>6} "
+            f"{stat['busy_seconds']:>9.1f} {stat['blocked_seconds']:>9.1f} {100 * stat['utilisation']:>5.0f}%"
+        )
+    print(f"Total wall time: {wall:.1f} s")
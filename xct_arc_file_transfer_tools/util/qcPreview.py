@@ -0,0 +1,312 @@
+"""
+qcPreview.py
+
+Description: Builds quality control previews of a 3D image from the slabs
+             a conversion already has in memory: the three orthogonal
+             mid-slices, maximum intensity projections (MIPs) along each
+             axis, an intensity histogram and basic statistics. Used by
+             fileConverter's --qc so that QC needs no second read of the
+             output.
+
+Notes:
+1. The previews are written next to the output, in <name>_qc/:
+       axial.png, coronal.png, sagittal.png            mid-slices
+       mip_axial.png, mip_coronal.png, mip_sagittal.png MIPs
+       histogram.png                                    log-count histogram
+       stats.json       size, spacing, pixel type, min, max, mean, std,
+                        percentiles and the histogram counts
+   The PNGs are 8-bit grayscale, windowed to the 0.5-99.5th percentile
+   (the MIPs up to the maximum), with z pointing up and the z axis
+   stretched to the in-plane pixel size.
+
+2. QCAccumulator takes the slabs in order and only keeps the mid-slices,
+   the MIPs and a histogram. For 8- and 16-bit integer images the
+   histogram counts every value, so the statistics and percentiles are
+   exact; for other types every slab is binned into 1024 bins over its
+   own range and the percentiles are approximate.
+"""
+
+import os
+import json
+import zlib
+import struct
+
+import numpy as np
+
+from .lazyImport import lazy_import
+
+sitk = lazy_import("SimpleITK")
+
+
+QC_FILES = (
+    "axial.png",
+    "coronal.png",
+    "sagittal.png",
+    "mip_axial.png",
+    "mip_coronal.png",
+    "mip_sagittal.png",
+    "histogram.png",
+    "stats.json",
+)
+
+# Bins of the histogram in stats.json and histogram.png
+HISTOGRAM_BINS = 256
+
+# Bins per slab for types whose values are not counted one by one
+SLAB_BINS = 1024
+
+PERCENTILES = (0.5, 1, 5, 25, 50, 75, 95, 99, 99.5)
+
+
+def qc_directory(outputImage):
+    """
+    Directory the previews of an output image are written to.
+    """
+    name = os.path.basename(outputImage.rstrip(os.sep))
+    return os.path.join(os.path.dirname(outputImage.rstrip(os.sep)), name.split(".", 1)[0] + "_qc")
+
+
+def qc_files(outputImage):
+    """
+    Files written for the previews of an output image.
+    """
+    directory = qc_directory(outputImage)
+    return [os.path.join(directory, name) for name in QC_FILES]
+
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def write_png(fileName, array):
+    """
+    Write a 2D uint8 array as a grayscale PNG.
+    """
+    array = np.ascontiguousarray(array, dtype=np.uint8)
+    height, width = array.shape
+    # Filter type 0 (none) in front of every row
+    rows = np.hstack([np.zeros((height, 1), dtype=np.uint8), array])
+    with open(fileName, "wb") as fp:
+        fp.write(b"\x89PNG\r\n\x1a\n")
+        fp.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)))
+        fp.write(_png_chunk(b"IDAT", zlib.compress(rows.tobytes(), 6)))
+        fp.write(_png_chunk(b"IEND", b""))
+
+
+def _window(array, low, high):
+    # Map [low, high] to 0..255
+    scale = 255.0 / (high - low) if high > low else 0.0
+    return np.clip((array.astype(np.float64) - low) * scale, 0, 255).astype(np.uint8)
+
+
+def _stretch_z(array, zSpacing, inPlaneSpacing):
+    # Repeat the rows of a (z, n) image so that a row is as high as a
+    # pixel is wide, and put z = 0 at the bottom
+    rows = max(1, int(round(array.shape[0] * zSpacing / inPlaneSpacing)))
+    index = np.minimum((np.arange(rows) * array.shape[0]) // rows, array.shape[0] - 1)
+    return array[index][::-1]
+
+
+def _histogram_png(edges, counts, width=HISTOGRAM_BINS, height=128):
+    # Bars of log(1 + count), white on black
+    heights = np.log1p(counts)
+    if heights.max() > 0:
+        heights = np.round(heights / heights.max() * height).astype(int)
+    else:
+        heights = np.zeros(len(counts), dtype=int)
+    image = np.zeros((height, width), dtype=np.uint8)
+    columns = (np.arange(width) * len(counts)) // width
+    for x, column in enumerate(columns):
+        if heights[column]:
+            image[height - heights[column]:, x] = 255
+    return image
+
+
+class QCAccumulator:
+    """
+    Collect the previews of a 3D image one z-slab at a time.
+
+    Parameters
+    ----------
+    size : sequence of int
+        Image size (x, y, z).
+    spacing : sequence of float
+    dtype : numpy.dtype
+    """
+
+    def __init__(self, size, spacing, dtype):
+        self.size = tuple(int(n) for n in size)
+        self.spacing = tuple(float(s) for s in spacing)
+        self.dtype = np.dtype(dtype)
+        self.slicesAdded = 0
+
+        x, y, z = self.size
+        self.axial = None
+        self.coronal = np.zeros((z, x), dtype=self.dtype)
+        self.sagittal = np.zeros((z, y), dtype=self.dtype)
+        self.mipAxial = None
+        self.mipCoronal = np.zeros((z, x), dtype=self.dtype)
+        self.mipSagittal = np.zeros((z, y), dtype=self.dtype)
+
+        # Every value is counted for 8- and 16-bit integers
+        self.exact = np.issubdtype(self.dtype, np.integer) and self.dtype.itemsize <= 2
+        if self.exact:
+            self.offset = int(np.iinfo(self.dtype).min)
+            self.counts = np.zeros(2 ** (8 * self.dtype.itemsize), dtype=np.int64)
+            # Flipping the sign bit of the unsigned view maps signed values
+            # to value - minimum without a wider copy
+            self.unsigned = np.dtype(f"u{self.dtype.itemsize}")
+            self.signBit = -self.offset
+        else:
+            self.binValues = []
+            self.binCounts = []
+            self.total = 0.0
+            self.totalSquares = 0.0
+            self.minimum, self.maximum = np.inf, -np.inf
+
+    def add_slab(self, slab):
+        """
+        Add the next slab, of shape (slices, y, x).
+        """
+        slab = np.asarray(slab)
+        if slab.ndim == 2:
+            slab = slab[np.newaxis]
+        z0, z1 = self.slicesAdded, self.slicesAdded + slab.shape[0]
+        if z1 > self.size[2]:
+            raise ValueError("More slices added than the image holds")
+        x, y, z = self.size
+
+        if z0 <= z // 2 < z1:
+            self.axial = slab[z // 2 - z0].copy()
+        self.coronal[z0:z1] = slab[:, y // 2, :]
+        self.sagittal[z0:z1] = slab[:, :, x // 2]
+
+        slabMip = slab.max(axis=0)
+        self.mipAxial = slabMip if self.mipAxial is None else np.maximum(self.mipAxial, slabMip)
+        self.mipCoronal[z0:z1] = slab.max(axis=1)
+        self.mipSagittal[z0:z1] = slab.max(axis=2)
+
+        if self.exact:
+            # One slice at a time keeps bincount's intp copy small
+            for image in slab:
+                index = np.ascontiguousarray(image).ravel().view(self.unsigned)
+                if self.signBit:
+                    index = index ^ self.unsigned.type(self.signBit)
+                self.counts += np.bincount(index, minlength=len(self.counts))
+        else:
+            values = slab.astype(np.float64, copy=False)
+            low, high = float(values.min()), float(values.max())
+            self.minimum, self.maximum = min(self.minimum, low), max(self.maximum, high)
+            counts, edges = np.histogram(values, SLAB_BINS, range=(low, high))
+            keep = counts > 0
+            self.binValues.append(((edges[:-1] + edges[1:]) / 2)[keep])
+            self.binCounts.append(counts[keep])
+            self.total += values.sum()
+            self.totalSquares += np.vdot(values, values)
+
+        self.slicesAdded = z1
+
+    def add_image(self, image, slabSize=64):
+        """
+        Add a whole SimpleITK image, one slab of its pixel buffer at a time.
+        """
+        # View of the pixel buffer, (z, y, x) ordered
+        array = sitk.GetArrayViewFromImage(image)
+        for z in range(0, array.shape[0], slabSize):
+            self.add_slab(array[z:z + slabSize])
+
+    def stats(self):
+        """
+        Statistics and histogram of every slice added so far.
+        """
+        if self.exact:
+            nonzero = np.flatnonzero(self.counts)
+            values = (nonzero + self.offset).astype(np.float64)
+            counts = self.counts[nonzero]
+            count = int(counts.sum())
+            mean = float(np.dot(values, counts) / count) if count else 0.0
+            variance = float(np.dot((values - mean) ** 2, counts) / count) if count else 0.0
+            minimum = float(values[0]) if count else 0.0
+            maximum = float(values[-1]) if count else 0.0
+        else:
+            values = np.concatenate(self.binValues) if self.binValues else np.zeros(0)
+            counts = np.concatenate(self.binCounts) if self.binCounts else np.zeros(0, dtype=np.int64)
+            order = np.argsort(values, kind="stable")
+            values, counts = values[order], counts[order]
+            count = int(counts.sum())
+            mean = self.total / count if count else 0.0
+            variance = max(self.totalSquares / count - mean ** 2, 0.0) if count else 0.0
+            minimum = self.minimum if count else 0.0
+            maximum = self.maximum if count else 0.0
+
+        cumulative = np.cumsum(counts)
+        percentiles = {}
+        for p in PERCENTILES:
+            index = np.searchsorted(cumulative, p / 100 * count) if count else 0
+            percentiles[str(p)] = float(values[min(index, len(values) - 1)]) if count else 0.0
+
+        histogram, edges = np.histogram(values, HISTOGRAM_BINS, range=(minimum, maximum), weights=counts)
+
+        return {
+            "size": list(self.size),
+            "spacing": list(self.spacing),
+            "pixel_type": self.dtype.name,
+            "voxels": count,
+            "min": minimum,
+            "max": maximum,
+            "mean": mean,
+            "std": variance ** 0.5,
+            "percentiles": percentiles,
+            "histogram": {"edges": edges.tolist(), "counts": histogram.astype(np.int64).tolist()},
+        }
+
+    def write(self, directory):
+        """
+        Write the previews (see QC_FILES) to a directory.
+
+        Returns
+        -------
+        stats : dict
+            The contents of stats.json.
+        """
+        if self.slicesAdded != self.size[2]:
+            raise ValueError(f"Only {self.slicesAdded} of {self.size[2]} slices were added")
+        os.makedirs(directory, exist_ok=True)
+
+        stats = self.stats()
+        low, high = stats["percentiles"]["0.5"], stats["percentiles"]["99.5"]
+        xSpacing, ySpacing, zSpacing = self.spacing
+
+        write_png(os.path.join(directory, "axial.png"), _window(self.axial, low, high))
+        write_png(os.path.join(directory, "coronal.png"),
+                  _window(_stretch_z(self.coronal, zSpacing, xSpacing), low, high))
+        write_png(os.path.join(directory, "sagittal.png"),
+                  _window(_stretch_z(self.sagittal, zSpacing, ySpacing), low, high))
+        write_png(os.path.join(directory, "mip_axial.png"), _window(self.mipAxial, low, stats["max"]))
+        write_png(os.path.join(directory, "mip_coronal.png"),
+                  _window(_stretch_z(self.mipCoronal, zSpacing, xSpacing), low, stats["max"]))
+        write_png(os.path.join(directory, "mip_sagittal.png"),
+                  _window(_stretch_z(self.mipSagittal, zSpacing, ySpacing), low, stats["max"]))
+        write_png(os.path.join(directory, "histogram.png"),
+                  _histogram_png(stats["histogram"]["edges"], np.array(stats["histogram"]["counts"])))
+
+        with open(os.path.join(directory, "stats.json"), "w") as fp:
+            json.dump(stats, fp, indent=2)
+
+        return stats
+
+
+def write_qc(image, outputImage, slabSize=64):
+    """
+    Write the previews of a SimpleITK image next to an output image.
+
+    Returns
+    -------
+    directory : str
+        The <name>_qc directory written to.
+    """
+    accumulator = QCAccumulator(image.GetSize(), image.GetSpacing(), sitk.GetArrayViewFromImage(image).dtype)
+    accumulator.add_image(image, slabSize)
+    directory = qc_directory(outputImage)
+    accumulator.write(directory)
+    return directory
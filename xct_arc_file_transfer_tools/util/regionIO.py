@@ -0,0 +1,343 @@
+"""
+regionIO.py
+
+Description: Reads a region of interest (a sub-volume) of a 3D image
+             without reading the rest of it. Uncompressed Scanco (AIM/ISQ),
+             MHA/MHD, NRRD and NIfTI files are memory-mapped, so only the
+             bytes of the rows inside the region are read from disk. Used
+             by fileConverter's --roi and --slices.
+
+Notes:
+1. A RegionOfInterest holds a bounding box (x0 y0 x1 y1, or x0 y0 z0 x1 y1
+   z1) and/or a slice range (z0 z1). As indices, the lower bound is
+   included and the upper bound is not, like a Python slice. As physical
+   coordinates (mm), every voxel whose centre lies inside the box is kept;
+   for rotated images the box is taken in physical space and the voxels
+   of its bounding box in index space are kept. The slice range is always
+   in slice indices and takes precedence over the z bounds of the box.
+   The region is clipped to the image; an empty region is an error.
+
+2. The origin of the sub-volume is the physical position of its first
+   voxel, origin + direction * (start * spacing), so it overlays the
+   full image.
+
+3. Geometry (size, spacing, origin, direction, pixel type) of MHA/MHD,
+   NRRD and NIfTI files is taken from SimpleITK's header-only read, so it
+   matches what sitk.ReadImage() returns; only the position and byte order
+   of the voxel data are parsed here. Compressed data, detached data split
+   over several files, multi-component images and NIfTI files with a
+   rescale slope/intercept cannot be memory-mapped: raw_layout() returns
+   None and the caller falls back to a full read and a crop.
+"""
+
+import os
+import math
+import struct
+
+from collections import namedtuple
+
+import numpy as np
+
+from .lazyImport import lazy_import
+from .scancoIO import read_scanco_header
+
+sitk = lazy_import("SimpleITK")
+pixelTypes = lazy_import(__package__ + ".sitkDataTypes")
+
+
+# bounds: 4 or 6 numbers (see Note 1) or None; slices: (z0, z1) or None;
+# physical: bounds are in mm instead of voxel indices
+RegionOfInterest = namedtuple("RegionOfInterest", ["bounds", "slices", "physical"])
+
+
+def roi_region(roi, size, spacing=(1.0, 1.0, 1.0), origin=(0.0, 0.0, 0.0), direction=None):
+    """
+    Voxel region of an image covered by a RegionOfInterest.
+
+    Parameters
+    ----------
+    roi : RegionOfInterest
+    size, spacing, origin : sequence
+        Geometry of the image (x, y, z).
+    direction : sequence of float, optional
+        Row-major 3x3 direction matrix (identity by default).
+
+    Returns
+    -------
+    start, size : tuple of int
+        Region (x, y, z), clipped to the image.
+
+    Raises
+    ------
+    ValueError
+        If the bounds are malformed or the region is empty.
+    """
+    size = [int(n) for n in size]
+    lower, upper = [0, 0, 0], list(size)
+
+    if roi.bounds is not None:
+        bounds = [float(v) for v in roi.bounds]
+        if len(bounds) == 4:
+            low, high = bounds[:2], bounds[2:]
+        elif len(bounds) == 6:
+            low, high = bounds[:3], bounds[3:]
+        else:
+            raise ValueError(f"A region needs 4 (x0 y0 x1 y1) or 6 (x0 y0 z0 x1 y1 z1) bounds, not {len(bounds)}")
+        axes = len(low)
+
+        if roi.physical:
+            # Voxel indices of the corners of the box
+            matrix = np.reshape(direction if direction is not None else np.eye(3).ravel(), (3, 3)) * spacing
+            inverse = np.linalg.inv(matrix)
+            if axes == 2:
+                # z over the whole image
+                extent = np.array([
+                    [i, j, k] for i in (0, size[0] - 1) for j in (0, size[1] - 1) for k in (0, size[2] - 1)
+                ])
+                zs = extent @ matrix[2] + origin[2]
+                low, high = low + [zs.min()], high + [zs.max()]
+            corners = np.array([
+                [(low, high)[i][0], (low, high)[j][1], (low, high)[k][2]]
+                for i in (0, 1) for j in (0, 1) for k in (0, 1)
+            ])
+            indices = (corners - np.asarray(origin, dtype=float)) @ inverse.T
+            first, last = indices.min(axis=0), indices.max(axis=0)
+            for axis in range(axes):
+                # Voxels whose centre is inside [first, last]
+                lower[axis] = max(lower[axis], math.ceil(first[axis] - 1e-6))
+                upper[axis] = min(upper[axis], math.floor(last[axis] + 1e-6) + 1)
+        else:
+            for axis in range(axes):
+                if low[axis] != int(low[axis]) or high[axis] != int(high[axis]):
+                    raise ValueError(f"Index bounds must be whole numbers, not {low[axis]} and {high[axis]}")
+                lower[axis] = max(lower[axis], int(low[axis]))
+                upper[axis] = min(upper[axis], int(high[axis]))
+
+    if roi.slices is not None:
+        z0, z1 = (int(z) for z in roi.slices)
+        lower[2], upper[2] = max(0, z0), min(size[2], z1)
+
+    if any(high <= low for low, high in zip(lower, upper)):
+        raise ValueError(f"The region of interest does not overlap the image (size {tuple(size)})")
+
+    return tuple(lower), tuple(high - low for low, high in zip(lower, upper))
+
+
+def region_origin(origin, spacing, start, direction=None):
+    """
+    Physical position of voxel start: the origin of a region.
+    """
+    offset = np.asarray(start, dtype=float) * spacing
+    if direction is not None:
+        offset = np.reshape(direction, (3, 3)) @ offset
+    return tuple(float(o) for o in np.asarray(origin, dtype=float) + offset)
+
+
+def _meta_layout(fileName):
+    # Key = value lines up to ElementDataFile, which is always last
+    fields = {}
+    with open(fileName, "rb") as fp:
+        for line in fp:
+            key, _, value = line.decode("latin-1").partition("=")
+            fields[key.strip()] = value.strip()
+            if key.strip() == "ElementDataFile":
+                break
+        offset = fp.tell()
+
+    if fields.get("CompressedData", "False").lower() == "true":
+        return None
+
+    dataFile = fields.get("ElementDataFile", "")
+    headerSize = int(fields.get("HeaderSize", 0))
+    if dataFile == "LOCAL":
+        dataFile = fileName
+    elif not dataFile or dataFile.startswith("LIST") or len(dataFile.split()) > 1:
+        # One file per slice
+        return None
+    else:
+        dataFile = os.path.join(os.path.dirname(fileName), dataFile)
+        offset = max(headerSize, 0)
+
+    if headerSize == -1:
+        # Data at the end of the file
+        offset = None
+
+    msb = fields.get("ElementByteOrderMSB", fields.get("BinaryDataByteOrderMSB", "False")).lower() == "true"
+    return dataFile, offset, ">" if msb else "<"
+
+
+def _nrrd_layout(fileName):
+    # Field: value lines up to a blank line
+    fields = {}
+    with open(fileName, "rb") as fp:
+        for line in fp:
+            line = line.decode("latin-1").rstrip("\r\n")
+            if not line:
+                break
+            if line.startswith("#") or ":" not in line:
+                continue
+            key, _, value = line.partition(":")
+            fields[key.strip().lower()] = value.lstrip("=").strip()
+        offset = fp.tell()
+
+    if fields.get("encoding") != "raw" or int(fields.get("line skip", 0)) or int(fields.get("byte skip", 0)):
+        return None
+
+    dataFile = fields.get("data file", fields.get("datafile"))
+    if dataFile is not None:
+        if dataFile.startswith("LIST") or len(dataFile.split()) > 1:
+            return None
+        dataFile, offset = os.path.join(os.path.dirname(fileName), dataFile), 0
+    else:
+        dataFile = fileName
+
+    return dataFile, offset, ">" if fields.get("endian") == "big" else "<"
+
+
+def _nifti_layout(fileName):
+    with open(fileName, "rb") as fp:
+        h = fp.read(348)
+    if len(h) < 348:
+        return None
+
+    for endian in "<>":
+        if struct.unpack_from(endian + "i", h, 0)[0] == 348:
+            break
+    else:
+        # NIfTI-2 or not NIfTI
+        return None
+
+    voxOffset, slope, intercept = struct.unpack_from(endian + "3f", h, 108)
+    if slope not in (0.0, 1.0) or intercept != 0.0:
+        # SimpleITK rescales these to float
+        return None
+
+    dataFile = fileName
+    if h[344:347] == b"ni1":
+        # .hdr/.img pair
+        dataFile = os.path.splitext(fileName)[0] + ".img"
+    return dataFile, int(voxOffset), endian
+
+
+def raw_layout(fileName):
+    """
+    Where the voxels of an uncompressed image file are, for memory-mapping.
+
+    Parameters
+    ----------
+    fileName : str
+        Scanco (.aim/.isq), MHA/MHD, NRRD or NIfTI (.nii/.hdr) file.
+
+    Returns
+    -------
+    layout : dict or None
+        'data_file', 'offset' and 'dtype' (with byte order) of the voxels,
+        and the 'size', 'spacing', 'origin' and 'direction' of the image.
+        None if the file is compressed or otherwise cannot be mapped (see
+        Note 3).
+    """
+    lower = fileName.lower()
+    if ".aim" in lower or ".isq" in lower:
+        header = read_scanco_header(fileName)
+        if header["compressed"] or header["dtype"] is None:
+            return None
+        return {
+            "data_file": fileName,
+            "offset": header["header_size"],
+            "dtype": header["dtype"],
+            "size": tuple(header["dimensions"]),
+            "spacing": tuple(header["spacing"]),
+            "origin": tuple(header["origin"]),
+            "direction": None,
+        }
+
+    if lower.endswith((".mha", ".mhd")):
+        parse = _meta_layout
+    elif lower.endswith(".nrrd") or lower.endswith(".nhdr"):
+        parse = _nrrd_layout
+    elif lower.endswith((".nii", ".hdr")):
+        parse = _nifti_layout
+    else:
+        return None
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(fileName)
+    reader.ReadImageInformation()
+    pixelType = pixelTypes.sitkPixelIDEnum.get(reader.GetPixelID(), "unknown")
+    if reader.GetDimension() != 3 or reader.GetNumberOfComponents() != 1 or pixelType == "unknown":
+        return None
+
+    layout = parse(fileName)
+    if layout is None:
+        return None
+    dataFile, offset, endian = layout
+
+    dtype = np.dtype(pixelType).newbyteorder(endian)
+    nbytes = int(np.prod(reader.GetSize())) * dtype.itemsize
+    try:
+        fileSize = os.path.getsize(dataFile)
+    except OSError:
+        return None
+    if offset is None:
+        offset = fileSize - nbytes
+    if offset < 0 or offset + nbytes > fileSize:
+        return None
+
+    return {
+        "data_file": dataFile,
+        "offset": offset,
+        "dtype": dtype,
+        "size": tuple(reader.GetSize()),
+        "spacing": tuple(reader.GetSpacing()),
+        "origin": tuple(reader.GetOrigin()),
+        "direction": tuple(reader.GetDirection()),
+    }
+
+
+def layout_region(layout, roi):
+    """
+    roi_region() of the image described by a raw_layout().
+    """
+    return roi_region(roi, layout["size"], layout["spacing"], layout["origin"], layout["direction"])
+
+
+def _memmap(layout):
+    nx, ny, nz = layout["size"]
+    return np.memmap(layout["data_file"], dtype=layout["dtype"], mode="r", offset=layout["offset"], shape=(nz, ny, nx))
+
+
+def iter_region_slabs(layout, start, size, slabSize=64):
+    """
+    Yield a region of a raw_layout() image as z-slabs, reading only the rows
+    inside the region.
+
+    Yields
+    ------
+    z : int
+        Index of the first slice of the slab, relative to the region.
+    slab : numpy.ndarray
+        Array of shape (slices, size y, size x), in native byte order.
+    """
+    data = _memmap(layout)
+    (x0, y0, z0), (nx, ny, nz) = start, size
+    dtype = layout["dtype"].newbyteorder("=")
+    for z in range(0, nz, slabSize):
+        slab = data[z0 + z:z0 + min(z + slabSize, nz), y0:y0 + ny, x0:x0 + nx]
+        yield z, slab.astype(dtype)
+
+
+def read_region(layout, start, size):
+    """
+    Read a region of a raw_layout() image into a SimpleITK image, with the
+    spacing and direction of the image and the origin of the region.
+    """
+    (x0, y0, z0), (nx, ny, nz) = start, size
+    data = _memmap(layout)[z0:z0 + nz, y0:y0 + ny, x0:x0 + nx]
+    image = sitk.GetImageFromArray(data.astype(layout["dtype"].newbyteorder("=")))
+    del data
+
+    image.SetSpacing(layout["spacing"])
+    image.SetOrigin(region_origin(layout["origin"], layout["spacing"], start, layout["direction"]))
+    if layout["direction"] is not None:
+        image.SetDirection(layout["direction"])
+    return image
@@ -0,0 +1,335 @@
+"""
+scancoIO.py
+
+Description: Reads Scanco ISQ and AIM files without ITK. The header is
+             parsed directly and the voxel data is exposed as a
+             read-only numpy memmap, so header queries, cropping and
+             slab access only touch the bytes that are needed. Only
+             uncompressed data can be read this way; compressed AIMs
+             still need itk.ScancoImageIO.
+"""
+
+import re
+import struct
+
+import numpy as np
+
+from .lazyImport import lazy_import
+
+sitk = lazy_import("SimpleITK")
+
+
+ISQ_MAGIC = b"CTDATA-HEADER_V1"
+AIM_V030_MAGIC = b"AIMDATA_V030   \0"
+
+# ISQ data type -> numpy dtype
+isqDataTypeDict = {
+    3: np.dtype("<i2"),
+}
+
+# AIM data type -> numpy dtype (uncompressed types only)
+aimDataTypeDict = {
+    0x00010001: np.dtype("i1"),
+    0x00020002: np.dtype("<i2"),
+    0x00030004: np.dtype("<i4"),
+    0x001A0004: np.dtype("<f4"),
+}
+
+
+def _decode_vms_float(data):
+    """
+    Decode a VAX F-float (used for the element size in AIM v020 headers).
+    """
+    i = (data[0] << 16) | (data[1] << 24) | data[2] | (data[3] << 8)
+    return 0.25 * struct.unpack("<f", struct.pack("<I", i))[0]
+
+
+def parse_aim_log(log):
+    """
+    Parse the processing log of an AIM into a dictionary.
+
+    Each log line holds a key padded with spaces followed by its value,
+    e.g. 'Mu_Scaling                     8192'. Separator lines ('!---')
+    are skipped. Values are kept as strings.
+    """
+    fields = {}
+    for line in log.splitlines():
+        line = line.strip()
+        if not line or line.startswith("!"):
+            continue
+
+        entry = re.split(r"\s{2,}", line, maxsplit=1)
+        key = entry[0].strip()
+        if key not in fields:
+            fields[key] = entry[1].strip() if len(entry) > 1 else ""
+
+    return fields
+
+
+def _float_or_none(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _aim_calibration(fields):
+    return {
+        "mu_scaling": _float_or_none(fields.get("Mu_Scaling")),
+        "mu_water": _float_or_none(fields.get("HU: mu water")),
+        "rescale_slope": _float_or_none(fields.get("Density: slope")),
+        "rescale_intercept": _float_or_none(fields.get("Density: intercept")),
+        "rescale_units": fields.get("Density: unit") or None,
+        "calibration_data": fields.get("Calibration Data") or None,
+    }
+
+
+def _read_isq_header(fp):
+    h = fp.read(512)
+    if len(h) < 512:
+        raise ValueError("ISQ header is truncated")
+
+    ints = struct.unpack_from("<32i", h, 16)
+    pixdim = ints[7:10]
+    physdim = ints[10:13]
+
+    dataType = ints[0]
+    if dataType not in isqDataTypeDict:
+        raise ValueError(f"Unsupported ISQ data type: {dataType}")
+
+    return {
+        "version": h[:16].decode("latin-1"),
+        "format": "isq",
+        "data_type": dataType,
+        "dtype": isqDataTypeDict[dataType],
+        "compressed": False,
+        "dimensions": tuple(pixdim),
+        "spacing": tuple(1e-3 * physdim[i] / pixdim[i] if pixdim[i] else 1.0 for i in range(3)),
+        "origin": (0.0, 0.0, 0.0),
+        "header_size": (struct.unpack_from("<i", h, 508)[0] + 1) * 512,
+        "patient_index": ints[3],
+        "scanner_id": ints[4],
+        "slice_thickness": 1e-3 * ints[13],
+        "slice_increment": 1e-3 * ints[14],
+        "start_position": 1e-3 * ints[15],
+        "data_range": (ints[16], ints[17]),
+        "mu_scaling": float(ints[18]),
+        "number_of_samples": ints[19],
+        "number_of_projections": ints[20],
+        "scan_distance": 1e-3 * ints[21],
+        "scanner_type": ints[22],
+        "sample_time": 1e-3 * ints[23],
+        "measurement_index": ints[24],
+        "site": ints[25],
+        "reference_line": 1e-3 * ints[26],
+        "reconstruction_alg": ints[27],
+        "patient_name": h[128:168].split(b"\0")[0].decode("latin-1").strip(),
+        "energy": 1e-3 * struct.unpack_from("<i", h, 168)[0],
+        "intensity": 1e-3 * struct.unpack_from("<i", h, 172)[0],
+        # The density calibration of an ISQ is not in the main header
+        "calibration": {
+            "mu_scaling": float(ints[18]),
+            "mu_water": None,
+            "rescale_slope": None,
+            "rescale_intercept": None,
+            "rescale_units": None,
+            "calibration_data": None,
+        },
+    }
+
+
+def aim_preheader(fp):
+    """
+    Read the pre-header of an AIM file open in binary mode.
+
+    Returns
+    -------
+    intSize : int
+        4 for AIM v020, 8 for v030.
+    structOffset, structSize : int
+        Position and size of the image structure.
+    logSize : int
+        Size of the processing log, which follows the image structure.
+    """
+    fp.seek(0)
+    h = fp.read(16)
+    if h == AIM_V030_MAGIC:
+        intFormat, intSize, offset = "<q", 8, 16
+    else:
+        intFormat, intSize, offset = "<i", 4, 0
+
+    fp.seek(offset)
+    preheader = fp.read(5 * intSize)
+    if len(preheader) < 5 * intSize:
+        raise ValueError("AIM pre-header is truncated")
+    preheaderSize, structSize, logSize = (
+        struct.unpack_from(intFormat, preheader, i * intSize)[0] for i in range(3)
+    )
+    return intSize, offset + preheaderSize, structSize, logSize
+
+
+def _read_aim_header(fp):
+    intSize, structOffset, structSize, logSize = aim_preheader(fp)
+
+    fp.seek(structOffset)
+    s = fp.read(structSize)
+
+    if intSize == 8:
+        dataType = struct.unpack_from("<i", s, 12)[0]
+        values = struct.unpack_from("<21q", s, 16)
+        elementSize = [1e-6 * v for v in struct.unpack_from("<3q", s, 16 + 21 * 8)]
+    else:
+        dataType = struct.unpack_from("<i", s, 20)[0]
+        values = struct.unpack_from("<21i", s, 24)
+        elementSize = [_decode_vms_float(s[108 + 4 * i:112 + 4 * i]) for i in range(3)]
+
+    position = values[0:3]
+    pixdim = values[3:6]
+
+    log = fp.read(logSize).decode("latin-1")
+    logFields = parse_aim_log(log)
+
+    return {
+        "version": ("AIMDATA_V030   " if intSize == 8 else "AIMDATA_V020   "),
+        "format": "aim",
+        "data_type": dataType,
+        "dtype": aimDataTypeDict.get(dataType),
+        "compressed": dataType not in aimDataTypeDict,
+        "dimensions": tuple(pixdim),
+        "spacing": tuple(elementSize),
+        "origin": tuple(position[i] * elementSize[i] for i in range(3)),
+        "header_size": structOffset + structSize + logSize,
+        "log": log,
+        "log_fields": logFields,
+        "calibration": _aim_calibration(logFields),
+    }
+
+
+def read_scanco_header(fileName):
+    """
+    Read the header of a Scanco ISQ or AIM file.
+
+    Parameters
+    ----------
+    fileName : str
+
+    Returns
+    -------
+    header : dict
+        Always contains 'format' ('isq' or 'aim'), 'dimensions' (x, y, z),
+        'spacing' and 'origin' (mm), 'dtype' (numpy dtype, None if unknown),
+        'compressed', 'header_size' (byte offset of the voxel data) and
+        'calibration' (mu scaling, mu water, density slope/intercept/unit;
+        None where not stored). ISQ headers also carry the scanner fields,
+        AIM headers the processing 'log' and its parsed 'log_fields'.
+    """
+    with open(fileName, "rb") as fp:
+        magic = fp.read(16)
+        fp.seek(0)
+
+        if magic == ISQ_MAGIC:
+            return _read_isq_header(fp)
+        else:
+            return _read_aim_header(fp)
+
+
+def iter_scanco_slabs(fileName, header=None, slabSize=64):
+    """
+    Yield the voxel data of a Scanco file as z-slabs.
+
+    Parameters
+    ----------
+    fileName : str
+    header : dict, optional
+        Header from read_scanco_header(). Read from the file if not given.
+    slabSize : int
+        Number of slices per slab.
+
+    Yields
+    ------
+    z : int
+        Index of the first slice in the slab.
+    slab : numpy.ndarray
+        Array of shape (slices, y, x).
+    """
+    if header is None:
+        header = read_scanco_header(fileName)
+
+    if header["compressed"] or header["dtype"] is None:
+        raise ValueError(
+            f"Cannot stream {fileName}: data type {header['data_type']:#010x} is compressed or unsupported"
+        )
+
+    nx, ny, nz = header["dimensions"]
+    dtype = header["dtype"]
+    sliceCount = nx * ny
+
+    with open(fileName, "rb") as fp:
+        fp.seek(header["header_size"])
+        for z in range(0, nz, slabSize):
+            slices = min(slabSize, nz - z)
+            slab = np.fromfile(fp, dtype=dtype, count=slices * sliceCount)
+            if slab.size != slices * sliceCount:
+                raise ValueError(f"{fileName} is truncated at slice {z}")
+            yield z, slab.reshape(slices, ny, nx)
+
+
+def read_scanco_memmap(fileName, header=None):
+    """
+    Memory-map the voxel data of an uncompressed Scanco file.
+
+    Parameters
+    ----------
+    fileName : str
+    header : dict, optional
+        Header from read_scanco_header(). Read from the file if not given.
+
+    Returns
+    -------
+    data : numpy.memmap
+        Read-only array of shape (z, y, x). Nothing is read from disk until
+        the array (or a slice of it) is accessed.
+    """
+    if header is None:
+        header = read_scanco_header(fileName)
+
+    if header["compressed"] or header["dtype"] is None:
+        raise ValueError(
+            f"Cannot memory-map {fileName}: data type {header['data_type']:#010x} is compressed or unsupported"
+        )
+
+    nx, ny, nz = header["dimensions"]
+    return np.memmap(
+        fileName,
+        dtype=header["dtype"],
+        mode="r",
+        offset=header["header_size"],
+        shape=(nz, ny, nx),
+    )
+
+
+def read_scanco_sitk(fileName, header=None):
+    """
+    Read an uncompressed Scanco file into a SimpleITK image.
+
+    The native pixel type of the file is kept. Spacing and origin are set
+    from the header; the direction is identity.
+
+    Parameters
+    ----------
+    fileName : str
+    header : dict, optional
+        Header from read_scanco_header(). Read from the file if not given.
+
+    Returns
+    -------
+    sitk_image : SimpleITK.Image
+    """
+    if header is None:
+        header = read_scanco_header(fileName)
+
+    sitk_image = sitk.GetImageFromArray(read_scanco_memmap(fileName, header))
+    sitk_image.SetSpacing(header["spacing"])
+    sitk_image.SetOrigin(header["origin"])
+
+    return sitk_image
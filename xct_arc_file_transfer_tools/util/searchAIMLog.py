@@ -7,11 +7,176 @@
 # Description: Searches the header log file of an AIM file
 #              to determine if the file is a segmented image
 #              or grayscale image.
+#
+# Notes:
+# 1. Works on AIM files and on their logs saved as text. Of an AIM, only the pre-header, the image
+#    structure and the processing log are read, never the voxel data. The log is read in buffers of
+#    BUFFER_SIZE bytes; text logs are read up to MAX_LOG_BYTES.
+# 2. An image is 'segmented' if its log mentions "Segmented Objects", otherwise 'grayscale' if it
+#    mentions "Linear Attenuation", otherwise 'unknown'. Without parsed fields, reading stops as soon
+#    as "Segmented Objects" is found.
+# 3. classify_tree() classifies every AIM below a directory on a pool of threads (the work is reading
+#    headers, so threads overlap the file system latency). Files that cannot be read are classified
+#    'unknown' with the error, so one bad file does not stop a scan.
 # -----------------------------------------------------
 
+import os
+import struct
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .scancoIO import AIM_V030_MAGIC, aim_preheader, parse_aim_log
+
+
+SEGMENTED = "segmented"
+GRAYSCALE = "grayscale"
+UNKNOWN = "unknown"
+
+# Log text that marks each kind, in order of precedence
+_markers = ((SEGMENTED, b"Segmented Objects"), (GRAYSCALE, b"Linear Attenuation"))
+
+BUFFER_SIZE = 64 * 1024
+MAX_LOG_BYTES = 4 * 1024 * 1024
+
+# kind: SEGMENTED, GRAYSCALE or UNKNOWN; log_fields: parse_aim_log() of the
+# log (None if not parsed); data_type: AIM data type (None for text logs)
+AIMClassification = namedtuple("AIMClassification", ["file", "kind", "log_fields", "data_type", "error"])
+
+
+def _is_aim(fp):
+    # AIM v030 starts with its magic, v020 with a pre-header size of 20
+    start = fp.read(16)
+    fp.seek(0)
+    return start == AIM_V030_MAGIC or start[:4] == struct.pack("<i", 20)
+
+
+def _scan_log(fp, nbytes, bufferSize, keepText):
+    # Read nbytes in buffers, looking for the markers across buffer
+    # boundaries. Returns the kind and, with keepText, the log text.
+    overlap = max(len(marker) for kind, marker in _markers) - 1
+    found = set()
+    chunks = []
+    tail = b""
+
+    while nbytes > 0:
+        chunk = fp.read(min(bufferSize, nbytes))
+        if not chunk:
+            break
+        nbytes -= len(chunk)
+        if keepText:
+            chunks.append(chunk)
+
+        window = tail + chunk
+        for kind, marker in _markers:
+            if marker in window:
+                found.add(kind)
+        tail = window[-overlap:]
+
+        if SEGMENTED in found and not keepText:
+            break
+
+    kind = next((kind for kind, marker in _markers if kind in found), UNKNOWN)
+    return kind, b"".join(chunks).decode("latin-1") if keepText else None
+
+
+def classify_aim(fileName, fields=True, bufferSize=BUFFER_SIZE):
+    """
+    Classify an AIM (or its log) as segmented or grayscale from its log.
+
+    Parameters
+    ----------
+    fileName : str
+        AIM file or text log.
+    fields : bool
+        Also parse the log into fields (see scancoIO.parse_aim_log()).
+    bufferSize : int
+        Bytes read at a time.
+
+    Returns
+    -------
+    result : AIMClassification
+        Kind 'unknown' with the error message if the file cannot be read.
+    """
+    try:
+        return _classify(fileName, fields, bufferSize)
+    except (OSError, ValueError, struct.error) as e:
+        return AIMClassification(fileName, UNKNOWN, None, None, str(e) or type(e).__name__)
+
+
+def _classify(fileName, fields, bufferSize):
+    with open(fileName, "rb") as fp:
+        dataType = None
+        if _is_aim(fp):
+            intSize, structOffset, structSize, logSize = aim_preheader(fp)
+            fp.seek(structOffset)
+            s = fp.read(structSize)
+            dataType = struct.unpack_from("<i", s, 12 if intSize == 8 else 20)[0]
+            fp.seek(structOffset + structSize)
+        else:
+            logSize = MAX_LOG_BYTES
+
+        kind, log = _scan_log(fp, logSize, bufferSize, fields)
+
+    return AIMClassification(fileName, kind, parse_aim_log(log) if fields else None, dataType, None)
+
+
+def find_aims(directory, extensions=(".aim",)):
+    """
+    Every file below a directory with one of the extensions (ignoring case
+    and VMS version numbers such as ';1'), in sorted order.
+    """
+    found = []
+    for parent, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().rsplit(";", 1)[0].endswith(extensions):
+                found.append(os.path.join(parent, name))
+    return found
+
+
+def classify_files(fileNames, threads=None, fields=True, bufferSize=BUFFER_SIZE):
+    """
+    classify_aim() a list of files on a pool of threads.
+
+    Parameters
+    ----------
+    fileNames : list of str
+    threads : int, optional
+        Files read at once (default: number of CPUs).
+
+    Returns
+    -------
+    results : list of AIMClassification
+        In the order of fileNames.
+    """
+    if not fileNames:
+        return []
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as executor:
+        return list(executor.map(lambda fileName: classify_aim(fileName, fields, bufferSize), fileNames))
+
+
+def classify_tree(directory, threads=None, fields=True, extensions=(".aim",)):
+    """
+    Classify every AIM below a directory (see find_aims() and
+    classify_files()).
+
+    Returns
+    -------
+    results : list of AIMClassification
+        In sorted path order.
+    """
+    return classify_files(find_aims(directory, extensions), threads, fields)
+
 
 def searchAIMLog(log):
-    if "Segmented Objects" in open(log).read():
+    """
+    True if an AIM (or its log) is segmented, False if it is grayscale and
+    None if its log says neither.
+    """
+    kind = _classify(log, False, BUFFER_SIZE).kind
+    if kind == SEGMENTED:
         return True
-    elif "Linear Attenuation" in open(log).read():
+    elif kind == GRAYSCALE:
         return False
+    return None
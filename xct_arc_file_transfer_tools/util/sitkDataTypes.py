@@ -1,3 +1,4 @@
+import numpy as np
 import SimpleITK as sitk
 
 # Dictionary for interpolator types
@@ -15,16 +16,125 @@ dataTypeDict = {
     "unknown": sitk.sitkUnknown,
 }
 
-sitkPixelIDEnum = {
-    0: "uint8",
-    2: "uint16",
-    4: "uint32",
-    6: "uint34",
-    1: "int8",
-    3: "int16",
-    5: "int32",
-    7: "int64",
-    8: "float32",
-    9: "float64",
-    -1: "unknown",
-}
+sitkPixelIDEnum = {pixelID: name for name, pixelID in dataTypeDict.items()}
+
+# Integer types in order of size, unsigned first (used for narrowing)
+integerTypes = ["uint8", "int8", "uint16", "int16", "uint32", "int32", "uint64", "int64"]
+
+
+def pixel_type_name(image):
+    """
+    dataTypeDict name of the pixel type of an image ('unknown' for vector
+    and complex pixels).
+    """
+    return sitkPixelIDEnum.get(image.GetPixelID(), "unknown")
+
+
+def value_range(image, slabSize=64):
+    """
+    Minimum and maximum of an image, in one pass over its z-slabs.
+
+    Parameters
+    ----------
+    image : SimpleITK.Image
+        Scalar image.
+    slabSize : int
+        Number of slices looked at a time.
+
+    Returns
+    -------
+    minimum, maximum, integral, float32
+        See slabs_value_range().
+    """
+    # A view of the image's own buffer, not a copy
+    array = sitk.GetArrayViewFromImage(image)
+    if array.ndim < 3:
+        array = array.reshape((1,) + array.shape)
+    return slabs_value_range(array[z:z + slabSize] for z in range(0, array.shape[0], slabSize))
+
+
+def slabs_value_range(slabs):
+    """
+    Minimum and maximum of an image given as slabs (numpy arrays of one
+    dtype), e.g. the slabs of a streamed conversion.
+
+    Returns
+    -------
+    minimum, maximum : float
+    integral : bool
+        Whether every value is a whole number (always True for integer
+        pixel types).
+    float32 : bool
+        Whether every value survives a round trip through float32 (always
+        True for float32 and 8/16-bit integer images).
+    """
+    minimum, maximum = np.inf, -np.inf
+    integral = True
+    float32 = True
+    for slab in slabs:
+        isInteger = np.issubdtype(slab.dtype, np.integer)
+        # float32 holds every float32, int8/16 and uint8/16 value
+        checkFloat32 = slab.dtype != np.float32 and not (isInteger and slab.dtype.itemsize <= 2)
+
+        minimum = min(minimum, float(slab.min()))
+        maximum = max(maximum, float(slab.max()))
+        if not isInteger and integral:
+            integral = bool(np.all(np.mod(slab, 1) == 0))
+        if checkFloat32 and float32:
+            float32 = bool(np.array_equal(slab.astype(np.float32).astype(slab.dtype), slab, equal_nan=True))
+
+    return minimum, maximum, integral, float32
+
+
+def narrowest_pixel_type(minimum, maximum, integral=True, float32=False):
+    """
+    Smallest dataTypeDict type holding every value in [minimum, maximum]
+    without loss.
+
+    Non-integral values (or whole numbers beyond the integer types) need a
+    float type: float32 only if every value is known to survive a round
+    trip through float32 (see value_range()), float64 otherwise.
+    """
+    if integral and np.isfinite(minimum) and np.isfinite(maximum):
+        for name in integerTypes:
+            info = np.iinfo(name)
+            if info.min <= minimum and maximum <= info.max:
+                return name
+
+    if float32:
+        return "float32"
+    return "float64"
+
+
+def cast_pixel_type(image, pixelType, slabSize=64):
+    """
+    Cast an image to a pixel type.
+
+    Parameters
+    ----------
+    image : SimpleITK.Image
+    pixelType : str or None
+        A dataTypeDict name, 'auto' for the narrowest type that holds the
+        image's values without loss (see value_range()), or None to keep
+        the image's own type.
+    slabSize : int
+        Slices per slab of the min/max pass of 'auto'.
+
+    Returns
+    -------
+    image : SimpleITK.Image
+        The input itself if it already has that type.
+    """
+    if pixelType is None:
+        return image
+
+    if pixelType == "auto":
+        pixelType = narrowest_pixel_type(*value_range(image, slabSize))
+    elif pixelType not in dataTypeDict or pixelType == "unknown":
+        raise ValueError(
+            f"Unknown pixel type {pixelType} (use auto or one of: {', '.join(list(dataTypeDict)[:-1])})"
+        )
+
+    if image.GetPixelID() == dataTypeDict[pixelType]:
+        return image
+    return sitk.Cast(image, dataTypeDict[pixelType])
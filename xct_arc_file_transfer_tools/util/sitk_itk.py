@@ -5,57 +5,143 @@ Created by:   Michael Kuczynski
 Created on:   26/01/2021
 
 Description: Converts between SimpleITK and ITK images.
-"""
 
-import itk
-import SimpleITK as sitk
+Notes:
+1. SimpleITK -> ITK does not copy the pixel buffer. The ITK image is a view
+   of the SimpleITK buffer and keeps a reference to the SimpleITK image
+   (itk_image._sitk_base) so the buffer stays alive as long as the ITK image
+   does. Changes made to the pixels of one image are seen by the other.
+   A copy is only made when deep=True or when ITK-Python is not wrapped for
+   the pixel type (int8 is widened to int16, int64 to float64).
+
+2. SimpleITK (Python) cannot adopt an external buffer, so ITK -> SimpleITK
+   costs one copy. The only exception is an ITK image that is itself a view
+   of a SimpleITK image with the same size and geometry, whose buffer is
+   still that of the SimpleITK image (not reallocated or grafted): the
+   original SimpleITK buffer is shared again (copy-on-write).
+"""
 
 import numpy as np
 
+from .lazyImport import lazy_import
+from .instrumentation import stage
+
+itk = lazy_import("itk")
+sitk = lazy_import("SimpleITK")
+
 
-def sitk_itk(sitk_image):
+# Pixel types ITK-Python is not wrapped for, and what they are widened to
+_itkUnwrappedTypes = {
+    np.dtype("int8"): np.dtype("int16"),
+    np.dtype("int64"): np.dtype("float64"),
+}
+
+
+def sitk_itk(sitk_image, deep=False, return_copied=False):
     """
     Convert a SimpleITK image to an ITK image.
 
     Parameters
     ----------
     sitk_image : SimpleITK.Image
+    deep : bool
+        Copy the pixel buffer instead of sharing it.
+    return_copied : bool
+        Also return whether the pixel buffer was copied.
 
     Returns
     -------
     itk_image : ITK.Image
+    copied : bool
+        Only returned if return_copied is True.
     """
-    itk_image = itk.GetImageFromArray(
-        sitk.GetArrayFromImage(sitk_image),
-        is_vector=sitk_image.GetNumberOfComponentsPerPixel() > 1,
-    )
+    with stage("sitk_itk") as record:
+        itk_image, copied = _sitk_itk(sitk_image, deep)
+        record["bytes_in"] = record["bytes_out"] = itk.GetArrayViewFromImage(itk_image).nbytes
+        record["copied"] = copied
+
+    if return_copied:
+        return itk_image, copied
+    return itk_image
+
+
+def _sitk_itk(sitk_image, deep):
+    is_vector = sitk_image.GetNumberOfComponentsPerPixel() > 1
+    array = sitk.GetArrayViewFromImage(sitk_image)
+
+    copied = deep or array.dtype in _itkUnwrappedTypes
+    if copied:
+        array = np.array(array, dtype=_itkUnwrappedTypes.get(array.dtype, array.dtype))
+        itk_image = itk.GetImageFromArray(array, is_vector=is_vector)
+    else:
+        itk_image = itk.GetImageViewFromArray(array, is_vector=is_vector)
+        # Keep the SimpleITK image (owner of the buffer) alive
+        itk_image._sitk_base = sitk_image
+
+    dimension = sitk_image.GetDimension()
     itk_image.SetOrigin(sitk_image.GetOrigin())
     itk_image.SetSpacing(sitk_image.GetSpacing())
     itk_image.SetDirection(
-        itk.GetMatrixFromArray(np.reshape(np.array(sitk_image.GetDirection()), [3] * 2))
+        itk.GetMatrixFromArray(np.reshape(np.array(sitk_image.GetDirection()), [dimension] * 2))
     )
 
-    return itk_image
+    return itk_image, copied
 
 
-def itk_sitk(itk_image):
+def itk_sitk(itk_image, deep=False, return_copied=False):
     """
     Convert an ITK image to a SimpleITK image.
 
     Parameters
     ----------
     itk_image : ITK.Image
+    deep : bool
+        Always copy the pixel buffer, even if it could be shared.
+    return_copied : bool
+        Also return whether the pixel buffer was copied.
 
     Returns
     -------
     sitk_image : SimpleITK.Image
+    copied : bool
+        Only returned if return_copied is True.
     """
-    sitk_image = sitk.GetImageFromArray(
-        itk.GetArrayFromImage(itk_image),
-        isVector=itk_image.GetNumberOfComponentsPerPixel() > 1,
-    )
-    sitk_image.SetOrigin(tuple(itk_image.GetOrigin()))
-    sitk_image.SetSpacing(tuple(itk_image.GetSpacing()))
-    sitk_image.SetDirection(itk.GetArrayFromMatrix(itk_image.GetDirection()).flatten())
+    with stage("itk_sitk") as record:
+        sitk_image, copied = _itk_sitk(itk_image, deep)
+        record["bytes_in"] = record["bytes_out"] = sitk.GetArrayViewFromImage(sitk_image).nbytes
+        record["copied"] = copied
 
+    if return_copied:
+        return sitk_image, copied
     return sitk_image
+
+
+def _itk_sitk(itk_image, deep):
+    origin = tuple(itk_image.GetOrigin())
+    spacing = tuple(itk_image.GetSpacing())
+    direction = tuple(itk.GetArrayFromMatrix(itk_image.GetDirection()).flatten())
+
+    sitk_base = getattr(itk_image, "_sitk_base", None)
+    if (
+        not deep
+        and sitk_base is not None
+        and tuple(sitk_base.GetSize()) == tuple(itk_image.GetLargestPossibleRegion().GetSize())
+        and itk.GetArrayViewFromImage(itk_image).ctypes.data == sitk.GetArrayViewFromImage(sitk_base).ctypes.data
+        and np.allclose(sitk_base.GetOrigin(), origin)
+        and np.allclose(sitk_base.GetSpacing(), spacing)
+        and np.allclose(sitk_base.GetDirection(), direction)
+    ):
+        # Shallow, copy-on-write copy sharing the original buffer
+        sitk_image = sitk.Image(sitk_base)
+        copied = False
+    else:
+        sitk_image = sitk.GetImageFromArray(
+            itk.GetArrayViewFromImage(itk_image),
+            isVector=itk_image.GetNumberOfComponentsPerPixel() > 1,
+        )
+        sitk_image.SetOrigin(origin)
+        sitk_image.SetSpacing(spacing)
+        sitk_image.SetDirection(direction)
+        copied = True
+
+    return sitk_image, copied
@@ -5,64 +5,153 @@ Created by:   Michael Kuczynski
 Created on:   21-01-2020
 
 Description: Converts between SimpleITK and VTK image types
+
+Notes:
+1. SimpleITK -> VTK wraps the SimpleITK pixel buffer without copying it
+   (unless deep=True). The VTK image keeps a reference to the SimpleITK
+   image (vtk_image._sitk_base) so the buffer stays alive as long as the
+   VTK image does.
+
+2. SimpleITK (Python) cannot adopt an external buffer, so VTK -> SimpleITK
+   costs one copy, unless the VTK image is an unchanged wrapper of a
+   SimpleITK image: same geometry, and scalars that are still the
+   SimpleITK buffer (not replaced by SetScalars() or a ShallowCopy()).
+
+3. Dimensions, spacing, origin and direction are carried over in both
+   directions. VTK < 9 has no direction matrix; there the direction is
+   dropped on the way to VTK and assumed to be identity on the way back.
 """
 
-import vtk
-from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk, get_vtk_array_type
+import numpy as np
+
+from .lazyImport import lazy_import
 
-import SimpleITK as sitk
+vtk = lazy_import("vtk")
+numpy_support = lazy_import("vtk.util.numpy_support")
+sitk = lazy_import("SimpleITK")
 
 
-def sitk_to_vtk(sitk_image):
+def sitk_to_vtk(sitk_image, deep=False, return_copied=False):
     """
     Convert a SimpleITK image to a VTK image.
 
     Parameters
     ----------
     sitk_image : SimpleITK.Image
+    deep : bool
+        Copy the pixel buffer instead of sharing it.
+    return_copied : bool
+        Also return whether the pixel buffer was copied.
 
     Returns
     -------
     vtk_image : VTK.Image
+    copied : bool
+        Only returned if return_copied is True.
     """
-    origin = list(sitk_image.GetOrigin())
-    spacing = list(sitk_image.GetSpacing())
+    components = sitk_image.GetNumberOfComponentsPerPixel()
 
-    # Cconvert the SimpleITK image to a numpy array
-    raw_data = sitk.GetArrayFromImage(sitk_image)
+    # View of the SimpleITK buffer, (z, y, x) ordered
+    raw_data = sitk.GetArrayViewFromImage(sitk_image)
+    if deep:
+        raw_data = np.array(raw_data)
 
-    data_type = get_vtk_array_type(raw_data.dtype)
-    shape = raw_data.shape
+    # Flattening a contiguous array is a view, not a copy
+    flat_data_array = raw_data.reshape(-1, components) if components > 1 else raw_data.reshape(-1)
+
+    vtk_data = numpy_support.numpy_to_vtk(
+        num_array=flat_data_array,
+        deep=False,
+        array_type=numpy_support.get_vtk_array_type(raw_data.dtype),
+    )
 
-    flat_data_array = raw_data.flatten()
-    vtk_data = numpy_to_vtk(num_array=flat_data_array, deep=True, array_type=data_type)
-    
     vtk_image = vtk.vtkImageData()
+    vtk_image.SetDimensions(sitk_image.GetSize())
+    vtk_image.SetSpacing(sitk_image.GetSpacing())
+    vtk_image.SetOrigin(sitk_image.GetOrigin())
+    if hasattr(vtk_image, "SetDirectionMatrix"):
+        vtk_image.SetDirectionMatrix(sitk_image.GetDirection())
     vtk_image.GetPointData().SetScalars(vtk_data)
-    vtk_image.SetDimensions(shape[0], shape[1], shape[2])
-    vtk_image.SetSpacing(spacing)
-    vtk_image.SetOrigin(origin)
-    
+
+    if not deep:
+        # Keep the SimpleITK image (owner of the buffer) alive
+        vtk_image._sitk_base = sitk_image
+
+    if return_copied:
+        return vtk_image, deep
     return vtk_image
 
-def vtk_to_sitk(vtk_image):
+
+def _vtk_direction(vtk_image):
+    if not hasattr(vtk_image, "GetDirectionMatrix"):
+        return (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
+
+    matrix = vtk_image.GetDirectionMatrix()
+    return tuple(matrix.GetElement(r, c) for r in range(3) for c in range(3))
+
+
+def _shares_buffer(vtk_image, sitk_image):
+    # The scalars of vtk_image are still the pixel buffer of sitk_image
+    scalars = vtk_image.GetPointData().GetScalars()
+    if scalars is None:
+        return False
+    array = sitk.GetArrayViewFromImage(sitk_image)
+    return numpy_support.vtk_to_numpy(scalars).ctypes.data == array.ctypes.data and scalars.GetSize() == array.size
+
+
+def vtk_to_sitk(vtk_image, deep=False, return_copied=False):
     """
     Convert a VTK image to a SimpleITK image.
 
     Parameters
     ----------
     vtk_image : VTK.Image
+    deep : bool
+        Always copy the pixel buffer, even if it could be shared.
+    return_copied : bool
+        Also return whether the pixel buffer was copied.
 
     Returns
     -------
     sitk_image : SimpleITK.Image
+    copied : bool
+        Only returned if return_copied is True.
     """
-    vtk_data = vtk_image.GetPointData().GetScalars()
-    numpy_data = vtk_to_numpy(vtk_data)
     dims = vtk_image.GetDimensions()
-    numpy_data = numpy_data.reshape(dims[2], dims[1], dims[0])
-    numpy_data = numpy_data.transpose(2, 1, 0)
-
-    sitk_image = sitk.GetImageFromArray(numpy_data)
-
+    spacing = vtk_image.GetSpacing()
+    origin = vtk_image.GetOrigin()
+    direction = _vtk_direction(vtk_image)
+
+    sitk_base = getattr(vtk_image, "_sitk_base", None)
+    if (
+        not deep
+        and sitk_base is not None
+        and tuple(sitk_base.GetSize()) == tuple(dims)
+        and np.allclose(sitk_base.GetOrigin(), origin)
+        and np.allclose(sitk_base.GetSpacing(), spacing)
+        and np.allclose(sitk_base.GetDirection(), direction)
+        and _shares_buffer(vtk_image, sitk_base)
+    ):
+        # Shallow, copy-on-write copy sharing the original buffer
+        sitk_image = sitk.Image(sitk_base)
+        copied = False
+    else:
+        vtk_data = vtk_image.GetPointData().GetScalars()
+        components = vtk_data.GetNumberOfComponents()
+
+        # VTK is x-fastest, so the buffer is already (z, y, x) in numpy order
+        numpy_data = numpy_support.vtk_to_numpy(vtk_data)
+        if components > 1:
+            numpy_data = numpy_data.reshape(dims[2], dims[1], dims[0], components)
+        else:
+            numpy_data = numpy_data.reshape(dims[2], dims[1], dims[0])
+
+        sitk_image = sitk.GetImageFromArray(numpy_data, isVector=components > 1)
+        sitk_image.SetSpacing(spacing)
+        sitk_image.SetOrigin(origin)
+        sitk_image.SetDirection(direction)
+        copied = True
+
+    if return_copied:
+        return sitk_image, copied
     return sitk_image
@@ -0,0 +1,419 @@
+"""
+streamWriters.py
+
+Description: Writes 3D images slab by slab so that only one z-slab has
+             to be held in memory. Supports MHA/MHD, NRRD and NIfTI
+             (optionally gzipped) outputs. The headers follow what
+             SimpleITK writes for the same image, so the outputs can be
+             read back with SimpleITK, ITK or nibabel.
+
+Notes:
+1. Compressed outputs (.nii.gz, NRRD with gzip encoding, MHA/MHD with
+   CompressedData) are compressed on several threads by
+   ParallelCompressWriter, with a configurable level and thread count.
+
+2. write_image() writes a whole SimpleITK image through SlabImageWriter,
+   without copying its pixel buffer.
+"""
+
+import os
+import math
+import struct
+
+import numpy as np
+
+from .lazyImport import lazy_import
+from .parallelCompress import ParallelCompressWriter
+
+sitk = lazy_import("SimpleITK")
+
+
+# Extensions that can be written slab by slab
+streamExtensions = (".mha", ".mhd", ".raw", ".nrrd", ".nii", ".nii.gz")
+
+metaElementTypes = {
+    "int8": "MET_CHAR",
+    "uint8": "MET_UCHAR",
+    "int16": "MET_SHORT",
+    "uint16": "MET_USHORT",
+    "int32": "MET_INT",
+    "uint32": "MET_UINT",
+    "int64": "MET_LONG_LONG",
+    "uint64": "MET_ULONG_LONG",
+    "float32": "MET_FLOAT",
+    "float64": "MET_DOUBLE",
+}
+
+nrrdTypes = {
+    "int8": "signed char",
+    "uint8": "unsigned char",
+    "int16": "short",
+    "uint16": "unsigned short",
+    "int32": "int",
+    "uint32": "unsigned int",
+    "int64": "long long int",
+    "uint64": "unsigned long long int",
+    "float32": "float",
+    "float64": "double",
+}
+
+# NIfTI-1 datatype codes
+niftiTypes = {
+    "uint8": 2,
+    "int16": 4,
+    "int32": 8,
+    "float32": 16,
+    "float64": 64,
+    "int8": 256,
+    "uint16": 512,
+    "uint32": 768,
+    "int64": 1024,
+    "uint64": 1280,
+}
+
+NIFTI_HEADER_FORMAT = "<i10s18sihcb8h3f4h8f3fhcb4f2i80s24s2h6f12f16s4s"
+
+
+def split_extension(fileName):
+    """
+    Split a file name at its first '.', the same way fileConverter() does,
+    so that '.nii.gz' is kept together.
+    """
+    directory, filename = os.path.split(fileName)
+    ext_idx = filename.find(".")
+    if ext_idx < 0:
+        return fileName, ""
+    return os.path.join(directory, filename[:ext_idx]), filename[ext_idx:].lower()
+
+
+def _columns(direction):
+    # SimpleITK directions are row-major; columns are the axis directions
+    return [[direction[r * 3 + c] for r in range(3)] for c in range(3)]
+
+
+# Fixed width, so the size can be filled in once the data is written
+COMPRESSED_SIZE_FORMAT = "CompressedDataSize = {:020d}"
+
+
+def _meta_header(size, spacing, origin, direction, dtype, dataFile, compressedSize=None):
+    cols = _columns(direction)
+    lines = [
+        "ObjectType = Image",
+        "NDims = 3",
+        "BinaryData = True",
+        "BinaryDataByteOrderMSB = False",
+    ]
+    if compressedSize is None:
+        lines.append("CompressedData = False")
+    else:
+        lines.append("CompressedData = True")
+        lines.append(COMPRESSED_SIZE_FORMAT.format(compressedSize))
+    lines += [
+        "TransformMatrix = " + " ".join(repr(float(v)) for col in cols for v in col),
+        "Offset = " + " ".join(repr(float(v)) for v in origin),
+        "CenterOfRotation = 0 0 0",
+        "AnatomicalOrientation = RAI",
+        "ElementSpacing = " + " ".join(repr(float(v)) for v in spacing),
+        "DimSize = " + " ".join(str(int(v)) for v in size),
+        "ElementType = " + metaElementTypes[dtype.name],
+        "ElementDataFile = " + dataFile,
+    ]
+    return ("\n".join(lines) + "\n").encode("ascii")
+
+
+def _nrrd_header(size, spacing, origin, direction, dtype, encoding):
+    cols = _columns(direction)
+    axes = [
+        "(" + ",".join(repr(float(v * spacing[i])) for v in cols[i]) + ")" for i in range(3)
+    ]
+    lines = [
+        "NRRD0004",
+        "# Complete NRRD file format specification at:",
+        "# http://teem.sourceforge.net/nrrd/format.html",
+        "type: " + nrrdTypes[dtype.name],
+        "dimension: 3",
+        "space: left-posterior-superior",
+        "sizes: " + " ".join(str(int(v)) for v in size),
+        "space directions: " + " ".join(axes),
+        "kinds: domain domain domain",
+        "endian: little",
+        "encoding: " + encoding,
+        "space origin: (" + ",".join(repr(float(v)) for v in origin) + ")",
+    ]
+    return ("\n".join(lines) + "\n\n").encode("ascii")
+
+
+def _quaternion(r):
+    """
+    Quaternion (b, c, d) and qfac of a 3x3 rotation matrix, following
+    nifti_mat44_to_quatern() from nifti1_io.c.
+    """
+    (r11, r12, r13), (r21, r22, r23), (r31, r32, r33) = [list(row) for row in r]
+
+    det = (
+        r11 * r22 * r33 - r11 * r32 * r23 - r21 * r12 * r33
+        + r21 * r32 * r13 + r31 * r12 * r23 - r31 * r22 * r13
+    )
+    if det > 0:
+        qfac = 1.0
+    else:
+        qfac = -1.0
+        r13, r23, r33 = -r13, -r23, -r33
+
+    a = r11 + r22 + r33 + 1.0
+    if a > 0.5:
+        a = 0.5 * math.sqrt(a)
+        b = 0.25 * (r32 - r23) / a
+        c = 0.25 * (r13 - r31) / a
+        d = 0.25 * (r21 - r12) / a
+    else:
+        xd = 1.0 + r11 - (r22 + r33)
+        yd = 1.0 + r22 - (r11 + r33)
+        zd = 1.0 + r33 - (r11 + r22)
+        if xd > 1.0:
+            b = 0.5 * math.sqrt(xd)
+            c = 0.25 * (r12 + r21) / b
+            d = 0.25 * (r13 + r31) / b
+            a = 0.25 * (r32 - r23) / b
+        elif yd > 1.0:
+            c = 0.5 * math.sqrt(yd)
+            b = 0.25 * (r12 + r21) / c
+            d = 0.25 * (r23 + r32) / c
+            a = 0.25 * (r13 - r31) / c
+        else:
+            d = 0.5 * math.sqrt(zd)
+            b = 0.25 * (r13 + r31) / d
+            c = 0.25 * (r23 + r32) / d
+            a = 0.25 * (r21 - r12) / d
+        if a < 0.0:
+            b, c, d = -b, -c, -d
+
+    return b, c, d, qfac
+
+
+def _nifti_header(size, spacing, origin, direction, dtype):
+    # NIfTI is RAS, ITK/SimpleITK is LPS: flip the first two axes
+    flip = (-1.0, -1.0, 1.0)
+    rot = [[flip[r] * direction[r * 3 + c] for c in range(3)] for r in range(3)]
+    offset = [flip[r] * origin[r] for r in range(3)]
+
+    b, c, d, qfac = _quaternion(rot)
+    srows = [
+        [rot[r][c] * spacing[c] for c in range(3)] + [offset[r]] for r in range(3)
+    ]
+
+    header = struct.pack(
+        NIFTI_HEADER_FORMAT,
+        348,                                        # sizeof_hdr
+        b"",                                        # data_type
+        b"",                                        # db_name
+        0,                                          # extents
+        0,                                          # session_error
+        b"r",                                       # regular
+        0,                                          # dim_info
+        3, int(size[0]), int(size[1]), int(size[2]), 1, 1, 1, 1,   # dim
+        0.0, 0.0, 0.0,                              # intent_p1..3
+        0,                                          # intent_code
+        niftiTypes[dtype.name],                     # datatype
+        dtype.itemsize * 8,                         # bitpix
+        0,                                          # slice_start
+        qfac, spacing[0], spacing[1], spacing[2], 0.0, 0.0, 0.0, 0.0,   # pixdim
+        352.0,                                      # vox_offset
+        1.0, 0.0,                                   # scl_slope, scl_inter
+        0,                                          # slice_end
+        b"\0",                                      # slice_code
+        10,                                         # xyzt_units (mm, sec)
+        0.0, 0.0, 0.0, 0.0,                         # cal_max, cal_min, slice_duration, toffset
+        0, 0,                                       # glmax, glmin
+        b"",                                        # descrip
+        b"",                                        # aux_file
+        1, 1,                                       # qform_code, sform_code (scanner)
+        b, c, d,                                    # quatern_b..d
+        offset[0], offset[1], offset[2],            # qoffset_x..z
+        *srows[0], *srows[1], *srows[2],            # srow_x, srow_y, srow_z
+        b"",                                        # intent_name
+        b"n+1\0",                                   # magic
+    )
+
+    # No extensions
+    return header + b"\0\0\0\0"
+
+
+class SlabImageWriter:
+    """
+    Write a 3D image to disk one z-slab at a time.
+
+    The header is written when the writer is created; each call to
+    write_slab() appends the next slices. close() checks that every slice
+    has been written.
+
+    Parameters
+    ----------
+    fileName : str
+        Output image (.mha, .mhd/.raw, .nrrd, .nii or .nii.gz).
+    size : sequence of int
+        Image size (x, y, z).
+    spacing, origin : sequence of float
+    direction : sequence of float
+        Row-major 3x3 direction matrix (as returned by SimpleITK).
+    dtype : numpy.dtype
+    compress : bool
+        Compress the voxel data of MHA/MHD (zlib) and NRRD (gzip) outputs.
+        '.nii.gz' is always gzipped, '.nii' never.
+    level : int
+        Compression level (0-9).
+    threads : int, optional
+        Compression threads. Defaults to the number of CPUs.
+    """
+
+    def __init__(self, fileName, size, spacing, origin,
+                 direction=(1, 0, 0, 0, 1, 0, 0, 0, 1), dtype=np.int16, compress=False,
+                 level=6, threads=None):
+        self.fileName = fileName
+        self.size = tuple(int(v) for v in size)
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self.slicesWritten = 0
+
+        basename, extension = split_extension(fileName)
+        container = None
+        # File and offset of the CompressedDataSize field of MetaImage headers
+        self._sizeField = None
+
+        if extension == ".mha":
+            header = _meta_header(
+                self.size, spacing, origin, direction, self.dtype, "LOCAL",
+                compressedSize=0 if compress else None,
+            )
+            self._raw = open(fileName, "wb")
+            self._raw.write(header)
+            if compress:
+                self._sizeField = (fileName, header.index(b"CompressedDataSize"))
+                container = "zlib"
+        elif extension in (".mhd", ".raw"):
+            dataFileName = basename + (".zraw" if compress else ".raw")
+            header = _meta_header(
+                self.size, spacing, origin, direction, self.dtype, os.path.basename(dataFileName),
+                compressedSize=0 if compress else None,
+            )
+            with open(basename + ".mhd", "wb") as fp:
+                fp.write(header)
+            self._raw = open(dataFileName, "wb")
+            if compress:
+                self._sizeField = (basename + ".mhd", header.index(b"CompressedDataSize"))
+                container = "zlib"
+        elif extension == ".nrrd":
+            self._raw = open(fileName, "wb")
+            self._raw.write(_nrrd_header(
+                self.size, spacing, origin, direction, self.dtype, "gzip" if compress else "raw"
+            ))
+            container = "gzip" if compress else None
+        elif extension == ".nii":
+            self._raw = open(fileName, "wb")
+            self._raw.write(_nifti_header(self.size, spacing, origin, direction, self.dtype))
+        elif extension == ".nii.gz":
+            self._raw = open(fileName, "wb")
+            container = "gzip"
+        else:
+            raise ValueError(f"Cannot stream-write {extension} files")
+
+        self._fp = self._raw
+        if container is not None:
+            self._fp = ParallelCompressWriter(self._raw, level=level, threads=threads, container=container)
+
+        if extension == ".nii.gz":
+            # The NIfTI header is part of the gzipped stream
+            self._fp.write(_nifti_header(self.size, spacing, origin, direction, self.dtype))
+
+    def write_slab(self, slab):
+        """
+        Append a slab of shape (slices, y, x) to the image.
+        """
+        slab = np.asarray(slab)
+        if slab.ndim == 2:
+            slab = slab[np.newaxis]
+
+        if slab.shape[1:] != (self.size[1], self.size[0]):
+            raise ValueError(f"Slab shape {slab.shape} does not match image size {self.size}")
+        if self.slicesWritten + slab.shape[0] > self.size[2]:
+            raise ValueError("More slices written than the image holds")
+
+        self._fp.write(np.ascontiguousarray(slab, dtype=self.dtype).data)
+        self.slicesWritten += slab.shape[0]
+
+    def _close_files(self):
+        if self._fp is not self._raw:
+            # ParallelCompressWriter does not close the file it writes to
+            self._fp.close()
+        self._raw.close()
+
+        if self._sizeField is not None:
+            headerFile, offset = self._sizeField
+            with open(headerFile, "r+b") as fp:
+                fp.seek(offset)
+                fp.write(COMPRESSED_SIZE_FORMAT.format(self._fp.bytesOut).encode("ascii"))
+
+    def close(self):
+        self._close_files()
+
+        if self.slicesWritten != self.size[2]:
+            raise ValueError(
+                f"Only {self.slicesWritten} of {self.size[2]} slices were written to {self.fileName}"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._close_files()
+        return False
+
+
+def write_image(image, fileName, compress=False, level=6, threads=None, slabSize=64):
+    """
+    Write a SimpleITK image with SlabImageWriter.
+
+    Parameters
+    ----------
+    image : SimpleITK.Image
+        3D scalar image.
+    fileName : str
+    compress, level, threads
+        See SlabImageWriter.
+    slabSize : int
+        Slices handed to the writer at a time.
+
+    Returns
+    -------
+    written : bool
+        False if the image cannot be written this way (not a 3D scalar
+        image, or a pixel type the format has no code for); the caller
+        should fall back to SimpleITK.
+    """
+    if image.GetDimension() != 3 or image.GetNumberOfComponentsPerPixel() != 1:
+        return False
+
+    # View of the pixel buffer, (z, y, x) ordered
+    array = sitk.GetArrayViewFromImage(image)
+    _, extension = split_extension(fileName)
+    types = niftiTypes if extension in (".nii", ".nii.gz") else metaElementTypes
+    if extension not in streamExtensions or array.dtype.name not in types:
+        return False
+
+    with SlabImageWriter(
+        fileName,
+        image.GetSize(),
+        image.GetSpacing(),
+        image.GetOrigin(),
+        image.GetDirection(),
+        dtype=array.dtype,
+        compress=compress,
+        level=level,
+        threads=threads,
+    ) as writer:
+        for z in range(0, array.shape[0], slabSize):
+            writer.write_slab(array[z:z + slabSize])
+
+    return True
@@ -0,0 +1,445 @@
+"""
+tiffIO.py
+
+Description: Writes 3D images as TIFF one slice at a time, either as one
+             multi-page file or as a series of single-page files, and
+             reads back the slice thickness stored in them. Used for
+             fileConverter's .tif outputs instead of ITK's TIFF writer.
+
+Notes:
+1. Values are rescaled to 0..32767 signed short, as ITK's
+   RescaleIntensityImageFilter did before: the input range comes from one
+   min/max pass over the image, and every slice is then rescaled on its
+   own with NumPy, so only one output slice is held in memory at a time.
+
+2. Pages are stored in strips, or in tiles with tile > 0 (a multiple of
+   16), uncompressed or Deflate-compressed (TIFF compression 8, zlib).
+   The strips/tiles of a page are compressed on several threads.
+
+3. The x/y pixel size is stored as XResolution/YResolution in pixels per
+   cm, which ITK/SimpleITK read back as the spacing in mm. TIFF has no
+   slice thickness, so it is stored in an ImageJ-style ImageDescription
+   ('spacing=' in 'unit=cm'); Fiji/ImageJ also pick it up from there, and
+   tiff_slice_spacing() reads it for fileConverter's TIFF inputs.
+
+4. Multi-page files that could exceed 4 GB are written as BigTIFF.
+"""
+
+import os
+import zlib
+import struct
+
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .lazyImport import lazy_import
+
+sitk = lazy_import("SimpleITK")
+
+
+# TIFF field types
+SHORT = 3
+LONG = 4
+RATIONAL = 5
+ASCII = 2
+LONG8 = 16
+
+# SampleFormat per numpy kind
+sampleFormats = {"u": 1, "i": 2, "f": 3}
+
+# Bytes per strip (uncompressed)
+STRIP_BYTES = 1 << 18
+
+# Stored value range of rescaled outputs
+OUTPUT_MAXIMUM = 32767
+
+
+def _resolution(spacing):
+    # Pixels per cm for a pixel size in mm
+    fraction = Fraction(10.0 / spacing).limit_denominator(1000000) if spacing > 0 else Fraction(1)
+    while fraction.numerator >= 2**32:
+        fraction = Fraction(fraction.numerator // 2, max(1, fraction.denominator // 2))
+    return fraction.numerator, fraction.denominator
+
+
+def image_description(size, spacing, minimum=0, maximum=OUTPUT_MAXIMUM):
+    """
+    ImageJ-style ImageDescription of a stack of size[2] slices.
+    """
+    return (
+        "ImageJ=1.11a\n"
+        f"images={size[2]}\n"
+        f"slices={size[2]}\n"
+        "unit=cm\n"
+        f"spacing={spacing[2] / 10.0!r}\n"
+        "loop=false\n"
+        f"min={minimum}\n"
+        f"max={maximum}\n"
+    )
+
+
+class TiffWriter:
+    """
+    Write a TIFF file one page (2D slice) at a time.
+
+    Parameters
+    ----------
+    fileName : str
+    width, height : int
+    dtype : numpy.dtype
+        Pixel type of the pages.
+    spacing : sequence of float
+        Pixel size in mm (x, y[, z]).
+    pages : int
+        Number of pages that will be written (used to choose BigTIFF).
+    compress : bool
+        Deflate-compress the pages.
+    level : int
+        zlib compression level (0-9).
+    tile : int, optional
+        Tile width/height (a multiple of 16). Strips if None or 0.
+    threads : int, optional
+        Compression threads. Defaults to the number of CPUs.
+    description : str, optional
+        ImageDescription of the first page.
+    """
+
+    def __init__(self, fileName, width, height, dtype, spacing=(1.0, 1.0), pages=1, compress=False,
+                 level=6, tile=None, threads=None, description=None):
+        self.fileName = fileName
+        self.width = int(width)
+        self.height = int(height)
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self.spacing = spacing
+        self.compress = compress
+        self.level = level
+        self.tile = tile or None
+        self.description = description
+        self.pagesWritten = 0
+
+        if self.tile is not None and self.tile % 16:
+            raise ValueError(f"TIFF tile size must be a multiple of 16, not {self.tile}")
+        if self.dtype.kind not in sampleFormats:
+            raise ValueError(f"Cannot write {self.dtype.name} pixels to TIFF")
+
+        # Leave room for the IFDs and deflate's worst case
+        estimate = int(self.width * self.height * self.dtype.itemsize * pages * 1.01) + pages * 4096
+        self.bigtiff = estimate >= 2**32 - 1
+
+        self._executor = None
+        if compress:
+            self._executor = ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1)
+
+        self._fp = open(fileName, "wb")
+        if self.bigtiff:
+            self._fp.write(b"II" + struct.pack("<HHHQ", 43, 8, 0, 0))
+            self._nextPointer = 8
+        else:
+            self._fp.write(b"II" + struct.pack("<HI", 42, 0))
+            self._nextPointer = 4
+
+    def _blocks(self, page):
+        # Strips (rows of the page) or tiles, as contiguous arrays
+        if self.tile is None:
+            rows = max(1, STRIP_BYTES // (self.width * self.dtype.itemsize))
+            return rows, [page[y:y + rows] for y in range(0, self.height, rows)]
+
+        tile = self.tile
+        blocks = []
+        for y in range(0, self.height, tile):
+            for x in range(0, self.width, tile):
+                block = page[y:y + tile, x:x + tile]
+                if block.shape != (tile, tile):
+                    # Edge tiles are padded to the full tile size
+                    padded = np.zeros((tile, tile), dtype=self.dtype)
+                    padded[:block.shape[0], :block.shape[1]] = block
+                    block = padded
+                blocks.append(block)
+        return None, blocks
+
+    def write_page(self, page):
+        """
+        Append a page of shape (height, width).
+        """
+        page = np.ascontiguousarray(page, dtype=self.dtype)
+        if page.shape != (self.height, self.width):
+            raise ValueError(f"Page shape {page.shape} does not match {(self.height, self.width)}")
+
+        rowsPerStrip, blocks = self._blocks(page)
+        data = [np.ascontiguousarray(block).tobytes() for block in blocks]
+        if self.compress:
+            data = list(self._executor.map(lambda b: zlib.compress(b, self.level), data))
+
+        offsets = []
+        for block in data:
+            offsets.append(self._fp.tell())
+            self._fp.write(block)
+        counts = [len(block) for block in data]
+
+        offsetType = LONG8 if self.bigtiff else LONG
+        tags = [
+            (254, LONG, [0]),
+            (256, LONG, [self.width]),
+            (257, LONG, [self.height]),
+            (258, SHORT, [self.dtype.itemsize * 8]),
+            (259, SHORT, [8 if self.compress else 1]),
+            (262, SHORT, [1]),
+        ]
+        if self.pagesWritten == 0 and self.description:
+            tags.append((270, ASCII, self.description.encode("ascii") + b"\0"))
+        if self.tile is None:
+            tags.append((273, offsetType, offsets))
+        tags.append((277, SHORT, [1]))
+        if self.tile is None:
+            tags.append((278, LONG, [rowsPerStrip]))
+            tags.append((279, offsetType, counts))
+        tags.extend([
+            (282, RATIONAL, list(_resolution(self.spacing[0]))),
+            (283, RATIONAL, list(_resolution(self.spacing[1]))),
+            (284, SHORT, [1]),
+            (296, SHORT, [3]),
+        ])
+        if self.tile is not None:
+            tags.extend([
+                (322, LONG, [self.tile]),
+                (323, LONG, [self.tile]),
+                (324, offsetType, offsets),
+                (325, offsetType, counts),
+            ])
+        tags.append((339, SHORT, [sampleFormats[self.dtype.kind]]))
+
+        self._write_ifd(tags)
+        self.pagesWritten += 1
+
+    def _write_ifd(self, tags):
+        # IFDs start on a word boundary
+        if self._fp.tell() % 2:
+            self._fp.write(b"\0")
+        ifdOffset = self._fp.tell()
+
+        if self.bigtiff:
+            countFormat, entryFormat, pointerFormat, inline = "<Q", "<HHQ", "<Q", 8
+        else:
+            countFormat, entryFormat, pointerFormat, inline = "<H", "<HHI", "<I", 4
+        entrySize = struct.calcsize(entryFormat) + inline
+        pointerSize = struct.calcsize(pointerFormat)
+
+        # Values that do not fit in an entry follow the IFD
+        extraOffset = ifdOffset + struct.calcsize(countFormat) + len(tags) * entrySize + pointerSize
+        entries = []
+        extra = b""
+        for tag, fieldType, values in tags:
+            if fieldType == ASCII:
+                value = values
+                count = len(values)
+            else:
+                fmt = {SHORT: "H", LONG: "I", RATIONAL: "I", LONG8: "Q"}[fieldType]
+                value = struct.pack(f"<{len(values)}{fmt}", *values)
+                count = len(values) // 2 if fieldType == RATIONAL else len(values)
+
+            if len(value) <= inline:
+                field = value.ljust(inline, b"\0")
+            else:
+                field = struct.pack(pointerFormat, extraOffset + len(extra))
+                extra += value + (b"\0" if len(value) % 2 else b"")
+            entries.append(struct.pack(entryFormat, tag, fieldType, count) + field)
+
+        self._fp.write(struct.pack(countFormat, len(tags)) + b"".join(entries))
+        nextPointer = self._fp.tell()
+        self._fp.write(struct.pack(pointerFormat, 0) + extra)
+
+        # Link the previous IFD (or the header) to this one
+        end = self._fp.tell()
+        self._fp.seek(self._nextPointer)
+        self._fp.write(struct.pack(pointerFormat, ifdOffset))
+        self._fp.seek(end)
+        self._nextPointer = nextPointer
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+
+def rescale_slice(array, minimum, maximum):
+    """
+    Rescale a slice from [minimum, maximum] to 0..32767 signed short,
+    truncating like ITK's RescaleIntensityImageFilter.
+    """
+    scale = OUTPUT_MAXIMUM / (maximum - minimum) if maximum > minimum else 0.0
+    rescaled = (array.astype(np.float64) - minimum) * scale
+    np.clip(rescaled, 0, OUTPUT_MAXIMUM, out=rescaled)
+    return rescaled.astype(np.int16)
+
+
+def series_file_names(fileName, slices):
+    """
+    Files of a TIFF series: <dir>/<name>/<name>_<zzzz>.tif for <dir>/<name>.tif
+    """
+    directory, filename = os.path.split(fileName)
+    basename = filename.split(".")[0]
+    return [os.path.join(directory, basename, f"{basename}_{z:04d}.tif") for z in range(slices)]
+
+
+def write_tiff_slices(slices, fileName, size, spacing, minimum, maximum, series=False, compress=False,
+                      level=6, tile=None, threads=None):
+    """
+    Rescale and write z-slices as a multi-page TIFF or a TIFF series.
+
+    Parameters
+    ----------
+    slices : iterable of numpy.ndarray
+        The size[2] slices, each of shape (y, x), in order.
+    fileName : str
+        Output .tif. A series is written to the directory named after it
+        (see series_file_names()).
+    size, spacing : sequence
+        Image size and spacing (x, y, z).
+    minimum, maximum : float
+        Input value range mapped to 0..32767.
+    series : bool
+        One single-page file per slice.
+    compress, level, tile, threads
+        See TiffWriter.
+
+    Returns
+    -------
+    files : list of str
+        Files written.
+    """
+    description = image_description(size, spacing)
+    options = dict(compress=compress, level=level, tile=tile, threads=threads, description=description)
+
+    if not series:
+        with TiffWriter(fileName, size[0], size[1], np.int16, spacing, pages=size[2], **options) as writer:
+            for array in slices:
+                writer.write_page(rescale_slice(array, minimum, maximum))
+        if writer.pagesWritten != size[2]:
+            raise ValueError(f"Only {writer.pagesWritten} of {size[2]} slices were written to {fileName}")
+        return [fileName]
+
+    files = series_file_names(fileName, size[2])
+    os.makedirs(os.path.dirname(files[0]), exist_ok=True)
+    for seriesFile, array in zip(files, slices):
+        with TiffWriter(seriesFile, size[0], size[1], np.int16, spacing, **options) as writer:
+            writer.write_page(rescale_slice(array, minimum, maximum))
+    return files
+
+
+def write_tiff(image, fileName, minimum=None, maximum=None, **options):
+    """
+    Write a SimpleITK image with write_tiff_slices(), slice by slice from
+    views of its pixel buffer.
+
+    minimum and maximum default to the image's value range.
+    """
+    # View of the pixel buffer, (z, y, x) ordered
+    array = sitk.GetArrayViewFromImage(image)
+    if array.ndim == 2:
+        array = array[np.newaxis]
+    size = tuple(image.GetSize()) + (1,) * (3 - image.GetDimension())
+    spacing = tuple(image.GetSpacing()) + (1.0,) * (3 - image.GetDimension())
+
+    if minimum is None or maximum is None:
+        minimum, maximum = np.inf, -np.inf
+        for z in range(array.shape[0]):
+            minimum = min(minimum, float(array[z].min()))
+            maximum = max(maximum, float(array[z].max()))
+
+    return write_tiff_slices(
+        (array[z] for z in range(array.shape[0])), fileName, size, spacing, minimum, maximum, **options
+    )
+
+
+def _first_ifd_tags(fp):
+    # {tag: (type, count, raw value bytes)} of the first IFD
+    byteOrder = fp.read(2)
+    if byteOrder not in (b"II", b"MM"):
+        return {}
+    endian = "<" if byteOrder == b"II" else ">"
+    version = struct.unpack(endian + "H", fp.read(2))[0]
+
+    if version == 43:
+        fp.read(4)
+        countFormat, entryFormat, pointerFormat, inline = "Q", "HHQ", "Q", 8
+    elif version == 42:
+        countFormat, entryFormat, pointerFormat, inline = "H", "HHI", "I", 4
+    else:
+        return {}
+
+    ifdOffset = struct.unpack(endian + pointerFormat, fp.read(struct.calcsize(endian + pointerFormat)))[0]
+    fp.seek(ifdOffset)
+    count = struct.unpack(endian + countFormat, fp.read(struct.calcsize(endian + countFormat)))[0]
+
+    entrySize = struct.calcsize(endian + entryFormat) + inline
+    table = fp.read(count * entrySize)
+    typeSizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 16: 8}
+
+    tags = {}
+    for idx in range(count):
+        entry = table[idx * entrySize:(idx + 1) * entrySize]
+        tag, fieldType, valueCount = struct.unpack(endian + entryFormat, entry[:-inline])
+        nbytes = typeSizes.get(fieldType, 1) * valueCount
+        value = entry[-inline:]
+        if nbytes > inline:
+            offset = struct.unpack(endian + pointerFormat, value)[0]
+            position = fp.tell()
+            fp.seek(offset)
+            value = fp.read(nbytes)
+            fp.seek(position)
+        tags[tag] = (fieldType, valueCount, value[:nbytes])
+    return tags
+
+
+def tiff_is_tiled(fileName):
+    """
+    Whether a TIFF stores its (first) page in tiles. ITK cannot read tiled
+    TIFFs: SimpleITK falls back to an RGBA reader and garbles the pixels.
+    """
+    try:
+        with open(fileName, "rb") as fp:
+            tags = _first_ifd_tags(fp)
+    except (OSError, struct.error):
+        return False
+    # TileWidth
+    return 322 in tags
+
+
+def tiff_slice_spacing(fileName):
+    """
+    Slice thickness (mm) stored in a TIFF's ImageJ-style ImageDescription.
+
+    Returns
+    -------
+    spacing : float or None
+        None if the file has no (readable) slice spacing.
+    """
+    try:
+        with open(fileName, "rb") as fp:
+            tags = _first_ifd_tags(fp)
+    except (OSError, struct.error):
+        return None
+    if 270 not in tags:
+        return None
+
+    fields = {}
+    for line in tags[270][2].rstrip(b"\0").decode("latin-1").splitlines():
+        key, _, value = line.partition("=")
+        fields[key.strip()] = value.strip()
+
+    try:
+        spacing = float(fields["spacing"])
+    except (KeyError, ValueError):
+        return None
+
+    unitScale = {"cm": 10.0, "mm": 1.0, "micron": 1e-3, "um": 1e-3, "µm": 1e-3}
+    return spacing * unitScale.get(fields.get("unit", "mm"), 1.0)
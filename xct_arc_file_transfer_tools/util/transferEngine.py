@@ -0,0 +1,761 @@
+"""
+transferEngine.py
+
+Description: Runs file transfers to and from remote hosts concurrently
+             over a few persistent SSH connections, with per-host
+             concurrency limits, retries and progress/throughput reports.
+
+Notes:
+1. Remote hosts are reached with the OpenSSH client, so everything in
+   ~/.ssh/config (host aliases, users, keys and the legacy key exchange
+   algorithms xt2 needs) applies. One master connection is opened per host
+   (ControlMaster) and every transfer runs as an sftp session multiplexed
+   over it, so the SSH handshake is paid once per host instead of once per
+   file.
+
+2. A host spec of the form 'local:<dir>' is a stand-in for a remote host:
+   remote paths are taken relative to <dir> on the local file system. It
+   supports the same operations and is meant for testing.
+
+3. Transfers are written to '<target>.part' and renamed once complete, so
+   an interrupted transfer never leaves a truncated file at the target.
+   With resume=True (the default) an interrupted transfer continues from
+   the last verified chunk of the '.part' file instead of starting over:
+   a sidecar '<file>.chunks.json' records the SHA-256 of every chunk (see
+   util/chunkLedger.py). The whole-file SHA-256 is computed while the data
+   streams in and returned in the transfer record; uploads are checked
+   against the SHA-256 of the remote file before it is renamed. A download
+   that cannot succeed (missing source, no permission) leaves neither the
+   '.part' file nor the sidecar behind.
+
+4. A failed transfer is retried (after a growing delay). If the master
+   connection died, it is reopened before the retry.
+
+5. list() expands many remote glob patterns in one sftp session (one
+   'ls' per pattern), so a directory tree can be checked without a
+   connection per file. stat() sends a whole list of paths to one remote
+   'stat' (GNU coreutils, so Linux hosts only) and gets the size and
+   modification time of every file that exists.
+
+6. Downloads only use sftp, so they work with any SFTP server (xt2 runs
+   OpenVMS). Uploads also run coreutils commands on the host (sha256sum,
+   truncate, mv), so they need a Linux host such as arc.
+"""
+
+import os
+import glob
+import time
+import hashlib
+import shlex
+import shutil
+import tempfile
+import threading
+import subprocess
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .chunkLedger import CHUNK_SIZE, ChunkLedger, StreamHasher
+from .instrumentation import stage
+
+
+# direction is 'get' (remote source -> local target) or 'put' (local source -> remote target)
+Transfer = namedtuple("Transfer", ["direction", "host", "source", "target"])
+
+
+class TransferError(Exception):
+    pass
+
+
+# Errors (from sftp or LocalHost) that no retry or resume will fix
+_PERMANENT_ERRORS = ("not found", "no such file", "permission denied", "matches")
+
+
+def _is_permanent(error):
+    message = str(error).lower()
+    return any(marker in message for marker in _PERMANENT_ERRORS)
+
+
+def _sftp_quote(path):
+    # Escape what sftp would split on, but leave glob characters active
+    return "".join("\\" + c if c in " \t\"'\\" else c for c in path)
+
+
+class SSHHost:
+    """
+    Remote host reached through a multiplexed OpenSSH connection.
+
+    Parameters
+    ----------
+    host : str
+        Host name or ~/.ssh/config alias.
+    sessions : int
+        Maximum number of concurrent transfers to this host.
+    timeout : int
+        Connection timeout (seconds).
+    """
+
+    def __init__(self, host, sessions=4, timeout=30):
+        self.host = host
+        self.sessions = sessions
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._controlDir = tempfile.mkdtemp(prefix="xct_ssh_")
+        self._controlPath = os.path.join(self._controlDir, "master")
+
+    def __repr__(self):
+        return self.host
+
+    def _options(self):
+        return [
+            "-o", "ControlMaster=no",
+            "-o", f"ControlPath={self._controlPath}",
+            "-o", "BatchMode=yes",
+            "-o", f"ConnectTimeout={self.timeout}",
+        ]
+
+    def _is_open(self):
+        result = subprocess.run(
+            ["ssh", "-o", f"ControlPath={self._controlPath}", "-O", "check", self.host],
+            capture_output=True,
+        )
+        return result.returncode == 0
+
+    def open(self):
+        """
+        Open the master connection (if it is not open already).
+        """
+        with self._lock:
+            if os.path.exists(self._controlPath) and self._is_open():
+                return
+
+            # The SSH handshake; everything after it reuses this connection
+            with stage("connect", host=self.host):
+                result = subprocess.run(
+                    [
+                        "ssh", "-fNM",
+                        "-o", f"ControlPath={self._controlPath}",
+                        "-o", "ControlPersist=yes",
+                        "-o", "BatchMode=yes",
+                        "-o", f"ConnectTimeout={self.timeout}",
+                        self.host,
+                    ],
+                    capture_output=True,
+                    text=True,
+                )
+            if result.returncode != 0:
+                raise TransferError(f"Cannot connect to {self.host}: {result.stderr.strip()}")
+
+    def close(self):
+        """
+        Close the master connection.
+        """
+        with self._lock:
+            if os.path.exists(self._controlPath):
+                subprocess.run(
+                    ["ssh", "-o", f"ControlPath={self._controlPath}", "-O", "exit", self.host],
+                    capture_output=True,
+                )
+            shutil.rmtree(self._controlDir, ignore_errors=True)
+
+    def sftp(self, commands):
+        """
+        Run sftp batch commands over the master connection.
+        """
+        result = subprocess.run(
+            ["sftp", "-q", "-b", "-"] + self._options() + [self.host],
+            input="\n".join(commands) + "\n",
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            raise TransferError(result.stderr.strip() or f"sftp to {self.host} failed")
+        return result.stdout
+
+    def run(self, command, input=None):
+        """
+        Run a shell command on the host and return its output.
+        """
+        result = subprocess.run(
+            ["ssh", "-qx" if input is not None else "-qnx"] + self._options() + [self.host, command],
+            input=input,
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            raise TransferError(result.stderr.strip() or f"'{command}' failed on {self.host}")
+        return result.stdout
+
+    def list(self, patterns):
+        """
+        Expand remote glob patterns in one sftp session.
+
+        Returns
+        -------
+        matches : list of list of str
+            Matching paths for each pattern (empty if nothing matches).
+        """
+        if not patterns:
+            return []
+
+        # '-' keeps sftp going when a pattern matches nothing
+        stdout = self.sftp([f"-ls -1 {_sftp_quote(pattern)}" for pattern in patterns])
+
+        # sftp echoes every batch command as 'sftp> <command>' before its output
+        matches = []
+        for line in stdout.splitlines():
+            if line.startswith("sftp> "):
+                matches.append([])
+            elif line.strip() and matches:
+                matches[-1].append(line.strip())
+
+        if len(matches) != len(patterns):
+            raise TransferError(f"Unexpected sftp listing from {self.host}")
+        return matches
+
+    def stat(self, paths):
+        """
+        Size and modification time of remote files, in one remote command.
+
+        Returns
+        -------
+        stats : dict
+            Path -> (size, mtime) for every path that is an existing file.
+        """
+        if not paths:
+            return {}
+
+        # Missing files only make stat complain on stderr
+        stdout = self.run(
+            "xargs -d '\\n' -r stat -L -c '%F|%s|%Y|%n' 2>/dev/null; true",
+            input="\n".join(paths) + "\n",
+        )
+
+        stats = {}
+        for line in stdout.splitlines():
+            kind, size, mtime, path = line.split("|", 3)
+            if kind.startswith("regular"):
+                stats[path] = (int(size), int(mtime))
+        return stats
+
+    def get(self, source, target, resume=False):
+        # The source may be a glob (e.g. '*ISQ*'); sftp fails if it matches several files.
+        # reget/reput continue from the current size of the target.
+        command = "reget" if resume else "get"
+        self.sftp([f"{command} {_sftp_quote(source)} {_sftp_quote(target)}"])
+
+    def put(self, source, target, resume=False):
+        command = "reput" if resume else "put"
+        self.sftp([f"{command} {_sftp_quote(source)} {_sftp_quote(target)}"])
+
+    def makedirs(self, path):
+        self.run(f"mkdir -p {shlex.quote(path)}")
+
+    def chunk_hashes(self, path, chunkSize):
+        """
+        SHA-256 of every complete chunk of a remote file (empty if it does
+        not exist).
+        """
+        stdout = self.run(
+            f"f={shlex.quote(path)}; [ -f \"$f\" ] || exit 0; "
+            f"n=$(( $(stat -c %s \"$f\") / {chunkSize} )); i=0; "
+            f"while [ $i -lt $n ]; do "
+            f"dd if=\"$f\" bs={chunkSize} skip=$i count=1 2>/dev/null | sha256sum | cut -c1-64; "
+            f"i=$((i + 1)); done"
+        )
+        return stdout.split()
+
+    def truncate(self, path, size):
+        self.run(f"truncate -s {size} {shlex.quote(path)}")
+
+    def sha256(self, path):
+        return self.run(f"sha256sum {shlex.quote(path)} | cut -c1-64").strip()
+
+    def rename(self, source, target):
+        self.run(f"mv -f {shlex.quote(source)} {shlex.quote(target)}")
+
+    def remove(self, path):
+        self.run(f"rm -f {shlex.quote(path)}")
+
+
+class LocalHost:
+    """
+    Local stand-in for a remote host. Remote paths are resolved relative to
+    the root directory.
+
+    Parameters
+    ----------
+    root : str
+    sessions : int
+        Maximum number of concurrent transfers to this host.
+    """
+
+    def __init__(self, root, sessions=4):
+        self.root = os.path.abspath(root)
+        self.sessions = sessions
+
+    def __repr__(self):
+        return "local:" + self.root
+
+    def path(self, remotePath):
+        return os.path.join(self.root, remotePath.lstrip("/"))
+
+    def open(self):
+        if not os.path.isdir(self.root):
+            raise TransferError(f"Cannot connect to {self}: no such directory")
+
+    def close(self):
+        pass
+
+    def list(self, patterns):
+        return [
+            ["/" + os.path.relpath(match, self.root) for match in sorted(glob.glob(self.path(pattern)))]
+            for pattern in patterns
+        ]
+
+    def stat(self, paths):
+        stats = {}
+        for path in paths:
+            if os.path.isfile(self.path(path)):
+                st = os.stat(self.path(path))
+                stats[path] = (st.st_size, int(st.st_mtime))
+        return stats
+
+    @staticmethod
+    def _copy(source, target, resume):
+        offset = os.path.getsize(target) if resume and os.path.exists(target) else 0
+        with open(source, "rb") as src, open(target, "ab" if offset else "wb") as dst:
+            src.seek(offset)
+            shutil.copyfileobj(src, dst, 1 << 20)
+
+    def get(self, source, target, resume=False):
+        matches = sorted(glob.glob(self.path(source)))
+        if not matches:
+            raise TransferError(f"{source} not found")
+        if len(matches) > 1:
+            raise TransferError(f"{source} matches {len(matches)} files")
+        self._copy(matches[0], target, resume)
+
+    def put(self, source, target, resume=False):
+        self._copy(source, self.path(target), resume)
+
+    def makedirs(self, path):
+        os.makedirs(self.path(path), exist_ok=True)
+
+    def chunk_hashes(self, path, chunkSize):
+        if not os.path.isfile(self.path(path)):
+            return []
+
+        hashes = []
+        with open(self.path(path), "rb") as fp:
+            for chunk in iter(lambda: fp.read(chunkSize), b""):
+                if len(chunk) == chunkSize:
+                    hashes.append(hashlib.sha256(chunk).hexdigest())
+        return hashes
+
+    def truncate(self, path, size):
+        with open(self.path(path), "r+b") as fp:
+            fp.truncate(size)
+
+    def sha256(self, path):
+        fileHash = hashlib.sha256()
+        with open(self.path(path), "rb") as fp:
+            for block in iter(lambda: fp.read(1 << 20), b""):
+                fileHash.update(block)
+        return fileHash.hexdigest()
+
+    def rename(self, source, target):
+        os.replace(self.path(source), self.path(target))
+
+    def remove(self, path):
+        if os.path.exists(self.path(path)):
+            os.remove(self.path(path))
+
+
+def open_host(spec, sessions=4):
+    """
+    Host for a host spec: 'local:<dir>' for a local stand-in, otherwise an
+    SSH host name or ~/.ssh/config alias.
+    """
+    if spec.startswith("local:"):
+        return LocalHost(spec[len("local:"):], sessions=sessions)
+    return SSHHost(spec, sessions=sessions)
+
+
+class TransferProgress:
+    """
+    Thread-safe progress and throughput of a set of transfers.
+    """
+
+    def __init__(self, total, interval=5.0):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.bytes = 0
+        self.start = time.perf_counter()
+
+        self._active = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def started(self, transfer, partFile):
+        with self._lock:
+            self._active[transfer] = partFile
+
+    def finished(self, transfer, nbytes, ok):
+        with self._lock:
+            self._active.pop(transfer, None)
+            self.done += 1
+            self.failed += 0 if ok else 1
+            self.bytes += nbytes
+
+    def _in_flight_bytes(self):
+        nbytes = 0
+        for partFile in self._active.values():
+            try:
+                nbytes += os.path.getsize(partFile)
+            except OSError:
+                pass
+        return nbytes
+
+    def report(self):
+        with self._lock:
+            nbytes = self.bytes + self._in_flight_bytes()
+            done, failed, active = self.done, self.failed, len(self._active)
+
+        elapsed = time.perf_counter() - self.start
+        rate = nbytes / elapsed / 1e6 if elapsed > 0 else 0.0
+        print(
+            f"[{done}/{self.total}] {nbytes / 1e6:.1f} MB in {elapsed:.1f} s "
+            f"({rate:.1f} MB/s), {active} active, {failed} failed"
+        )
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def __enter__(self):
+        if self.interval:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.report()
+
+
+class TransferEngine:
+    """
+    Runs transfers concurrently with a per-host limit.
+
+    Parameters
+    ----------
+    hosts : dict
+        Host spec -> SSHHost or LocalHost. Hosts of transfers that are not in
+        the dict are opened with open_host().
+    sessions : int
+        Concurrent transfers per host for hosts opened by the engine.
+    retries : int
+        Number of times a failed transfer is retried.
+    retryDelay : float
+        Delay before the first retry (seconds); doubled for every next one.
+    progressInterval : float
+        Seconds between progress reports (0 to only report at the end).
+    resume : bool
+        Continue interrupted transfers from their last verified chunk.
+    chunkSize : int
+        Chunk size of the resume ledgers (bytes).
+    """
+
+    def __init__(
+        self,
+        hosts=None,
+        sessions=4,
+        retries=3,
+        retryDelay=2.0,
+        progressInterval=5.0,
+        resume=True,
+        chunkSize=CHUNK_SIZE,
+    ):
+        self.hosts = dict(hosts or {})
+        self.sessions = sessions
+        self.retries = retries
+        self.retryDelay = retryDelay
+        self.progressInterval = progressInterval
+        self.resume = resume
+        self.chunkSize = chunkSize
+
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def host(self, spec):
+        """
+        Opened host for a host spec.
+        """
+        with self._lock:
+            if spec not in self.hosts:
+                self.hosts[spec] = open_host(spec, sessions=self.sessions)
+
+            host = self.hosts[spec]
+            if spec not in self._limits:
+                host.open()
+                self._limits[spec] = threading.BoundedSemaphore(host.sessions)
+            return host
+
+    def close(self):
+        for spec in self._limits:
+            self.hosts[spec].close()
+        self._limits = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def list(self, spec, patterns):
+        """
+        Expand remote glob patterns, split over the host's sessions.
+
+        Returns
+        -------
+        matches : dict
+            Pattern -> list of matching paths.
+        """
+        host = self.host(spec)
+        patterns = list(dict.fromkeys(patterns))
+
+        chunks = [patterns[i::host.sessions] for i in range(host.sessions)]
+        chunks = [chunk for chunk in chunks if chunk]
+
+        def list_chunk(chunk):
+            for attempt in range(self.retries + 1):
+                try:
+                    with stage("list", host=spec, patterns=len(chunk)):
+                        return host.list(chunk)
+                except TransferError:
+                    if attempt == self.retries:
+                        raise
+                    time.sleep(self.retryDelay * 2 ** attempt)
+                    host.open()
+
+        matches = {}
+        with ThreadPoolExecutor(max_workers=max(len(chunks), 1)) as executor:
+            for chunk, listing in zip(chunks, executor.map(list_chunk, chunks)):
+                matches.update(zip(chunk, listing))
+
+        return matches
+
+    def stat(self, spec, paths):
+        """
+        Size and modification time of remote files (see SSHHost.stat).
+        """
+        host = self.host(spec)
+        paths = list(dict.fromkeys(paths))
+
+        for attempt in range(self.retries + 1):
+            try:
+                with stage("stat", host=spec, paths=len(paths)):
+                    return host.stat(paths)
+            except TransferError:
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.retryDelay * 2 ** attempt)
+                host.open()
+
+    def transfer(self, transfer):
+        """
+        Run one transfer in the calling thread (waiting for a free session
+        to its host), with retries.
+
+        Returns
+        -------
+        record : dict
+            See run().
+        """
+        return self._transfer(transfer, None)
+
+    def _get(self, host, transfer, partFile, record):
+        ledger = ChunkLedger(transfer.target + ".chunks.json", transfer.source, self.chunkSize)
+        fileHash = hashlib.sha256()
+
+        offset = 0
+        if self.resume:
+            offset = ledger.verify(partFile, fileHash)
+        elif os.path.exists(partFile):
+            os.remove(partFile)
+        record["resumed_bytes"] = offset
+
+        hasher = StreamHasher(partFile, ledger, offset, fileHash).start()
+        try:
+            host.get(transfer.source, partFile, resume=offset > 0)
+        except BaseException as e:
+            # Keep the chunks written so far for the next attempt, except the
+            # last margin bytes, which sftp may have left with holes
+            resumable = self.resume and not (isinstance(e, TransferError) and _is_permanent(e))
+            hasher.stop(checkpoint=resumable)
+            if not resumable:
+                if os.path.exists(partFile):
+                    os.remove(partFile)
+                ledger.remove()
+            raise
+
+        record["sha256"] = hasher.finish()
+        os.replace(partFile, transfer.target)
+        ledger.remove()
+        record["bytes"] = os.path.getsize(transfer.target)
+
+    def _put(self, host, transfer, record):
+        partFile = transfer.target + ".part"
+        st = os.stat(transfer.source)
+        ledger = ChunkLedger(
+            transfer.source + ".chunks.json", [st.st_size, int(st.st_mtime)], self.chunkSize
+        )
+
+        # Local chunk hashes, unless an earlier attempt already has all of them
+        hasher = None
+        if not ledger.complete:
+            ledger.chunks = []
+            hasher = StreamHasher(transfer.source, ledger, margin=0, interval=0.05).start()
+
+        try:
+            offset = 0
+            if self.resume:
+                remoteChunks = host.chunk_hashes(partFile, self.chunkSize)
+                if hasher is not None:
+                    hasher.wait_for(len(remoteChunks) * self.chunkSize)
+
+                for local, remote in zip(ledger.chunks, remoteChunks):
+                    if local != remote:
+                        break
+                    offset += self.chunkSize
+                if remoteChunks:
+                    host.truncate(partFile, offset)
+            record["resumed_bytes"] = offset
+
+            host.put(transfer.source, partFile, resume=offset > 0)
+        finally:
+            if hasher is not None:
+                hasher.stop()
+
+        sha256 = hasher.finish() if hasher is not None else ledger.sha256
+        record["sha256"] = sha256
+
+        with stage("verify", host=transfer.host, file=transfer.target, bytes_in=st.st_size):
+            remoteSha256 = host.sha256(partFile)
+        if remoteSha256 != sha256:
+            host.remove(partFile)
+            raise TransferError(f"Checksum mismatch after uploading {transfer.source}")
+
+        host.rename(partFile, transfer.target)
+        ledger.remove()
+        record["bytes"] = st.st_size
+
+    def _transfer(self, transfer, progress):
+        host = self.host(transfer.host)
+        partFile = transfer.target + ".part" if transfer.direction == "get" else transfer.source
+
+        record = {
+            "direction": transfer.direction,
+            "host": transfer.host,
+            "source": transfer.source,
+            "target": transfer.target,
+            "status": "ok",
+            "error": None,
+            "bytes": 0,
+            "resumed_bytes": 0,
+            "sha256": None,
+            "attempts": 0,
+            "seconds": 0.0,
+        }
+
+        start = time.perf_counter()
+        with self._limits[transfer.host]:
+            if progress is not None:
+                progress.started(transfer, partFile)
+
+            # Time spent waiting for a free session is not part of the stage
+            with stage(transfer.direction, host=transfer.host, file=transfer.source) as timing:
+                for attempt in range(self.retries + 1):
+                    record["attempts"] = attempt + 1
+                    try:
+                        if transfer.direction == "get":
+                            self._get(host, transfer, partFile, record)
+                        elif transfer.direction == "put":
+                            self._put(host, transfer, record)
+                        else:
+                            raise ValueError(f"Unknown transfer direction {transfer.direction}")
+
+                        record["error"] = None
+                        break
+                    except (TransferError, OSError) as e:
+                        record["error"] = str(e)
+                        if attempt == self.retries:
+                            record["status"] = "error"
+                            break
+
+                        time.sleep(self.retryDelay * 2 ** attempt)
+                        try:
+                            # Reopens the master connection if it died
+                            host.open()
+                        except TransferError:
+                            pass
+
+                timing["bytes_in"] = timing["bytes_out"] = record["bytes"]
+                timing["resumed_bytes"] = record["resumed_bytes"]
+                timing["attempts"] = record["attempts"]
+                if record["status"] != "ok":
+                    timing["error"] = record["error"]
+
+            if progress is not None:
+                progress.finished(transfer, record["bytes"], record["status"] == "ok")
+
+        record["seconds"] = round(time.perf_counter() - start, 3)
+        return record
+
+    def run(self, transfers):
+        """
+        Run transfers.
+
+        Parameters
+        ----------
+        transfers : list of Transfer
+
+        Returns
+        -------
+        records : list of dict
+            One record per transfer, in order, with 'status' ('ok' or
+            'error'), 'error', 'bytes', 'resumed_bytes' (bytes kept from an
+            earlier attempt), 'sha256', 'attempts' and 'seconds'.
+        """
+        transfers = list(transfers)
+        if not transfers:
+            return []
+
+        # Open every host up front, so a bad host fails before any transfer starts
+        specs = list(dict.fromkeys(t.host for t in transfers))
+        for spec in specs:
+            self.host(spec)
+
+        maxWorkers = sum(self.hosts[spec].sessions for spec in specs)
+        records = [None] * len(transfers)
+
+        with TransferProgress(len(transfers), self.progressInterval) as progress:
+            with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+                futures = {
+                    executor.submit(self._transfer, transfer, progress): idx
+                    for idx, transfer in enumerate(transfers)
+                }
+                for future in as_completed(futures):
+                    record = future.result()
+                    records[futures[future]] = record
+                    if record["status"] != "ok":
+                        print(f"FAILED: {record['source']} ({record['error']})")
+
+        return records
@@ -0,0 +1,430 @@
+"""
+zarrIO.py
+
+Description: Writes 3D images as chunked, compressed, multiscale Zarr
+             stores (OME-NGFF 0.4 layout) one z-slab at a time, and reads
+             a region or a coarser level back without reading the rest of
+             the store.
+
+Notes:
+1. A store is a directory <name>.zarr holding one Zarr v2 array per
+   level ('0' is the full resolution, every next level is half the size
+   along x, y and z) and OME-NGFF 'multiscales' metadata in .zattrs, so
+   zarr-python, napari, Fiji (n5-viewer/MoBIE) and neuroglancer can open
+   it. Chunks are zlib-compressed ('zlib' in numcodecs) and named
+   '<z>.<y>.<x>'.
+
+2. The pyramid is built in the same pass as level 0: every pair of
+   slices written to a level is averaged over 2 x 2 x 2 voxels (edges are
+   repeated for odd sizes) and handed to the next level. Each level only
+   holds one row of chunks (chunks[0] slices) in memory. Integer images
+   are rounded back to their own type.
+
+3. OME-NGFF has no direction matrix: the (z, y, x) scale and translation
+   in .zattrs are the spacing and origin in mm, and the full SimpleITK
+   spacing, origin and direction (x, y, z order) are also stored under
+   'xct' in .zattrs. read_zarr() uses those.
+
+4. Levels are added until a level fits in one chunk in-plane (at most
+   MAX_LEVELS), unless a number of levels is given.
+"""
+
+import os
+import json
+import math
+import shutil
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .lazyImport import lazy_import
+
+sitk = lazy_import("SimpleITK")
+
+
+# Default chunk shape (z, y, x)
+DEFAULT_CHUNKS = (64, 256, 256)
+
+MAX_LEVELS = 8
+
+
+def level_shapes(shape, chunks=DEFAULT_CHUNKS, levels=None):
+    """
+    (z, y, x) shape of every pyramid level of an image of (z, y, x) shape.
+    """
+    shapes = [tuple(int(n) for n in shape)]
+    while len(shapes) < (levels or MAX_LEVELS):
+        z, y, x = shapes[-1]
+        if levels is None and y <= chunks[1] and x <= chunks[2]:
+            break
+        shapes.append((math.ceil(z / 2), math.ceil(y / 2), math.ceil(x / 2)))
+    return shapes
+
+
+def _downsample_pair(slices, dtype):
+    # Average a (1 or 2, y, x) block over 2 x 2 x 2 voxels, repeating the
+    # last row/column for odd sizes
+    work = np.float64 if dtype.itemsize > 2 else np.float32
+    total = slices[0].astype(work)
+    for s in slices[1:]:
+        total += s
+    total /= len(slices)
+
+    if total.shape[0] % 2:
+        total = np.concatenate([total, total[-1:]], axis=0)
+    if total.shape[1] % 2:
+        total = np.concatenate([total, total[:, -1:]], axis=1)
+    y, x = total.shape
+    total = total.reshape(y // 2, 2, x // 2, 2).mean(axis=(1, 3))
+
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        total = np.clip(np.rint(total), info.min, info.max)
+    return total.astype(dtype)
+
+
+class _LevelWriter:
+    # One level of a store: buffers one row of chunks and writes it out
+
+    def __init__(self, path, shape, chunks, dtype, level, executor):
+        self.path = path
+        self.shape = shape
+        self.chunks = chunks
+        self.dtype = dtype
+        self.level = level
+        self.executor = executor
+        self.buffer = np.zeros((chunks[0],) + shape[1:], dtype=dtype)
+        self.buffered = 0
+        self.row = 0
+        self.carry = None
+        self.next = None
+
+        os.makedirs(path)
+        with open(os.path.join(path, ".zarray"), "w") as fp:
+            json.dump({
+                "zarr_format": 2,
+                "shape": list(shape),
+                "chunks": list(chunks),
+                "dtype": dtype.str,
+                "compressor": {"id": "zlib", "level": level},
+                "fill_value": 0,
+                "order": "C",
+                "filters": None,
+                "dimension_separator": ".",
+            }, fp, indent=4)
+
+    def write(self, slab):
+        # The next level gets the average of every pair of slices
+        if self.next is not None:
+            pending = slab if self.carry is None else np.concatenate([self.carry, slab])
+            pairs = pending.shape[0] // 2 * 2
+            for z in range(0, pairs, 2):
+                self.next.write(_downsample_pair(pending[z:z + 2], self.dtype)[np.newaxis])
+            self.carry = pending[pairs:].copy() if pairs < pending.shape[0] else None
+
+        z = 0
+        while z < slab.shape[0]:
+            n = min(self.chunks[0] - self.buffered, slab.shape[0] - z)
+            self.buffer[self.buffered:self.buffered + n] = slab[z:z + n]
+            self.buffered += n
+            z += n
+            if self.buffered == self.chunks[0]:
+                self._write_row()
+
+    def _write_row(self):
+        # Edge chunks are stored full size, padded with the fill value
+        self.buffer[self.buffered:] = 0
+        cz, cy, cx = self.chunks
+        tiles = []
+        for yi in range(math.ceil(self.shape[1] / cy)):
+            for xi in range(math.ceil(self.shape[2] / cx)):
+                tiles.append((yi, xi))
+
+        def write_chunk(tile):
+            yi, xi = tile
+            chunk = np.zeros(self.chunks, dtype=self.dtype)
+            block = self.buffer[:, yi * cy:(yi + 1) * cy, xi * cx:(xi + 1) * cx]
+            chunk[:, :block.shape[1], :block.shape[2]] = block
+            with open(os.path.join(self.path, f"{self.row}.{yi}.{xi}"), "wb") as fp:
+                fp.write(zlib.compress(chunk.data, self.level))
+
+        list(self.executor.map(write_chunk, tiles))
+        self.row += 1
+        self.buffered = 0
+
+    def close(self):
+        if self.next is not None:
+            if self.carry is not None:
+                self.next.write(_downsample_pair(self.carry, self.dtype)[np.newaxis])
+            self.next.close()
+        if self.buffered:
+            self._write_row()
+
+
+class ZarrWriter:
+    """
+    Write a 3D image to a multiscale Zarr store one z-slab at a time.
+
+    Same interface as streamWriters.SlabImageWriter: write_slab() appends
+    the next slices and close() checks that every slice has been written.
+
+    Parameters
+    ----------
+    fileName : str
+        Output store (<name>.zarr). An existing store is replaced.
+    size : sequence of int
+        Image size (x, y, z).
+    spacing, origin : sequence of float
+    direction : sequence of float
+        Row-major 3x3 direction matrix (as returned by SimpleITK).
+    dtype : numpy.dtype
+    chunks : sequence of int
+        Chunk shape (z, y, x).
+    levels : int, optional
+        Number of pyramid levels, including full resolution (default: see
+        note 4).
+    level : int
+        zlib compression level (0-9).
+    threads : int, optional
+        Compression threads. Defaults to the number of CPUs.
+    """
+
+    def __init__(self, fileName, size, spacing, origin,
+                 direction=(1, 0, 0, 0, 1, 0, 0, 0, 1), dtype=np.int16, chunks=DEFAULT_CHUNKS,
+                 levels=None, level=6, threads=None):
+        self.fileName = fileName
+        self.size = tuple(int(v) for v in size)
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self.slicesWritten = 0
+
+        if os.path.exists(fileName):
+            if not os.path.exists(os.path.join(fileName, ".zgroup")):
+                raise ValueError(f"{fileName} exists and is not a Zarr store")
+            shutil.rmtree(fileName)
+        os.makedirs(fileName)
+
+        chunks = tuple(int(c) for c in chunks)
+        shapes = level_shapes(self.size[::-1], chunks, levels)
+        datasets = []
+        for n, shape in enumerate(shapes):
+            factor = 2 ** n
+            datasets.append({
+                "path": str(n),
+                "coordinateTransformations": [
+                    {"type": "scale", "scale": [s * factor for s in spacing[::-1]]},
+                    {"type": "translation", "translation": [
+                        o + s * (factor - 1) / 2 for o, s in zip(origin[::-1], spacing[::-1])
+                    ]},
+                ],
+            })
+
+        with open(os.path.join(fileName, ".zgroup"), "w") as fp:
+            json.dump({"zarr_format": 2}, fp, indent=4)
+        with open(os.path.join(fileName, ".zattrs"), "w") as fp:
+            json.dump({
+                "multiscales": [{
+                    "version": "0.4",
+                    "name": os.path.basename(split_store(fileName)),
+                    "axes": [{"name": axis, "type": "space", "unit": "millimeter"} for axis in "zyx"],
+                    "datasets": datasets,
+                    "type": "mean",
+                }],
+                "xct": {
+                    "size": list(self.size),
+                    "spacing": list(spacing),
+                    "origin": list(origin),
+                    "direction": list(direction),
+                },
+            }, fp, indent=4)
+
+        self._executor = ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1)
+        self._levels = [
+            _LevelWriter(os.path.join(fileName, str(n)), shape, chunks, self.dtype, level, self._executor)
+            for n, shape in enumerate(shapes)
+        ]
+        for current, following in zip(self._levels, self._levels[1:]):
+            current.next = following
+
+    def write_slab(self, slab):
+        """
+        Append a slab of shape (slices, y, x) to the image.
+        """
+        slab = np.asarray(slab)
+        if slab.ndim == 2:
+            slab = slab[np.newaxis]
+
+        if slab.shape[1:] != (self.size[1], self.size[0]):
+            raise ValueError(f"Slab shape {slab.shape} does not match image size {self.size}")
+        if self.slicesWritten + slab.shape[0] > self.size[2]:
+            raise ValueError("More slices written than the image holds")
+
+        self._levels[0].write(slab.astype(self.dtype, copy=False))
+        self.slicesWritten += slab.shape[0]
+
+    def close(self):
+        try:
+            if self.slicesWritten != self.size[2]:
+                raise ValueError(
+                    f"Only {self.slicesWritten} of {self.size[2]} slices were written to {self.fileName}"
+                )
+            self._levels[0].close()
+        finally:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown()
+        return False
+
+
+def split_store(fileName):
+    """
+    Store path without its trailing '/' and '.zarr'.
+    """
+    fileName = fileName.rstrip("/")
+    return fileName[:-len(".zarr")] if fileName.endswith(".zarr") else fileName
+
+
+def write_zarr(image, fileName, slabSize=64, **options):
+    """
+    Write a SimpleITK image with ZarrWriter.
+
+    Parameters
+    ----------
+    image : SimpleITK.Image
+        3D scalar image.
+    fileName : str
+    slabSize : int
+        Slices handed to the writer at a time.
+    **options
+        chunks, levels, level and threads of ZarrWriter.
+
+    Raises
+    ------
+    ValueError
+        If the image is not a 3D scalar image.
+    """
+    if image.GetDimension() != 3 or image.GetNumberOfComponentsPerPixel() != 1:
+        raise ValueError("Only 3D scalar images can be written to Zarr")
+
+    # View of the pixel buffer, (z, y, x) ordered
+    array = sitk.GetArrayViewFromImage(image)
+    with ZarrWriter(
+        fileName, image.GetSize(), image.GetSpacing(), image.GetOrigin(), image.GetDirection(),
+        dtype=array.dtype, **options
+    ) as writer:
+        for z in range(0, array.shape[0], slabSize):
+            writer.write_slab(array[z:z + slabSize])
+
+
+def zarr_levels(fileName):
+    """
+    Levels of a store written by ZarrWriter.
+
+    Returns
+    -------
+    levels : list of dict
+        'size' (x, y, z), 'spacing', 'origin' and 'chunks' (z, y, x) of
+        every level, full resolution first.
+    """
+    with open(os.path.join(fileName, ".zattrs"), "r") as fp:
+        attrs = json.load(fp)
+    if "xct" not in attrs:
+        raise ValueError(f"{fileName} was not written by fileConverter (no 'xct' metadata)")
+
+    spacing = np.array(attrs["xct"]["spacing"], dtype=float)
+    origin = np.array(attrs["xct"]["origin"], dtype=float)
+    direction = np.array(attrs["xct"]["direction"], dtype=float).reshape(3, 3)
+
+    levels = []
+    for dataset in attrs["multiscales"][0]["datasets"]:
+        with open(os.path.join(fileName, dataset["path"], ".zarray"), "r") as fp:
+            zarray = json.load(fp)
+        factor = 2 ** int(dataset["path"])
+        levels.append({
+            "path": dataset["path"],
+            "size": zarray["shape"][::-1],
+            "spacing": list(spacing * factor),
+            "origin": list(origin + direction @ (spacing * (factor - 1) / 2)),
+            "direction": list(direction.ravel()),
+            "chunks": zarray["chunks"],
+            "dtype": zarray["dtype"],
+            "compressor": zarray["compressor"],
+        })
+    return levels
+
+
+def read_zarr(fileName, level=0, start=None, size=None):
+    """
+    Read a region of one level of a store written by ZarrWriter. Only the
+    chunks overlapping the region are read.
+
+    Parameters
+    ----------
+    fileName : str
+    level : int
+        Pyramid level (0 is the full resolution).
+    start, size : sequence of int, optional
+        Region (x, y, z) in voxels of that level. The whole level by
+        default; size is clipped to the level.
+
+    Returns
+    -------
+    image : SimpleITK.Image
+        With the spacing of the level and the origin of the region.
+    """
+    levels = zarr_levels(fileName)
+    if not 0 <= level < len(levels):
+        raise ValueError(f"{fileName} has levels 0-{len(levels) - 1}, not {level}")
+    info = levels[level]
+
+    levelSize = info["size"]
+    start = [0, 0, 0] if start is None else [int(v) for v in start]
+    if size is None:
+        size = [n - s for n, s in zip(levelSize, start)]
+    stop = [min(s + int(n), total) for s, n, total in zip(start, size, levelSize)]
+    if any(s < 0 or s >= e for s, e in zip(start, stop)):
+        raise ValueError(f"Region start {start} size {size} is outside the level size {levelSize}")
+
+    # (z, y, x) from here on
+    start, stop = start[::-1], stop[::-1]
+    chunks = info["chunks"]
+    dtype = np.dtype(info["dtype"])
+    path = os.path.join(fileName, info["path"])
+    region = np.zeros([e - s for s, e in zip(start, stop)], dtype=dtype)
+
+    first = [s // c for s, c in zip(start, chunks)]
+    last = [(e - 1) // c for e, c in zip(stop, chunks)]
+    for zi in range(first[0], last[0] + 1):
+        for yi in range(first[1], last[1] + 1):
+            for xi in range(first[2], last[2] + 1):
+                index = (zi, yi, xi)
+                chunkFile = os.path.join(path, ".".join(str(i) for i in index))
+                if not os.path.exists(chunkFile):
+                    # Missing chunks hold the fill value
+                    continue
+                with open(chunkFile, "rb") as fp:
+                    data = fp.read()
+                if info["compressor"] is not None:
+                    data = zlib.decompress(data)
+                chunk = np.frombuffer(data, dtype=dtype).reshape(chunks)
+
+                low = [max(i * c, s) for i, c, s in zip(index, chunks, start)]
+                high = [min((i + 1) * c, e) for i, c, e in zip(index, chunks, stop)]
+                region[tuple(slice(lo - s, hi - s) for lo, hi, s in zip(low, high, start))] = \
+                    chunk[tuple(slice(lo - i * c, hi - i * c) for lo, hi, i, c in zip(low, high, index, chunks))]
+
+    image = sitk.GetImageFromArray(region)
+    spacing = np.array(info["spacing"])
+    direction = np.array(info["direction"]).reshape(3, 3)
+    image.SetSpacing(info["spacing"])
+    image.SetDirection(info["direction"])
+    image.SetOrigin(list(np.array(info["origin"]) + direction @ (spacing * start[::-1])))
+    return image
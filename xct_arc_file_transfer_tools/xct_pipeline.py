@@ -0,0 +1,323 @@
+# -----------------------------------------------------
+# xct_pipeline.py
+#
+# Description: Fetches the ISQs of a pull request from xt2, converts them
+#              to NIfTI and uploads them to arc, with the three stages
+#              running at the same time: the next ISQ is downloaded while
+#              the current one converts and the previous NIfTI uploads.
+#
+# Notes:
+# 1. Every stage has its own workers (--fetch-workers, --convert-workers,
+#    --upload-workers) and the stages are connected by bounded queues
+#    (--queue-size), see util/pipeline.py. Conversions run in a process
+#    pool.
+#
+# 2. Local scratch disk is bounded: no new ISQ is fetched while the ISQs
+#    and NIfTIs in flight take more than --scratch-gb, or while less than
+#    --min-free-gb is free. Each fetch reserves the size of the largest ISQ
+#    seen so far and corrects it to the downloaded size. ISQs are removed
+#    once converted and NIfTIs once uploaded (unless --keep-local).
+#
+# 3. With --skip-existing, stacks that are already on arc (checked with
+#    one remote stat, as in check_arc.py) are not fetched.
+#
+# 4. The utilisation of every stage is printed at the end. The stage with
+#    the highest utilisation is the bottleneck; adding workers to the
+#    others will not make the run faster.
+#
+# 5. Transfers are resumable (see util/chunkLedger.py): rerunning after an
+#    interruption continues partial downloads and uploads from their last
+#    verified chunk. --no-resume always starts over.
+#
+# 6. Either host may be 'local:<dir>' (for testing).
+#
+# 7. --metrics-summary / --metrics <file.jsonl> break the stages down further:
+#    SSH handshakes, transfers, and the read and write of every conversion
+#    (see util/instrumentation.py).
+#
+# 8. With --db <jobs.db>, only stacks that were not uploaded yet are
+#    processed, and every stack's fetch, conversion and upload (or its
+#    error) is recorded in the database (see util/manifest.py). Rerunning a
+#    long pull request after adding subjects only processes the new stacks.
+# -----------------------------------------------------
+# USAGE:
+# 1. conda activate manskelab
+# 2. python xct_pipeline.py <pull_request.txt> xt2 ./ arc <arc_out_dir> [--convert-workers 2] [--scratch-gb 50] [--db jobs.db]
+#
+# -----------------------------------------------------
+
+import os
+import sys
+import json
+import argparse
+
+from concurrent.futures import ProcessPoolExecutor
+
+from batchConverter import _available_cpus, _convert_job, _preload_backends
+from util.manifest import JobDB, parse_txt, expand_jobs
+from util.parallelCompress import compressionPresets
+from util.instrumentation import Instrumentation, add_arguments
+from util.pipeline import Stage, Pipeline, ScratchBudget, print_stage_report
+from util.transferEngine import Transfer, TransferEngine, open_host
+
+XT2_DATA_ROOT = '/DISK6/xtremect2/data'
+
+
+def pipeline_items(data_dict, temp_dir, arc_out_dir, data_root=XT2_DATA_ROOT, only=None):
+    '''
+    pipeline_items
+        One item per stack of data_dict, with its (Study_ID, timepoint, STACK)
+        key, the xt2 source, the local isq and nii.gz files and the arc target.
+        With only (a set of keys), other stacks are skipped.
+    '''
+    stacks = ['DST', 'MID', 'PRX']
+    items = []
+
+    for id, measurements in data_dict.items():
+
+        time = 0
+        for image in measurements:
+            image_dir = os.path.join(temp_dir, id[0], str(time))
+            arc_dir = '{}/{}/{}'.format(arc_out_dir, id[0], time)
+
+            for idx in range(3):
+                stack = stacks[idx]
+                if only is not None and (id[0], time, stack) not in only:
+                    continue
+                name = '{}_{}'.format(id[0], stack)
+
+                items.append({
+                    'id': name,
+                    'key': (id[0], time, stack),
+                    'source': r'{}/0000{}/000{}/*ISQ*'.format(data_root, id[1], image[idx]),
+                    'isq': os.path.join(image_dir, name + '.isq'),
+                    'nii': os.path.join(image_dir, name + '.nii.gz'),
+                    'arc_dir': arc_dir,
+                    'arc_target': '{}/{}.nii.gz'.format(arc_dir, name),
+                })
+            time += 1
+
+    return items
+
+
+class XCTPipeline:
+    '''
+    Stage functions of the fetch -> convert -> upload pipeline.
+    '''
+
+    def __init__(self, engine, xt2_host, arc_host, executor, budget, keep_local=False, options=None,
+                 instrumentation=None, db=None):
+        self.engine = engine
+        self.xt2_host = xt2_host
+        self.arc_host = arc_host
+        self.executor = executor
+        self.budget = budget
+        self.keep_local = keep_local
+        self.options = options or {}
+        self.instrumentation = instrumentation
+        self.db = db
+
+        self._arc_dirs = set()
+        # Scratch charged for an ISQ before it is fetched: the largest seen so far
+        self._isq_estimate = 0
+
+    def _mark(self, item, state):
+        if self.db is not None:
+            self.db.mark([item['key']], state)
+
+    def wait_for_scratch(self, item):
+        # Backpressure: wait until the scratch disk has room for the ISQ
+        item['isq_bytes'] = self._isq_estimate
+        self.budget.reserve(item['isq_bytes'])
+
+    def _charge_isq(self, item, nbytes):
+        # Replace the estimate reserved by wait_for_scratch with the real size
+        self.budget.adjust(nbytes - item['isq_bytes'])
+        item['isq_bytes'] = nbytes
+        self._isq_estimate = max(self._isq_estimate, nbytes)
+
+    def fetch(self, item):
+        try:
+            # Fetched by an earlier, interrupted run
+            if os.path.exists(item['isq']):
+                self._charge_isq(item, os.path.getsize(item['isq']))
+                self._mark(item, 'fetched')
+                return item
+
+            os.makedirs(os.path.dirname(item['isq']), exist_ok=True)
+            record = self.engine.transfer(Transfer('get', self.xt2_host, item['source'], item['isq']))
+            if record['status'] != 'ok':
+                raise RuntimeError(record['error'])
+        except Exception:
+            self.budget.release(item['isq_bytes'])
+            raise
+
+        self._charge_isq(item, os.path.getsize(item['isq']))
+        item['isq_sha256'] = record['sha256']
+        self._mark(item, 'fetched')
+        return item
+
+    def convert(self, item):
+        try:
+            record = self.executor.submit(
+                _convert_job, item['isq'], item['nii'], self.options, self.instrumentation is not None
+            ).result()
+            if self.instrumentation is not None:
+                self.instrumentation.add(record.pop('stages', []))
+        finally:
+            os.remove(item['isq'])
+            self.budget.release(item['isq_bytes'])
+
+        if record['status'] != 'ok':
+            raise RuntimeError(record['error'])
+
+        item['nii_bytes'] = os.path.getsize(item['nii'])
+        self.budget.adjust(item['nii_bytes'])
+        self._mark(item, 'converted')
+        return item
+
+    def upload(self, item):
+        try:
+            if item['arc_dir'] not in self._arc_dirs:
+                self.engine.host(self.arc_host).makedirs(item['arc_dir'])
+                self._arc_dirs.add(item['arc_dir'])
+
+            record = self.engine.transfer(Transfer('put', self.arc_host, item['nii'], item['arc_target']))
+            if record['status'] != 'ok':
+                raise RuntimeError(record['error'])
+        finally:
+            if not self.keep_local:
+                os.remove(item['nii'])
+            self.budget.release(item['nii_bytes'])
+
+        self._mark(item, 'uploaded')
+        return item
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sftp_path", type=str, help="Text file (path + filename)")
+    parser.add_argument("xt2_host", type=str, help="Host address of xt2 server (or local:<dir>)")
+    parser.add_argument("out_dir", type=str, help="Output")
+    parser.add_argument("arc_host", type=str, help="Host address of arc cluster (or local:<dir>)")
+    parser.add_argument("arc_out_dir", type=str, help="Output dir on arc")
+    parser.add_argument("--data-root", type=str, default=XT2_DATA_ROOT, help="Sample directories on xt2")
+    parser.add_argument("--fetch-workers", type=int, default=2, help="Concurrent downloads from xt2")
+    parser.add_argument("--convert-workers", type=int, default=1, help="Concurrent conversions")
+    parser.add_argument("--upload-workers", type=int, default=2, help="Concurrent uploads to arc")
+    parser.add_argument("--queue-size", type=int, default=2, help="Items waiting between two stages")
+    parser.add_argument("--scratch-gb", type=float, default=50.0, help="Local disk used by images in flight (GB)")
+    parser.add_argument("--min-free-gb", type=float, default=5.0, help="Local disk to always leave free (GB)")
+    parser.add_argument("--retries", type=int, default=3, help="Retries per failed transfer")
+    parser.add_argument("--no-resume", action="store_true", help="Restart interrupted transfers from scratch")
+    parser.add_argument("--skip-existing", action="store_true", help="Skip stacks already on arc")
+    parser.add_argument("--keep-local", action="store_true", help="Keep the NIfTIs after uploading")
+    parser.add_argument("--stream", action="store_true", help="Convert ISQs slab by slab")
+    parser.add_argument("--compression", type=str, default=None, choices=list(compressionPresets), help="NIfTI compression preset (fast, default or small)")
+    parser.add_argument("--report", type=str, default=None, help="JSON file to write per-stack results to")
+    parser.add_argument("--db", type=str, default=None, help="Job state database; only process stacks not uploaded yet")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    temp_dir = os.path.join(args.out_dir, 'temp')
+    os.makedirs(temp_dir, exist_ok=True)
+
+    with open(args.sftp_path, 'r') as file:
+        data_dict = parse_txt(file)
+
+    db = None
+    only = None
+    if args.db is not None:
+        db = JobDB(args.db)
+        jobs = expand_jobs(data_dict)
+        counts = db.sync(jobs)
+        only = db.pending('uploaded', jobs)
+        print('{} new and {} changed stacks in {}, {} of {} not uploaded yet'.format(
+            counts['new'], counts['changed'], args.db, len(only), len(jobs)))
+
+    items = pipeline_items(data_dict, temp_dir, args.arc_out_dir, args.data_root, only)
+
+    # The stage worker counts are the per-host session limits
+    hosts = {args.xt2_host: open_host(args.xt2_host, sessions=args.fetch_workers)}
+    if args.arc_host != args.xt2_host:
+        hosts[args.arc_host] = open_host(args.arc_host, sessions=args.upload_workers)
+
+    instrumentation = Instrumentation.from_args(args, tool='xct_pipeline')
+    with instrumentation, TransferEngine(hosts, retries=args.retries, resume=not args.no_resume) as engine:
+        engine.host(args.xt2_host)
+        engine.host(args.arc_host)
+
+        if args.skip_existing:
+            existing = engine.stat(args.arc_host, [item['arc_target'] for item in items])
+            skipped = len([item for item in items if item['arc_target'] in existing])
+            if db is not None:
+                db.mark([item['key'] for item in items if item['arc_target'] in existing], 'uploaded')
+            items = [item for item in items if item['arc_target'] not in existing]
+            print('Skipping {} stacks already on {}'.format(skipped, args.arc_host))
+
+        if not items:
+            print('Nothing to do.')
+            return
+
+        jobs = [(item['isq'], item['nii']) for item in items]
+        _preload_backends(jobs)
+
+        budget = ScratchBudget(
+            maxBytes=int(args.scratch_gb * 1e9),
+            directory=temp_dir,
+            minFreeBytes=int(args.min_free_gb * 1e9),
+        )
+
+        with ProcessPoolExecutor(max_workers=args.convert_workers) as executor:
+            stages = XCTPipeline(
+                engine,
+                args.xt2_host,
+                args.arc_host,
+                executor,
+                budget,
+                keep_local=args.keep_local,
+                instrumentation=instrumentation,
+                db=db,
+                options={
+                    'stream': args.stream,
+                    'compression': args.compression,
+                    # Share the CPUs between the concurrent conversions
+                    'compressThreads': max(1, _available_cpus() // args.convert_workers),
+                },
+            )
+            pipeline = Pipeline(
+                [
+                    Stage('fetch', stages.fetch, args.fetch_workers, gate=stages.wait_for_scratch),
+                    Stage('convert', stages.convert, args.convert_workers),
+                    Stage('upload', stages.upload, args.upload_workers),
+                ],
+                queueSize=args.queue_size,
+            )
+
+            print('Processing {} stacks'.format(len(items)))
+            results, stats, wall = pipeline.run(items)
+
+    print()
+    print_stage_report(stats, wall)
+
+    if args.report is not None:
+        with open(args.report, 'w') as fp:
+            json.dump({'stacks': results, 'stages': stats, 'wall_seconds': round(wall, 3)}, fp, indent=2)
+
+    failed = [r for r in results if r['status'] != 'ok']
+    if db is not None:
+        states = {'fetch': 'fetched', 'convert': 'converted', 'upload': 'uploaded'}
+        for result in failed:
+            if result['status'] == 'error':
+                db.mark([result['item']['key']], states[result['stage']], error=result['error'])
+
+    if failed:
+        print()
+        for result in failed:
+            print('FAILED ({}): {} {}'.format(result['stage'], result['item']['id'], result['error']))
+        sys.exit(1)
+
+if __name__=='__main__':
+
+    main()
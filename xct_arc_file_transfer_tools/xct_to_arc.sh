@@ -9,9 +9,10 @@ FILE_CONVERTER=$SCRIPT_DIR/fileConverter.py
 PULL_REQUEST=$1
 ARC_TARGET_PATH=$2
 
-# Prepare "pull to local" scripts
-echo python $SCRIPT_DIR/get_xct.py $PULL_REQUEST $XT2_HOST ./ $ARC_HOST $ARC_TARGET_PATH
-python $SCRIPT_DIR/get_xct.py $PULL_REQUEST $XT2_HOST ./ $ARC_HOST $ARC_TARGET_PATH
+# Prepare "pull to local" scripts (images that already exist on ARC are skipped below,
+# so only the command log is written here)
+echo python $SCRIPT_DIR/get_xct.py $PULL_REQUEST $XT2_HOST ./ $ARC_HOST $ARC_TARGET_PATH --log-only
+python $SCRIPT_DIR/get_xct.py $PULL_REQUEST $XT2_HOST ./ $ARC_HOST $ARC_TARGET_PATH --log-only
 
 ssh -qnx $ARC_HOST "mkdir $ARC_TARGET_PATH"
 scp -r ./temp/* $ARC_HOST:$ARC_TARGET_PATH
@@ -38,10 +38,13 @@ do
         nii_image_dir=${isq_image_dir%%.i*}.nii.gz
         nii_image_file=${nii_image_dir##*./temp/}
 
-        echo Transferring image locally...
-
-        eval $line
-        echo
+        # get_xct.py already fetched the image; only fetch it again if it failed
+        if [[ ! -f "$isq_image_dir" ]]
+        then
+            echo Transferring image locally...
+            eval $line
+            echo
+        fi
 
         # convert isq to nii.gz
         echo python $FILE_CONVERTER $isq_image_dir $nii_image_dir